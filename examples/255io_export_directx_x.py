@@ -88,14 +88,49 @@ def LegalName(Name):
     return NewName
 
 
+class AtomicFile:
+    #Text file written next to FilePath and renamed over it when closed,
+    #so nothing reading FilePath ever sees half an export
+    def __init__(self, FilePath):
+        self.FilePath = FilePath
+        Directory, Name = os.path.split(FilePath)
+        self.TempPath = os.path.join(Directory, ".{}.{}.tmp".format(Name, os.getpid()))
+        self.File = open(self.TempPath, "w")
+        self.write = self.File.write
+
+    def close(self):
+        self.File.close()
+        if os.name == "nt" and os.path.exists(self.FilePath):
+            os.remove(self.FilePath) #os.rename can't replace files on windows
+        os.rename(self.TempPath, self.FilePath)
+
+    def abort(self):
+        self.File.close()
+        try:
+            os.remove(self.TempPath)
+        except OSError:
+            pass
+
+
 def ExportDirectX(Config):
     print("----------\nExporting to {}".format(Config.FilePath))
     if Config.Verbose:
         print("Opening File...")
-    Config.File = open(Config.FilePath, "w")
+    # written to a temporary file and renamed over Config.FilePath in CloseFile
+    Config.File = AtomicFile(Config.FilePath)
     if Config.Verbose:
         print("Done")
 
+    try:
+        WriteFile(Config)
+    except:
+        Config.File.abort()
+        raise
+
+    CloseFile(Config)
+
+
+def WriteFile(Config):
     if Config.Verbose:
         print("Generating Object list for export...")
     if Config.ExportMode == 1:
@@ -167,8 +202,6 @@ def ExportDirectX(Config):
         bpy.context.scene.frame_current = CurrentFrame
         if Config.Verbose:
             print("Done")
-
-    CloseFile(Config)
     print("Finished")
 
 
@@ -36,12 +36,35 @@ bl_info = {
 
 if "bpy" in locals():
     import imp
-    if "export_fbx" in locals():
-        imp.reload(export_fbx)
+    # modules before the ones importing them, so those pick up the reloaded code
+    for module_name in ("sink",
+                        "encode_ascii",
+                        "encode_bin",
+                        "pose_cache",
+                        "anim_reduce",
+                        "anim_sample",
+                        "scene_index",
+                        "vertex_weights",
+                        "name_registry",
+                        "mesh_snapshot",
+                        "mesh_optimize",
+                        "mesh_instances",
+                        "bone_palette",
+                        "mesh_chunks",
+                        "static_batch",
+                        "export_cache",
+                        "texture_deploy",
+                        "export_fbx",
+                        "export_fbx_bin",
+                        "batch_export",
+                        ):
+        if module_name in locals():
+            imp.reload(locals()[module_name])
+    del module_name
 
 
 import bpy
-from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty
+from bpy.props import StringProperty, BoolProperty, FloatProperty, EnumProperty, IntProperty
 
 from bpy_extras.io_utils import (ExportHelper,
                                  path_reference_mode,
@@ -50,7 +73,7 @@ from bpy_extras.io_utils import (ExportHelper,
 
 
 class ExportFBX(bpy.types.Operator, ExportHelper):
-    '''Selection to an ASCII Autodesk FBX'''
+    '''Selection to an Autodesk FBX'''
     bl_idname = "export_scene.fbx"
     bl_label = "Export FBX"
     bl_options = {'PRESET'}
@@ -61,6 +84,13 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
     # List of operator properties, the attributes will be assigned
     # to the class instance from the operator settings before calling.
 
+    export_format = EnumProperty(
+            name="Format",
+            items=(('ASCII', "ASCII 6.1", "Text FBX 6.1, as read by XNA"),
+                   ('BINARY', "Binary 7.4", "Compressed binary FBX 7.4, smaller and faster to load"),
+                   ),
+            default='ASCII',
+            )
     use_selection = BoolProperty(
             name="Selected Objects",
             description="Export selected objects on visible layers",
@@ -129,6 +159,75 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
                          "pipeline errors with XNA"),
             default=False,
             )
+    use_mesh_optimize = BoolProperty(
+            name="Optimize Vertex Cache",
+            description=("Triangulate meshes and reorder their triangles and "
+                         "vertices for the GPU vertex cache"),
+            default=False,
+            )
+    use_mesh_instances = BoolProperty(
+            name="Share Meshes",
+            description=("Evaluate objects with the same mesh and modifiers "
+                         "(linked duplicates, duplis) once and share the geometry"),
+            default=False,
+            )
+    use_material_merge = BoolProperty(
+            name="Merge Materials",
+            description=("Write materials with the same colors, factors and shader "
+                         "(eg. copies like Metal.001) once"),
+            default=False,
+            )
+    use_static_batch = BoolProperty(
+            name="Static Batching",
+            description=("Merge meshes without parent, animation, constraints or armature "
+                         "into one mesh per material, with their transforms applied"),
+            default=False,
+            )
+    static_batch_cell_size = FloatProperty(
+            name="Batch Cell Size",
+            description=("Only merge static meshes in the same cell of a grid this size, "
+                         "so batches can still be culled, 0 merges all"),
+            min=0.0, max=100000.0,
+            soft_min=0.0, soft_max=1000.0,
+            default=0.0,
+            )
+    bone_palette_size = IntProperty(
+            name="Bone Palette",
+            description=("Split skinned meshes so each part is deformed by at most this many "
+                         "bones (72 for XNA's SkinnedEffect), 0 doesn't split"),
+            min=0, max=1024,
+            default=0,
+            )
+    use_bone_prune = BoolProperty(
+            name="Prune Bones",
+            description=("Leave out bones that deform no exported mesh and have no "
+                         "children that do (IK targets, poles, controls)"),
+            default=False,
+            )
+    use_bone_prune_keep_animated = BoolProperty(
+            name="Keep Animated Bones",
+            description="Don't prune bones the exported actions animate",
+            default=True,
+            )
+    mesh_vertex_limit = IntProperty(
+            name="Vertex Limit",
+            description=("Split meshes needing more vertices than this into spatially coherent "
+                         "chunks (65535 for XNA's Reach profile), 0 doesn't split"),
+            min=0, max=65535,
+            default=0,
+            )
+    use_color_quantize = BoolProperty(
+            name="Quantize Colors",
+            description=("Round vertex colors to 8 bits per channel, "
+                         "so nearly equal colors are written once"),
+            default=False,
+            )
+    use_export_cache = BoolProperty(
+            name="Use Cache",
+            description=("Keep written mesh, skin and take data next to the exported "
+                         "file and reuse it when unchanged (ASCII only)"),
+            default=False,
+            )
     use_anim = BoolProperty(
             name="Include Animation",
             description="Export keyframe animation",
@@ -147,6 +246,21 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
                          "start/end frames"),
             default=False
             )
+    use_anim_fcurve_sampling = BoolProperty(
+            name="Sample F-Curves",
+            description=("Read armature poses from the action F-Curves instead of "
+                         "updating the scene every frame. Rigs with constraints, "
+                         "drivers or NLA are always fully evaluated"),
+            default=False,
+            )
+    take_processes = IntProperty(
+            name="Take Processes",
+            description=("Write the takes with this many background Blender "
+                         "processes (from the saved blend file), 1 writes them here (ASCII only). "
+                         "Each process loads the file and collects the objects and meshes again"),
+            min=1, max=64,
+            default=1,
+            )
     use_anim_optimize = BoolProperty(
             name="Optimize Keyframes",
             description="Remove double keyframes",
@@ -160,7 +274,22 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
             soft_min=1, soft_max=16,
             default=6.0,
             )
+    use_anim_channel_prune = BoolProperty(
+            name="Only Animated Bones",
+            description=("Write curves in each take only for the bones its action animates "
+                         "(and their parents), the others keep their bind pose"),
+            default=False,
+            )
     path_mode = path_reference_mode
+    path_copy_method = EnumProperty(
+            name="Copy Method",
+            description="How images are put next to the exported file when the path mode is Copy",
+            items=(('COPY', "Copy", "Copy the images"),
+                   ('HARDLINK', "Hard Link", "Link the images, copying them when the file system can't"),
+                   ('REFLINK', "Reflink", "Clone the images copy on write (Btrfs, XFS), copying them when the file system can't"),
+                   ),
+            default='COPY',
+            )
     use_rotate_workaround = BoolProperty(
             name="Rotate Animation Fix",
             description="Disable global rotation, for XNA compatibility",
@@ -183,6 +312,13 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
             description="Create a dir for each exported file",
             default=True,
             )
+    batch_processes = IntProperty(
+            name="Processes",
+            description=("Export the batch with this many background Blender "
+                         "processes (from the saved blend file), 1 exports here"),
+            min=1, max=64,
+            default=1,
+            )
     use_metadata = BoolProperty(
             name="Use Metadata",
             default=True,
@@ -218,6 +354,9 @@ class ExportFBX(bpy.types.Operator, ExportHelper):
         if self.path_mode != 'STRIP':
             changed = True
             self.path_mode = 'STRIP'
+        if self.export_format != 'ASCII':
+            changed = True
+            self.export_format = 'ASCII'
         return changed
 
     @property
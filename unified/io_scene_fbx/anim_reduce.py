@@ -0,0 +1,74 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Keyframe reduction for sampled animation channels.
+
+Keys are written with linear interpolation, so a key can be removed when the
+line between the keys kept either side of it passes within the given
+precision of its value. reduce_keys does this greedily in a single pass.
+"""
+
+
+def reduce_keys(values, precision, times=None):
+    '''
+    Return the indices of the keys to keep (always including the first and last).
+
+    Each segment is extended from its first key for as long as one line fits
+    every key inside it, tracked as the range of slopes that stay within
+    precision of all keys seen so far, so every value is visited once.
+    times defaults to the key index.
+    '''
+    tot = len(values)
+    if tot <= 2:
+        return list(range(tot))
+
+    if times is None:
+        times = range(tot)
+
+    kept = [0]
+
+    t_a = times[0]
+    v_a = values[0]
+    slope_min = float("-inf")
+    slope_max = float("inf")
+
+    for b in range(2, tot):
+        # the key before b is now inside the segment, limit the slopes to ones that pass near it.
+        dt = times[b - 1] - t_a
+        dv = values[b - 1] - v_a
+        slope_min = max(slope_min, (dv - precision) / dt)
+        slope_max = min(slope_max, (dv + precision) / dt)
+
+        slope = (values[b] - v_a) / (times[b] - t_a)
+        if slope_min <= slope <= slope_max:
+            continue
+
+        # b can't be reached, end the segment at the key before it.
+        a = b - 1
+        kept.append(a)
+        t_a = times[a]
+        v_a = values[a]
+        slope_min = float("-inf")
+        slope_max = float("inf")
+
+    kept.append(tot - 1)
+    return kept
+
@@ -0,0 +1,381 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Sampling armature poses straight from the action F-Curves.
+
+Setting the scene frame updates everything in the scene (modifiers, particles...)
+when all the exporter needs is the pose matrices. Rigs that are driven only by
+their action can have their pose worked out from the bone rest matrices and
+the evaluated F-Curves instead. Anything else (constraints, drivers, NLA...)
+is reported so the caller can fall back to scene.frame_set().
+
+action_key and armature_pose_key list the same inputs for hashing,
+so takes written from them can be cached.
+"""
+
+from mathutils import Matrix, Vector, Quaternion, Euler
+
+# F-Curve paths that animate the object transform
+OBJECT_TRANSFORM_PATHS = {"location",
+                          "rotation_euler",
+                          "rotation_quaternion",
+                          "rotation_axis_angle",
+                          "scale",
+                          "delta_location",
+                          "delta_rotation_euler",
+                          "delta_rotation_quaternion",
+                          "delta_scale",
+                          }
+
+# pose bone channel: number of values
+POSE_CHANNELS = {"location": 3,
+                 "rotation_quaternion": 4,
+                 "rotation_euler": 3,
+                 "rotation_axis_angle": 4,
+                 "scale": 3,
+                 }
+
+_MAT_SCALE_AXES = (Vector((1.0, 0.0, 0.0)),
+                   Vector((0.0, 1.0, 0.0)),
+                   Vector((0.0, 0.0, 1.0)),
+                   )
+
+
+def _anim_data_unsupported(anim_data):
+    '''
+    Return a reason the animation data needs a scene update, or None.
+    '''
+    if anim_data is None:
+        return None
+    if len(anim_data.drivers):
+        return "drivers"
+    if len(anim_data.nla_tracks):
+        return "NLA tracks"
+    if getattr(anim_data, "action_influence", 1.0) != 1.0:
+        return "action influence"
+    return None
+
+
+def object_transform_unsupported(ob):
+    '''
+    Return a reason the world matrix of ob can change while playing back, or None.
+    '''
+    while ob:
+        if len(ob.constraints):
+            return "constraints on %r" % ob.name
+
+        anim_data = ob.animation_data
+        reason = _anim_data_unsupported(anim_data)
+        if reason:
+            return "%s on %r" % (reason, ob.name)
+
+        if anim_data and anim_data.action:
+            for fcu in anim_data.action.fcurves:
+                if fcu.data_path in OBJECT_TRANSFORM_PATHS:
+                    return "animated transform on %r" % ob.name
+
+        if ob.parent and ob.parent_type not in {'OBJECT', 'ARMATURE'}:
+            return "%r has a %s parent" % (ob.name, ob.parent_type.lower())
+
+        ob = ob.parent
+
+    return None
+
+
+def _pose_fcurve_key(data_path):
+    '''
+    Split 'pose.bones["Name"].location' into ("Name", "location"), None for other paths.
+    '''
+    if not data_path.startswith('pose.bones["'):
+        return None
+    i = data_path.find('"].', 12)
+    if i == -1:
+        return None
+    return data_path[12:i], data_path[i + 3:]
+
+
+def action_bone_names(action):
+    '''
+    Return the names of the pose bones the action has F-Curves for.
+    '''
+    names = set()
+    for fcu in action.fcurves:
+        key = _pose_fcurve_key(fcu.data_path)
+        if key is not None:
+            names.add(key[0])
+    return names
+
+
+def action_pose_channels(action):
+    '''
+    Return the (bone name, channel, array index) of the pose values the action has F-Curves for.
+    '''
+    channels = set()
+    if action is not None:
+        for fcu in action.fcurves:
+            key = _pose_fcurve_key(fcu.data_path)
+            if key is not None and key[1] in POSE_CHANNELS:
+                channels.add(key + (fcu.array_index,))
+    return channels
+
+
+class _BoneSample(object):
+    __slots__ = ("name",
+                 "parent",  # index of the parent in ArmatureSampler.bones or -1
+                 "offset",  # rest matrix relative to the parent
+                 "use_connect",
+                 "rotation_mode",
+                 "values",  # {channel: [value, ...]}, the pose values when not animated
+                 "fcurves",  # [(channel, array_index, fcurve), ...]
+                 )
+
+
+class ArmatureSampler(object):
+    '''
+    Evaluates the pose of an armature object in armature space for any frame.
+    '''
+    __slots__ = ("bones",
+                 )
+
+    def __init__(self, arm_ob, action):
+        pose_bones = arm_ob.pose.bones[:]
+
+        def bone_depth(pose_bone):
+            depth = 0
+            bone = pose_bone.bone.parent
+            while bone:
+                depth += 1
+                bone = bone.parent
+            return depth
+
+        # parents before children
+        pose_bones.sort(key=bone_depth)
+
+        fcurves = {}  # (bone_name, channel): [(array_index, fcurve), ...]
+        if action:
+            for fcu in action.fcurves:
+                if fcu.mute:
+                    continue
+                key = _pose_fcurve_key(fcu.data_path)
+                if key and key[1] in POSE_CHANNELS:
+                    fcurves.setdefault(key, []).append((fcu.array_index, fcu))
+
+        bone_index = {}
+        self.bones = []
+        for pose_bone in pose_bones:
+            bone = pose_bone.bone
+            b = _BoneSample()
+            b.name = pose_bone.name
+            if bone.parent:
+                b.parent = bone_index[bone.parent.name]
+                b.offset = bone.parent.matrix_local.inverted() * bone.matrix_local
+            else:
+                b.parent = -1
+                b.offset = bone.matrix_local.copy()
+            b.use_connect = bone.use_connect
+            b.rotation_mode = pose_bone.rotation_mode
+            b.values = {}
+            b.fcurves = []
+            for channel in POSE_CHANNELS:
+                b.values[channel] = list(getattr(pose_bone, channel))
+                for array_index, fcu in fcurves.get((b.name, channel), ()):
+                    b.fcurves.append((channel, array_index, fcu))
+
+            bone_index[b.name] = len(self.bones)
+            self.bones.append(b)
+
+    def evaluate(self, frame):
+        '''
+        Return {bone_name: matrix} the same as pose_bone.matrix once the frame is set.
+        '''
+        pose_mats = []
+        ret = {}
+        for b in self.bones:
+            values = b.values
+            if b.fcurves:
+                values = dict((channel, value[:]) for channel, value in values.items())
+                for channel, array_index, fcu in b.fcurves:
+                    values[channel][array_index] = fcu.evaluate(frame)
+
+            mat = _channel_matrix(b, values)
+
+            if b.parent != -1:
+                mat = pose_mats[b.parent] * b.offset * mat
+            else:
+                mat = b.offset * mat
+
+            pose_mats.append(mat)
+            ret[b.name] = mat
+
+        return ret
+
+
+def _channel_matrix(b, values):
+    rotation_mode = b.rotation_mode
+    if rotation_mode == 'QUATERNION':
+        mat = Quaternion(values["rotation_quaternion"]).normalized().to_matrix().to_4x4()
+    elif rotation_mode == 'AXIS_ANGLE':
+        angle, x, y, z = values["rotation_axis_angle"]
+        axis = Vector((x, y, z))
+        if axis.length:
+            mat = Matrix.Rotation(angle, 4, axis.normalized())
+        else:
+            mat = Matrix()
+    else:
+        mat = Euler(values["rotation_euler"], rotation_mode).to_matrix().to_4x4()
+
+    scale = values["scale"]
+    for i in range(3):
+        if scale[i] != 1.0:
+            mat = mat * Matrix.Scale(scale[i], 4, _MAT_SCALE_AXES[i])
+
+    # connected bones can't move away from their parent
+    if not b.use_connect:
+        mat = Matrix.Translation(Vector(values["location"])) * mat
+
+    return mat
+
+
+def _rna_key(data):
+    '''
+    Every property of data as a list of (identifier, value) pairs, for hashing.
+    '''
+    values = []
+    for prop in data.bl_rna.properties:
+        identifier = prop.identifier
+        if identifier == "rna_type":
+            continue
+        value = getattr(data, identifier)
+        if prop.type == 'COLLECTION':
+            value = [_rna_key(item) for item in value]
+        elif prop.type == 'POINTER':
+            value = getattr(value, "name", None)
+        elif getattr(prop, "array_length", 0):
+            value = tuple(value)
+        values.append((identifier, value))
+    return values
+
+
+def action_key(action):
+    '''
+    Return a list of values that only match for actions with the same curves,
+    keyframes, handles, interpolation and modifiers.
+    '''
+    if action is None:
+        return [None]
+
+    key = [action.name]
+    for fcu in action.fcurves:
+        points = fcu.keyframe_points
+        tot = len(points) * 2
+        co = [0.0] * tot
+        handle_left = [0.0] * tot
+        handle_right = [0.0] * tot
+        points.foreach_get("co", co)
+        points.foreach_get("handle_left", handle_left)
+        points.foreach_get("handle_right", handle_right)
+
+        key += [fcu.data_path, fcu.array_index, fcu.mute, fcu.extrapolation,
+                co, handle_left, handle_right,
+                [point.interpolation for point in points],
+                [_rna_key(fmod) for fmod in fcu.modifiers],
+                ]
+    return key
+
+
+def pose_bone_at_rest(pose_bone):
+    '''
+    Return True when the pose values of pose_bone leave it in its rest pose.
+    '''
+    if tuple(pose_bone.location) != (0.0, 0.0, 0.0) or tuple(pose_bone.scale) != (1.0, 1.0, 1.0):
+        return False
+
+    rotation_mode = pose_bone.rotation_mode
+    if rotation_mode == 'QUATERNION':
+        return tuple(pose_bone.rotation_quaternion) == (1.0, 0.0, 0.0, 0.0)
+    elif rotation_mode == 'AXIS_ANGLE':
+        return pose_bone.rotation_axis_angle[0] == 0.0
+    else:
+        return tuple(pose_bone.rotation_euler) == (0.0, 0.0, 0.0)
+
+
+def armature_pose_key(arm_ob, animated=()):
+    '''
+    Return a list of values that only match for armatures with the same rest pose and pose values,
+    leaving out the values in animated, (bone name, channel, array index) the action sets.
+    '''
+    key = []
+    for pose_bone in arm_ob.pose.bones:
+        bone = pose_bone.bone
+        key += [pose_bone.name, pose_bone.rotation_mode,
+                bone.parent.name if bone.parent else None, bone.use_connect,
+                [f for v in bone.matrix_local for f in v],
+                ]
+        for channel in sorted(POSE_CHANNELS):
+            key.append(tuple(None if (pose_bone.name, channel, i) in animated else value
+                             for i, value in enumerate(getattr(pose_bone, channel))))
+    return key
+
+
+def armature_pose_values(arm_ob):
+    '''
+    Return the pose values of arm_ob, [(bone name, channel, values), ...] for armature_pose_set.
+    '''
+    return [(pose_bone.name, channel, tuple(getattr(pose_bone, channel)))
+            for pose_bone in arm_ob.pose.bones for channel in sorted(POSE_CHANNELS)]
+
+
+def armature_pose_set(arm_ob, pose_values):
+    '''
+    Set the pose values from armature_pose_values, of the bones arm_ob still has.
+    '''
+    pose_bones = arm_ob.pose.bones
+    for name, channel, values in pose_values:
+        pose_bone = pose_bones.get(name)
+        if pose_bone is not None:
+            setattr(pose_bone, channel, values)
+
+
+def armature_unsupported(arm_ob):
+    '''
+    Return a reason the pose of arm_ob can't be sampled from its action alone, or None.
+    '''
+    reason = _anim_data_unsupported(arm_ob.animation_data)
+    if reason:
+        return "%s on %r" % (reason, arm_ob.name)
+
+    arm = arm_ob.data
+    if arm.pose_position != 'POSE':
+        return "armature %r is in rest position" % arm.name
+
+    reason = _anim_data_unsupported(arm.animation_data)
+    if reason:
+        return "%s on armature %r" % (reason, arm.name)
+
+    for pose_bone in arm_ob.pose.bones:
+        if len(pose_bone.constraints):
+            return "constraints on bone %r" % pose_bone.name
+
+        bone = pose_bone.bone
+        if not (bone.use_inherit_rotation and bone.use_inherit_scale and bone.use_local_location):
+            return "inherit options on bone %r" % pose_bone.name
+
+    return None
@@ -0,0 +1,420 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Exporting with background Blender processes.
+
+The work is written to a JSON manifest, split into one shard for each
+process, and every process ("blender -b file.blend --python batch_export.py
+-- manifest shard") does its shard and writes the results for the caller
+to collect. Two kinds of work are shared out this way:
+
+- 'BATCH', the scenes or groups of a batch export, one file each.
+- 'TAKES', the takes of a single export, each process writes the Take
+  blocks of its actions as text for the caller to put in the file.
+
+Workers load the saved .blend, unsaved changes are not exported.
+"""
+
+import os
+import sys
+import json
+import time
+
+MANIFEST_NAME = "manifest.json"
+
+
+# ----------------------------------------------------------------------------
+# Manifest, export options as JSON
+
+def _encode_value(value):
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(value)}
+    if hasattr(value, "col_size"):  # mathutils.Matrix
+        return {"__matrix__": [list(row) for row in value]}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if "__set__" in value:
+            return set(value["__set__"])
+        if "__matrix__" in value:
+            from mathutils import Matrix
+            return Matrix(value["__matrix__"])
+    return value
+
+
+def encode_kwargs(kwargs):
+    return dict((key, _encode_value(value)) for key, value in kwargs.items())
+
+
+def decode_kwargs(kwargs):
+    return dict((key, _decode_value(value)) for key, value in kwargs.items())
+
+
+def shard_jobs(jobs, processes):
+    '''
+    Split [(job, cost), ...] into shards of about the same cost,
+    the most costly first, each to the shard with the least so far.
+    '''
+    shards = [[] for i in range(processes)]
+    shard_costs = [0] * processes
+    for job, cost in sorted(jobs, key=lambda job: -job[1]):
+        i = shard_costs.index(min(shard_costs))
+        shards[i].append(job)
+        shard_costs[i] += cost
+    return [shard for shard in shards if shard]
+
+
+def write_manifest(dirpath, kind, shards, **kwargs):
+    '''
+    Write the manifest for the workers, kwargs are stored with it as is.
+    '''
+    import bpy
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    manifest = {"kind": kind,
+                "blend": bpy.data.filepath,
+                "module_path": os.path.dirname(package_dir),
+                "package": os.path.basename(package_dir),
+                "shards": shards,
+                }
+    manifest.update(kwargs)
+
+    filepath = os.path.join(dirpath, MANIFEST_NAME)
+    with open(filepath, "w") as f:
+        json.dump(manifest, f, indent=1)
+    return filepath
+
+
+def _result_path(dirpath, shard_index):
+    return os.path.join(dirpath, "result_%d.json" % shard_index)
+
+
+def _log_path(dirpath, shard_index):
+    return os.path.join(dirpath, "log_%d.txt" % shard_index)
+
+
+# ----------------------------------------------------------------------------
+# Caller
+
+def workers_unsupported():
+    '''
+    Return why the work can't be given to background processes, or None.
+    '''
+    import bpy
+
+    if not bpy.data.filepath:
+        return "the blend file is not saved, background processes load it from disk"
+    if not hasattr(bpy.data, "is_dirty"):
+        return "this blender can't tell if the blend file has unsaved changes"
+    if bpy.data.is_dirty:
+        return "the blend file has unsaved changes"
+    return None
+
+
+def start_workers(dirpath, manifest_path, shard_count):
+    '''
+    Start a background Blender for each shard, return [(process, log), ...] for wait_workers.
+    '''
+    import bpy
+    import subprocess
+
+    procs = []
+    for shard_index in range(shard_count):
+        log = open(_log_path(dirpath, shard_index), "w")
+        proc = subprocess.Popen([bpy.app.binary_path, "-b", bpy.data.filepath,
+                                 "--python", os.path.abspath(__file__),
+                                 "--", manifest_path, str(shard_index)],
+                                stdout=log, stderr=subprocess.STDOUT)
+        procs.append((proc, log))
+
+    return procs
+
+
+def wait_workers(dirpath, procs):
+    '''
+    Wait for the processes, return the results of each shard, None for shards that failed.
+    '''
+    results = []
+    for shard_index, (proc, log) in enumerate(procs):
+        proc.wait()
+        log.close()
+        try:
+            with open(_result_path(dirpath, shard_index)) as f:
+                results.append(json.load(f))
+        except (IOError, OSError, ValueError):
+            print("\tprocess %d failed, see %r" % (shard_index, _log_path(dirpath, shard_index)))
+            results.append(None)
+
+    return results
+
+
+def save_parallel(operator, batch_mode, jobs, processes, kwargs):
+    '''
+    Export jobs [(data, filepath), ...] with up to processes background Blender instances.
+    '''
+    import shutil
+    import tempfile
+
+    reason = workers_unsupported()
+    if reason and not reason.endswith("unsaved changes"):
+        operator.report({'ERROR'}, "Can't batch export in the background, %s" % reason)
+        return {'CANCELLED'}
+    elif reason:
+        operator.report({'WARNING'}, "Unsaved changes are not exported by the batch export processes")
+
+    time_start = time.time()
+
+    # objects are a rough guide to how long each file takes
+    shards = shard_jobs([((data.name, filepath), len(data.objects)) for data, filepath in jobs], processes)
+
+    dirpath = tempfile.mkdtemp(prefix="fbx_batch_")
+    manifest_path = write_manifest(dirpath, 'BATCH', shards,
+                                   batch_mode=batch_mode,
+                                   kwargs=encode_kwargs(kwargs))
+
+    print("\nBatch exporting %d files with %d processes, %r" % (len(jobs), len(shards), manifest_path))
+
+    results = []
+    failed_shards = []
+    procs = start_workers(dirpath, manifest_path, len(shards))
+    for shard_index, shard_results in enumerate(wait_workers(dirpath, procs)):
+        if shard_results is None:
+            failed_shards.append(shard_index)
+        else:
+            results.extend(shard_results)
+
+    # files the crashed processes never reported on
+    done = set(result["name"] for result in results)
+    for shard_index in failed_shards:
+        for name, filepath in shards[shard_index]:
+            if name not in done:
+                results.append({"name": name,
+                                "filepath": filepath,
+                                "status": 'ERROR',
+                                "time": 0.0,
+                                "error": "process exited, see %r" % _log_path(dirpath, shard_index),
+                                })
+
+    print_results(results, time.time() - time_start)
+
+    errors = [result for result in results if result["status"] != 'FINISHED']
+    if errors:
+        operator.report({'ERROR'}, "Batch export failed for %d of %d files, logs in %r" % (len(errors), len(results), dirpath))
+    else:
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    return {'FINISHED'}
+
+
+def print_results(results, time_total):
+    print("\nBatch export results:")
+    for result in sorted(results, key=lambda result: result["name"]):
+        print("\t%-10s %8.2f sec  %r" % (result["status"], result["time"], result["filepath"]))
+        if result.get("error"):
+            print("\t\t%s" % result["error"])
+
+    time_files = sum(result["time"] for result in results)
+    print("\t%d files, %.2f sec (%.2f sec exporting)" % (len(results), time_total, time_files))
+
+
+class TakeWorkers(object):
+    '''
+    Passed to save_single to write the takes with background processes,
+    started before the rest of the file is written and collected for the takes section.
+    '''
+    __slots__ = ("processes",
+                 "scene_name",
+                 "object_names",
+                 "filepath",
+                 "kwargs",
+                 "_dirpath",
+                 "_procs",
+                 "_take_count",
+                 "_time_start",
+                 )
+
+    def __init__(self, processes, scene, context_objects, filepath, kwargs):
+        self.processes = processes
+        self.scene_name = scene.name
+        self.object_names = [ob.name for ob in context_objects]
+        self.filepath = filepath
+        self.kwargs = kwargs
+        self._dirpath = None
+        self._procs = []
+        self._take_count = 0
+        self._time_start = 0.0
+
+    def start(self, take_jobs):
+        '''
+        Start writing the takes for take_jobs [(action_name, frame_count), ...], in take order.
+        '''
+        import tempfile
+
+        reason = workers_unsupported()
+        if reason:
+            print("\ttakes not written in the background, %s" % reason)
+            return
+
+        self._time_start = time.time()
+        self._take_count = len(take_jobs)
+
+        shards = shard_jobs([(i, frame_count) for i, (action_name, frame_count) in enumerate(take_jobs)],
+                            self.processes)
+
+        self._dirpath = tempfile.mkdtemp(prefix="fbx_takes_")
+        manifest_path = write_manifest(self._dirpath, 'TAKES', shards,
+                                       scene=self.scene_name,
+                                       objects=self.object_names,
+                                       filepath=self.filepath,
+                                       actions=[action_name for action_name, frame_count in take_jobs],
+                                       kwargs=encode_kwargs(self.kwargs))
+
+        print("\twriting %d takes with %d processes, %r" % (len(take_jobs), len(shards), manifest_path))
+
+        self._procs = start_workers(self._dirpath, manifest_path, len(shards))
+
+    def collect(self):
+        '''
+        Wait for the processes, return {take_index: text},
+        takes they failed to write are left out for the caller to write.
+        '''
+        import shutil
+
+        if not self._procs:
+            return {}
+
+        fragments = {}
+        failed = False
+        for shard_results in wait_workers(self._dirpath, self._procs):
+            if shard_results is None:
+                failed = True
+            else:
+                for i, text in shard_results["fragments"].items():
+                    fragments[int(i)] = text
+
+        self._procs = []
+        if not failed:
+            shutil.rmtree(self._dirpath, ignore_errors=True)
+
+        print("\t%d of %d takes written in the background in %.2f sec" %
+              (len(fragments), self._take_count, time.time() - self._time_start))
+        return fragments
+
+
+class TakeShard(object):
+    '''
+    Passed to save_single in a worker, the takes to write and the text written for them.
+    '''
+    __slots__ = ("action_names",
+                 "indices",
+                 "fragments",
+                 )
+
+    def __init__(self, action_names, indices):
+        self.action_names = action_names  # all takes, to check the worker found the same ones
+        self.indices = set(indices)
+        self.fragments = {}
+
+
+# ----------------------------------------------------------------------------
+# Worker, running in a background Blender
+
+class WorkerReport(object):
+    '''
+    Stands in for the operator, save_single only uses it for reports.
+    '''
+    __slots__ = ()
+
+    def report(self, type, message):
+        print("%s: %s" % ("/".join(sorted(type)), message))
+
+
+def worker_main(argv):
+    import importlib
+
+    manifest_path, shard_index = argv[0], int(argv[1])
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    sys.path.insert(0, manifest["module_path"])
+    export_fbx = importlib.import_module(manifest["package"] + ".export_fbx")
+
+    kwargs = decode_kwargs(manifest["kwargs"])
+    shard = manifest["shards"][shard_index]
+
+    if manifest["kind"] == 'TAKES':
+        results = worker_takes(export_fbx, manifest, shard, kwargs)
+    else:
+        results = worker_batch(export_fbx, manifest, shard, kwargs)
+
+    with open(_result_path(os.path.dirname(manifest_path), shard_index), "w") as f:
+        json.dump(results, f, indent=1)
+
+
+def worker_takes(export_fbx, manifest, shard, kwargs):
+    import bpy
+
+    scene = bpy.data.scenes[manifest["scene"]]
+    context_objects = [bpy.data.objects[name] for name in manifest["objects"]]
+
+    take_shard = TakeShard(manifest["actions"], shard)
+    export_fbx.save_single(WorkerReport(), scene, manifest["filepath"],
+                           context_objects=context_objects,
+                           take_shard=take_shard,
+                           **kwargs)
+
+    return {"fragments": dict((str(i), text) for i, text in take_shard.fragments.items())}
+
+
+def worker_batch(export_fbx, manifest, shard, kwargs):
+    import bpy
+    import traceback
+
+    batch_mode = manifest["batch_mode"]
+    if batch_mode == 'GROUP':
+        data_seq = bpy.data.groups
+    else:
+        data_seq = bpy.data.scenes
+
+    operator = WorkerReport()
+    results = []
+    for name, filepath in shard:
+        result = {"name": name, "filepath": filepath, "error": None}
+        time_start = time.time()
+        try:
+            status = export_fbx.save_batch_data(operator, batch_mode, data_seq[name], filepath, **kwargs)
+            result["status"] = list(status)[0]
+        except:
+            traceback.print_exc()
+            result["status"] = 'ERROR'
+            result["error"] = traceback.format_exc().splitlines()[-1]
+        result["time"] = time.time() - time_start
+        results.append(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    # arguments after "--" are ours
+    worker_main(sys.argv[sys.argv.index("--") + 1:])
@@ -0,0 +1,142 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Bone palette partitioning of skinned meshes.
+
+XNA's SkinnedEffect takes at most 72 bone matrices per draw, so meshes
+deformed by more bones are split into parts, each with its own palette.
+Faces are split by material first, then added to a part greedily: faces
+whose bones are all in the palette already cost nothing, otherwise the
+face adding the fewest bones is taken, preferring faces touching the part
+so fewer vertices end up in more than one part.
+"""
+
+from .encode_ascii import tolist
+
+# faces looked at for one touching the part, before taking any with the fewest new bones
+_TOUCH_SEARCH = 64
+
+
+def snapshot_vertex_bones(snapshot, weights, group_bones):
+    '''
+    Return the set of bones deforming each snapshot vertex,
+    group_bones is the bone (or None) of each vertex group in weights.
+    '''
+    vertex_bones = [frozenset()] * snapshot.vert_count
+    vertex_remap = snapshot.vertex_remap
+    for i in range(len(weights)):
+        groups = weights.vertex(i)[0]
+        bones = frozenset(group_bones[g] for g in groups if group_bones[g] is not None)
+        if vertex_remap is not None:
+            i = vertex_remap[i]
+            if i == -1:
+                continue
+        vertex_bones[i] = bones
+    return vertex_bones
+
+
+def partition_faces(faces, face_bones, face_vertices, palette_size):
+    '''
+    Split faces into parts deformed by at most palette_size bones,
+    return [(faces, bones), ...] with the faces of each part in their original order.
+    A face with more bones than palette_size gets a part of its own.
+    '''
+    remaining = set(faces)
+    parts = []
+
+    while remaining:
+        part_faces = []
+        part_bones = set()
+        part_vertices = set()
+
+        # faces grouped by the number of bones they would add to the palette
+        missing = {}
+        buckets = []
+        bone_faces = {}
+        for f in remaining:
+            count = len(face_bones[f])
+            missing[f] = count
+            while len(buckets) <= count:
+                buckets.append(set())
+            buckets[count].add(f)
+            for bone in face_bones[f]:
+                bone_faces.setdefault(bone, []).append(f)
+
+        while True:
+            count = 0
+            while count < len(buckets) and not buckets[count]:
+                count += 1
+            if count == len(buckets):
+                break  # all faces taken
+            if part_faces and len(part_bones) + count > palette_size:
+                break  # palette full
+
+            bucket = buckets[count]
+            f = None
+            if count and part_vertices:
+                for i, f_test in enumerate(bucket):
+                    if i == _TOUCH_SEARCH:
+                        break
+                    if not part_vertices.isdisjoint(face_vertices[f_test]):
+                        f = f_test
+                        break
+            if f is None:
+                f = next(iter(bucket))
+            bucket.discard(f)
+
+            remaining.discard(f)
+            part_faces.append(f)
+            part_vertices.update(face_vertices[f])
+
+            for bone in face_bones[f]:
+                if bone in part_bones:
+                    continue
+                part_bones.add(bone)
+                for f_other in bone_faces[bone]:
+                    if f_other in remaining:
+                        count_other = missing[f_other]
+                        buckets[count_other].discard(f_other)
+                        buckets[count_other - 1].add(f_other)
+                        missing[f_other] = count_other - 1
+
+        part_faces.sort()
+        parts.append((part_faces, part_bones))
+
+    return parts
+
+
+def partition_mesh(snapshot, weights, group_bones, palette_size):
+    '''
+    Split the faces of a snapshot by material and bone palette,
+    return [(faces, bones), ...], bones as in group_bones.
+    '''
+    vertex_bones = snapshot_vertex_bones(snapshot, weights, group_bones)
+    face_vertices = snapshot.face_vertices()
+    face_bones = [frozenset().union(*[vertex_bones[v] for v in verts]) for verts in face_vertices]
+
+    material_faces = {}
+    for f, mat_index in enumerate(tolist(snapshot.face_materials)):
+        material_faces.setdefault(mat_index, []).append(f)
+
+    parts = []
+    for mat_index in sorted(material_faces):
+        parts += partition_faces(material_faces[mat_index], face_bones, face_vertices, palette_size)
+    return parts
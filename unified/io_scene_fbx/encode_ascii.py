@@ -0,0 +1,216 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Bulk writing of ASCII FBX arrays.
+
+Mesh and deformer arrays are gathered with foreach_get and written a line at a
+time with one format operation per line, instead of one write per value.
+NumPy is used to gather and reshape the arrays when it is available,
+otherwise plain lists are used, the output is the same either way.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# flush the output after this many lines, keeps memory use bounded for large meshes.
+LINES_PER_WRITE = 256
+
+
+# ----------------------------------------------------------------------------
+# Array gathering
+
+def tolist(values):
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.tolist()
+    return values if isinstance(values, list) else list(values)
+
+
+def foreach_get(seq, attr, size, is_int=False):
+    '''
+    Return attr of every item in seq as a flat array, size is the number of values per item.
+    '''
+    tot = len(seq) * size
+    if numpy is not None:
+        values = numpy.empty(tot, dtype=numpy.int32 if is_int else numpy.float32)
+    else:
+        values = [0 if is_int else 0.0] * tot
+    seq.foreach_get(attr, values)
+    return values
+
+
+def faces_is_quad(faces_vertices_raw):
+    '''
+    Quad flag for each face from the faces "vertices_raw" array,
+    the 4th index of a triangle is always zero.
+    '''
+    if numpy is not None:
+        return numpy.asarray(faces_vertices_raw).reshape(-1, 4)[:, 3] != 0
+    return [v != 0 for v in faces_vertices_raw[3::4]]
+
+
+def interleave(arrays, size):
+    '''
+    Interleave arrays with size values per item,
+    used for per-corner face data stored in separate attributes (color1, color2...).
+    '''
+    if numpy is not None:
+        return numpy.stack([numpy.asarray(a).reshape(-1, size) for a in arrays], axis=1).reshape(-1)
+
+    items = [zip(*[iter(a)] * size) for a in arrays]
+    return [v for item in zip(*items) for value in item for v in value]
+
+
+def faces_corners(values, is_quad, size):
+    '''
+    Per face-corner values (4 corners of size values for each face)
+    with the unused 4th corner of triangles removed.
+    '''
+    if numpy is not None:
+        corners = numpy.asarray(values).reshape(-1, 4, size)
+        mask = numpy.ones((len(is_quad), 4), dtype=bool)
+        mask[:, 3] = is_quad
+        return corners[mask].reshape(-1)
+
+    corners = []
+    stride = size * 4
+    for i, quad in enumerate(is_quad):
+        ofs = i * stride
+        corners.extend(values[ofs:ofs + (stride if quad else stride - size)])
+    return corners
+
+
+def faces_vertex_index(faces_vertices_raw, is_quad):
+    '''
+    Return (indices, sizes), the flat face vertex indices
+    with the last index of each face XORd w. -1, and the size of each face.
+    '''
+    if numpy is not None:
+        sizes = numpy.where(is_quad, 4, 3)
+        indices = numpy.array(faces_vertices_raw, dtype=numpy.int32).reshape(-1, 4)
+        indices[numpy.arange(len(sizes)), sizes - 1] ^= -1
+        return faces_corners(indices, is_quad, 1), sizes.tolist()
+
+    indices = []
+    sizes = []
+    for i, quad in enumerate(is_quad):
+        size = 4 if quad else 3
+        fi = faces_vertices_raw[i * 4:i * 4 + size]
+        fi[-1] ^= -1
+        indices.extend(fi)
+        sizes.append(size)
+    return indices, sizes
+
+
+def dedupe_values(values, size):
+    '''
+    Return (unique, indices), the distinct groups of size values in the order
+    they are first used (flat) and the index of each group in them, as lists.
+    '''
+    if numpy is not None:
+        items = numpy.asarray(values).reshape(-1, size)
+        if not len(items):
+            return [], []
+        unique, first, inverse = numpy.unique(items, axis=0, return_index=True, return_inverse=True)
+        # numpy sorts the groups, put them back in the order they are used
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        return unique[order].reshape(-1).tolist(), rank[inverse.reshape(-1)].tolist()
+
+    values = tolist(values)
+    unique = []
+    indices = []
+    index_of = {}
+    for i in range(0, len(values), size):
+        item = tuple(values[i:i + size])
+        index = index_of.get(item)
+        if index is None:
+            index = index_of[item] = len(index_of)
+            unique.extend(item)
+        indices.append(index)
+    return unique, indices
+
+
+def quantize_values(values, steps=255):
+    '''
+    Round values in [0, 1] to steps (8 bits by default), so nearly equal colors are shared.
+    '''
+    if numpy is not None:
+        return numpy.clip(numpy.round(numpy.asarray(values, dtype=numpy.float64) * steps), 0, steps) / steps
+    return [min(max(round(v * steps), 0), steps) / steps for v in values]
+
+
+# ----------------------------------------------------------------------------
+# Writing
+
+def write_array(fw, values, fmt, per_line, line_sep, group_size=1, group_sizes=None, group_suffix=""):
+    '''
+    Write values as comma separated groups, per_line groups to a line.
+    Lines after the first start with line_sep and a comma.
+
+    fmt is the format of a single value, each group is group_size values
+    (or the sizes in group_sizes when they vary) followed by group_suffix.
+    '''
+    values = tolist(values)
+    if not values:
+        return
+
+    if group_sizes is None:
+        tot = len(values) // group_size
+    else:
+        tot = len(group_sizes)
+
+    group_fmt_cache = {}
+    line_fmt_cache = {}
+
+    def line_fmt(sizes):
+        ret = line_fmt_cache.get(sizes)
+        if ret is None:
+            groups = []
+            for size in sizes:
+                group_fmt = group_fmt_cache.get(size)
+                if group_fmt is None:
+                    group_fmt = group_fmt_cache[size] = ",".join((fmt,) * size) + group_suffix
+                groups.append(group_fmt)
+            ret = line_fmt_cache[sizes] = ",".join(groups)
+        return ret
+
+    line_prefix = line_sep + ","
+    lines = []
+    ofs = 0
+    for g in range(0, tot, per_line):
+        if group_sizes is None:
+            sizes = (group_size,) * min(per_line, tot - g)
+        else:
+            sizes = tuple(group_sizes[g:g + per_line])
+        ofs_next = ofs + sum(sizes)
+        line = line_fmt(sizes) % tuple(values[ofs:ofs_next])
+        ofs = ofs_next
+
+        lines.append(line_prefix + line if g else line)
+        if len(lines) == LINES_PER_WRITE:
+            fw("".join(lines))
+            lines[:] = []
+
+    if lines:
+        fw("".join(lines))
@@ -0,0 +1,261 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Low level encoding of binary FBX 7.x files.
+
+An FBX file is a tree of FBXElem nodes, each node has an id (its name),
+a list of typed properties and a list of child nodes.
+Array properties are written in bulk and zlib compressed when large.
+"""
+
+import sys
+import zlib
+from struct import pack
+from array import array
+
+_IS_BIG_ENDIAN = (sys.byteorder != 'little')
+
+_BLOCK_SENTINEL_LENGTH = 13
+_BLOCK_SENTINEL_DATA = (b'\0' * _BLOCK_SENTINEL_LENGTH)
+_HEAD_MAGIC = b'Kaydara FBX Binary\x20\x20\x00\x1a\x00'
+
+# The FBX SDK validates the footer against the file id and creation time,
+# so files are always written with these fixed values.
+TIME_ID = b'1970-01-01 10:00:00:000'
+FILE_ID = b'\x28\xb3\x2a\xeb\xb6\x24\xcc\xc2\xbf\xc8\xb0\x2a\xa9\x2b\xfc\xf1'
+_FOOT_ID = b'\xfa\xbc\xab\x09\xd0\xc8\xd4\x66\xb1\x76\xfb\x83\x1c\xf7\x26\x7e'
+_FOOT_MAGIC = b'\xf8\x5a\x8c\x6a\xde\xf5\xd9\x7e\xec\xe9\x0c\xe3\x75\x8f\x29\x0b'
+
+# These elements need a block sentinel even when they have properties but no children.
+_ELEMS_ID_ALWAYS_BLOCK_SENTINEL = {b"AnimationStack", b"AnimationLayer"}
+
+# Arrays smaller than this (in bytes) are not worth compressing,
+# this matches the FBX converter output.
+ARRAY_COMPRESS_MIN = 128
+ARRAY_COMPRESS_LEVEL = 1
+
+# property type codes
+BOOL = b'C'[0]
+INT16 = b'Y'[0]
+INT32 = b'I'[0]
+INT64 = b'L'[0]
+FLOAT32 = b'F'[0]
+FLOAT64 = b'D'[0]
+BYTES = b'R'[0]
+STRING = b'S'[0]
+BOOL_ARRAY = b'b'[0]
+INT32_ARRAY = b'i'[0]
+INT64_ARRAY = b'l'[0]
+FLOAT32_ARRAY = b'f'[0]
+FLOAT64_ARRAY = b'd'[0]
+
+
+class FBXElem(object):
+    __slots__ = ("id",
+                 "props",
+                 "props_type",
+                 "elems",
+                 "_props_length",  # combine length of props
+                 "_end_offset",  # byte offset from the start of the file.
+                 )
+
+    def __init__(self, id):
+        assert(len(id) < 256)  # length must fit in a uint8
+        self.id = id
+        self.props = []
+        self.props_type = bytearray()
+        self.elems = []
+        self._end_offset = -1
+        self._props_length = -1
+
+    def add_bool(self, data):
+        assert(isinstance(data, bool))
+        self.props_type.append(BOOL)
+        self.props.append(pack('?', data))
+
+    def add_int16(self, data):
+        assert(isinstance(data, int))
+        self.props_type.append(INT16)
+        self.props.append(pack('<h', data))
+
+    def add_int32(self, data):
+        assert(isinstance(data, int))
+        self.props_type.append(INT32)
+        self.props.append(pack('<i', data))
+
+    def add_int64(self, data):
+        assert(isinstance(data, int))
+        self.props_type.append(INT64)
+        self.props.append(pack('<q', data))
+
+    def add_float32(self, data):
+        assert(isinstance(data, float))
+        self.props_type.append(FLOAT32)
+        self.props.append(pack('<f', data))
+
+    def add_float64(self, data):
+        assert(isinstance(data, float))
+        self.props_type.append(FLOAT64)
+        self.props.append(pack('<d', data))
+
+    def add_bytes(self, data):
+        assert(isinstance(data, bytes))
+        self.props_type.append(BYTES)
+        self.props.append(pack('<I', len(data)) + data)
+
+    def add_string(self, data):
+        assert(isinstance(data, bytes))
+        self.props_type.append(STRING)
+        self.props.append(pack('<I', len(data)) + data)
+
+    def add_string_unicode(self, data):
+        assert(isinstance(data, str))
+        self.add_string(data.encode('utf8'))
+
+    def _add_array_helper(self, data, prop_type, length):
+        # mimic the behavior of the FBX converter, only compress larger arrays.
+        if len(data) <= ARRAY_COMPRESS_MIN:
+            encoding = 0
+        else:
+            encoding = 1
+            data = zlib.compress(data, ARRAY_COMPRESS_LEVEL)
+
+        self.props_type.append(prop_type)
+        self.props.append(pack('<3I', length, encoding, len(data)) + data)
+
+    def _add_array(self, data, typecode, prop_type):
+        if not isinstance(data, array) or data.typecode != typecode:
+            data = array(typecode, data)
+        length = len(data)
+        if _IS_BIG_ENDIAN:
+            data = data[:]
+            data.byteswap()
+        self._add_array_helper(data.tobytes(), prop_type, length)
+
+    def add_int32_array(self, data):
+        self._add_array(data, 'i', INT32_ARRAY)
+
+    def add_int64_array(self, data):
+        self._add_array(data, 'q', INT64_ARRAY)
+
+    def add_float32_array(self, data):
+        self._add_array(data, 'f', FLOAT32_ARRAY)
+
+    def add_float64_array(self, data):
+        self._add_array(data, 'd', FLOAT64_ARRAY)
+
+    def add_bool_array(self, data):
+        data = bytes(bytearray(bool(b) for b in data))
+        self._add_array_helper(data, BOOL_ARRAY, len(data))
+
+    # -------------------------
+    # Writing
+
+    def _calc_offsets(self, offset, is_last):
+        """
+        Call before writing, calculates fixed offsets.
+        """
+        assert(self._end_offset == -1)
+        assert(self._props_length == -1)
+
+        offset += 12  # 3 uints
+        offset += 1 + len(self.id)  # len + idname
+
+        props_length = 0
+        for data in self.props:
+            # 1 byte for the prop type
+            props_length += 1 + len(data)
+        self._props_length = props_length
+        offset += props_length
+
+        offset = self._calc_offsets_children(offset, is_last)
+
+        self._end_offset = offset
+        return offset
+
+    def _calc_offsets_children(self, offset, is_last):
+        if self.elems:
+            elem_last = self.elems[-1]
+            for elem in self.elems:
+                offset = elem._calc_offsets(offset, (elem is elem_last))
+            offset += _BLOCK_SENTINEL_LENGTH
+        elif (not self.props and not is_last) or self.id in _ELEMS_ID_ALWAYS_BLOCK_SENTINEL:
+            offset += _BLOCK_SENTINEL_LENGTH
+
+        return offset
+
+    def _write(self, write, is_last):
+        assert(self._end_offset != -1)
+        assert(self._props_length != -1)
+
+        write(pack('<3I', self._end_offset, len(self.props), self._props_length))
+
+        write(bytes((len(self.id),)))
+        write(self.id)
+
+        for i, data in enumerate(self.props):
+            write(bytes((self.props_type[i],)))
+            write(data)
+
+        self._write_children(write, is_last)
+
+    def _write_children(self, write, is_last):
+        if self.elems:
+            elem_last = self.elems[-1]
+            for elem in self.elems:
+                assert(elem.id != b'')
+                elem._write(write, (elem is elem_last))
+            write(_BLOCK_SENTINEL_DATA)
+        elif (not self.props and not is_last) or self.id in _ELEMS_ID_ALWAYS_BLOCK_SENTINEL:
+            write(_BLOCK_SENTINEL_DATA)
+
+
+def write(file, elem_root, version):
+    """
+    Write the element tree to a file opened in binary mode,
+    elem_root is a dummy element (with an empty id) holding the top level elements.
+    """
+    assert(elem_root.id == b'')
+
+    write = file.write
+
+    write(_HEAD_MAGIC)
+    write(pack('<I', version))
+
+    offset = elem_root._calc_offsets_children(len(_HEAD_MAGIC) + 4, False)
+    elem_root._write_children(write, False)
+
+    write(_FOOT_ID)
+    write(b'\x00' * 4)
+    offset += len(_FOOT_ID) + 4
+
+    # padding for alignment (values between 1 & 16 observed)
+    # if already aligned to 16, add a full 16 bytes padding.
+    pad = ((offset + 15) & ~15) - offset
+    if pad == 0:
+        pad = 16
+    write(b'\0' * pad)
+
+    write(pack('<I', version))
+
+    # unknown magic (always the same)
+    write(b'\0' * 120)
+    write(_FOOT_MAGIC)
@@ -0,0 +1,128 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+On disk cache of written file fragments.
+
+Fragments are stored under a hash of everything that went into writing
+them (the mesh arrays, names, export options...), so a fragment is only
+ever reused for identical input and old entries never need invalidating.
+"""
+
+import os
+import hashlib
+from array import array
+
+from .sink import open_sink
+
+# next to the exported file, shared by every export written there.
+CACHE_DIRNAME = ".fbx_export_cache"
+
+# change when the written text changes, so old fragments are not used.
+CACHE_VERSION = 2
+
+
+def _key_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf8")
+    if isinstance(value, array):
+        return value.tobytes()
+    if hasattr(value, "tobytes"):  # numpy arrays
+        return value.tobytes()
+    if isinstance(value, (list, tuple, range)):
+        try:
+            return array('d', value).tobytes()
+        except TypeError:
+            pass
+    return repr(value).encode("utf8")
+
+
+class ExportCache(object):
+    '''
+    Fragments keyed by content hash, counting hits and misses for the report.
+    '''
+    __slots__ = ("path",
+                 "hits",
+                 "misses",
+                 )
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        '''
+        Return the hash of parts, strings, numbers, arrays or sequences of numbers.
+        '''
+        h = hashlib.sha1(("%d:" % CACHE_VERSION).encode())
+        for value in parts:
+            data = _key_bytes(value)
+            # length prefix, so ("ab", "c") and ("a", "bc") differ
+            h.update(("%d:" % len(data)).encode())
+            h.update(data)
+        return h.hexdigest()
+
+    def _filepath(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        '''
+        Return the cached text or None.
+        '''
+        try:
+            with open(self._filepath(key), "rb") as f:
+                text = f.read().decode("utf8")
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        filepath = self._filepath(key)
+        try:
+            dirname = os.path.dirname(filepath)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # made by another export in the mean time
+                    if not os.path.isdir(dirname):
+                        raise
+            sink = open_sink(filepath)
+            sink.write(text.encode("utf8"))
+            sink.close()
+        except (IOError, OSError) as e:
+            # a cache that can't be written only costs speed.
+            print("\tcache: can't write %r, %s" % (filepath, e))
+
+    def report(self):
+        print("\tcache: %d hits, %d misses (%s)" % (self.hits, self.misses, self.path))
+
+
+def open_export_cache(filepath):
+    '''
+    Return the cache for exports to filepath.
+    '''
+    return ExportCache(os.path.join(os.path.dirname(filepath), CACHE_DIRNAME))
@@ -33,6 +33,26 @@ import math  # math.pi
 import bpy
 from mathutils import Vector, Matrix
 
+from . import encode_ascii
+from .encode_ascii import write_array
+from .sink import open_sink, NullSink, TextWriter
+from .pose_cache import PoseBuffer, matrices_to_trs, matrix_flat
+from .anim_reduce import reduce_keys
+from .anim_sample import (ArmatureSampler, armature_unsupported, object_transform_unsupported, action_key,
+                          armature_pose_key, action_bone_names, pose_bone_at_rest, action_pose_channels,
+                          armature_pose_values, armature_pose_set)
+from .scene_index import SceneIndex
+from .vertex_weights import mesh_vertex_weights
+from .name_registry import NameRegistry
+from .mesh_snapshot import MeshSnapshot
+from .mesh_optimize import optimize_mesh
+from .mesh_instances import mesh_instance_key
+from .bone_palette import partition_mesh
+from .mesh_chunks import chunk_mesh
+from .static_batch import face_material_keys, snapshot_center, batch_cell, merge_snapshots
+from .export_cache import open_export_cache
+from .texture_deploy import TextureDeploy
+
 
 # I guess FBX uses degrees instead of radians (Arystan).
 # Call this function just before writing to FBX.
@@ -40,146 +60,11 @@ from mathutils import Vector, Matrix
 def tuple_rad_to_deg(eul):
     return eul[0] * 57.295779513, eul[1] * 57.295779513, eul[2] * 57.295779513
 
-# Used to add the scene name into the filepath without using odd chars
-sane_name_mapping_ob = {}
-sane_name_mapping_ob_unique = set()
-sane_name_mapping_mat = {}
-sane_name_mapping_tex = {}
-sane_name_mapping_take = {}
-sane_name_mapping_group = {}
-
-# Make sure reserved names are not used
-sane_name_mapping_ob['Scene'] = 'Scene_'
-sane_name_mapping_ob_unique.add('Scene_')
-
-
-def increment_string(t):
-    name = t
-    num = ''
-    while name and name[-1].isdigit():
-        num = name[-1] + num
-        name = name[:-1]
-    if num:
-        return '%s%d' % (name, int(num) + 1)
-    else:
-        return name + '_0'
-
-
-# todo - Disallow the name 'Scene' - it will bugger things up.
-def sane_name(data, dct, unique_set=None):
-    #if not data: return None
-
-    if type(data) == tuple:  # materials are paired up with images
-        data, other = data
-        use_other = True
-    else:
-        other = None
-        use_other = False
-
-    name = data.name if data else None
-    orig_name = name
-
-    if other:
-        orig_name_other = other.name
-        name = '%s #%s' % (name, orig_name_other)
-    else:
-        orig_name_other = None
-
-    # dont cache, only ever call once for each data type now,
-    # so as to avoid namespace collision between types - like with objects <-> bones
-    #try:		return dct[name]
-    #except:		pass
-
-    if not name:
-        name = 'unnamed'  # blank string, ASKING FOR TROUBLE!
-    else:
-
-        name = bpy.path.clean_name(name)  # use our own
-
-    name_unique = dct.values() if unique_set is None else unique_set
-
-    while name in name_unique:
-        name = increment_string(name)
-
-    if use_other:  # even if other is None - orig_name_other will be a string or None
-        dct[orig_name, orig_name_other] = name
-    else:
-        dct[orig_name] = name
-
-    if unique_set is not None:
-        unique_set.add(name)
-
-    return name
-
-
-def sane_obname(data):
-    return sane_name(data, sane_name_mapping_ob, sane_name_mapping_ob_unique)
-
-
-def sane_matname(data):
-    return sane_name(data, sane_name_mapping_mat)
-
-
-def sane_texname(data):
-    return sane_name(data, sane_name_mapping_tex)
-
-
-def sane_takename(data):
-    return sane_name(data, sane_name_mapping_take)
-
-
-def sane_groupname(data):
-    return sane_name(data, sane_name_mapping_group)
-
 
 def mat4x4str(mat):
     return '%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f,%.15f' % tuple([f for v in mat for f in v])
 
 
-# ob must be OB_MESH
-def BPyMesh_meshWeight2List(ob, me):
-    ''' Takes a mesh and return its group names and a list of lists, one list per vertex.
-    aligning the each vert list with the group names, each list contains float value for the weight.
-    These 2 lists can be modified and then used with list2MeshWeight to apply the changes.
-    '''
-
-    # Clear the vert group.
-    groupNames = [g.name for g in ob.vertex_groups]
-    len_groupNames = len(groupNames)
-
-    if not len_groupNames:
-        # no verts? return a vert aligned empty list
-        return [[] for i in range(len(me.vertices))], []
-    else:
-        vWeightList = [[0.0] * len_groupNames for i in range(len(me.vertices))]
-
-    for i, v in enumerate(me.vertices):
-        for g in v.groups:
-            # possible weights are out of range
-            index = g.group
-            if index < len_groupNames:
-                vWeightList[i][index] = g.weight
-
-    return groupNames, vWeightList
-
-
-def meshNormalizedWeights(ob, me):
-    groupNames, vWeightList = BPyMesh_meshWeight2List(ob, me)
-
-    if not groupNames:
-        return [], []
-
-    for i, vWeights in enumerate(vWeightList):
-        tot = 0.0
-        for w in vWeights:
-            tot += w
-
-        if tot:
-            for j, w in enumerate(vWeights):
-                vWeights[j] = w / tot
-
-    return groupNames, vWeightList
-
 header_comment = \
 '''; FBX 6.1.0 project file
 ; Created by Blender FBX Exporter
@@ -190,7 +75,23 @@ header_comment = \
 
 
 # This func can be called with just the filepath
-def save_single(operator, scene, filepath="",
+def save_single(operator, scene, filepath="", **kwargs):
+    '''
+    Export scene to filepath, the keyword arguments are those of _save_single.
+    When the export fails, the partly written file is removed and image copies
+    not started yet are cancelled.
+    '''
+    abort_funcs = []
+    try:
+        return _save_single(operator, scene, filepath, abort_funcs=abort_funcs, **kwargs)
+    except:
+        for abort in reversed(abort_funcs):
+            abort()
+        raise
+
+
+def _save_single(operator, scene, filepath="",
+        abort_funcs=None,
         global_matrix=None,
         context_objects=None,
         object_types={'EMPTY', 'CAMERA', 'LAMP', 'ARMATURE', 'MESH'},
@@ -199,16 +100,31 @@ def save_single(operator, scene, filepath="",
         use_anim=True,
         use_anim_optimize=True,
         anim_optimize_precision=6,
+        use_anim_channel_prune=False,
         use_anim_action_all=False,
         use_metadata=True,
         path_mode='AUTO',
+        path_copy_method='COPY',
         use_mesh_edges=True,
+        use_mesh_optimize=False,
+        use_mesh_instances=False,
+        use_material_merge=False,
+        use_static_batch=False,
+        static_batch_cell_size=0.0,
+        bone_palette_size=0,
+        use_bone_prune=False,
+        use_bone_prune_keep_animated=True,
+        mesh_vertex_limit=0,
+        use_color_quantize=False,
         use_rotate_workaround=False,
         use_default_take=True,
+        export_format='ASCII',
+        use_anim_fcurve_sampling=False,
+        use_export_cache=False,
+        take_workers=None,
+        take_shard=None,
     ):
 
-    import bpy_extras.io_utils
-
     # Only used for camera and lamp rotations
     mtx_x90 = Matrix.Rotation(math.pi / 2.0, 3, 'X')
     # Used for mesh and armature rotations
@@ -225,8 +141,28 @@ def save_single(operator, scene, filepath="",
     base_src = os.path.dirname(bpy.data.filepath)
     base_dst = os.path.dirname(filepath)
 
-    # collect images to copy
-    copy_set = set()
+    # image paths, copied while the file is written (take workers leave it to the exporting process)
+    texture_deploy = TextureDeploy(base_src, base_dst, path_mode, path_copy_method, use_copy=(take_shard is None))
+    if abort_funcs is not None:
+        abort_funcs.append(texture_deploy.abort)
+
+    # unique names for everything written, only for this export
+    names = NameRegistry()
+
+    def sane_obname(data):
+        return names.name('OBJECT', data)
+
+    def sane_matname(data):
+        return names.name('MATERIAL', data)
+
+    def sane_texname(data):
+        return names.name('TEXTURE', data)
+
+    def sane_takename(data):
+        return names.name('TAKE', data)
+
+    def sane_groupname(data):
+        return names.name('GROUP', data)
 
     # ----------------------------------------------
     # storage classes
@@ -240,7 +176,7 @@ def save_single(operator, scene, filepath="",
                      "fbxName",
                      "fbxArm",
                      "__pose_bone",
-                     "__anim_poselist")
+                     "__anim_poses")
 
         def __init__(self, blenBone, fbxArm):
 
@@ -263,9 +199,8 @@ def save_single(operator, scene, filepath="",
             pose = fbxArm.blenObject.pose
             self.__pose_bone = pose.bones[self.blenName]
 
-            # store a list if matricies here, (poseMatrix, head, tail)
-            # {frame:posematrix, frame:posematrix, ...}
-            self.__anim_poselist = {}
+            # pose matrices of the sampled frames, 16 floats per frame.
+            self.__anim_poses = PoseBuffer()
 
         '''
         def calcRestMatrixLocal(self):
@@ -274,34 +209,17 @@ def save_single(operator, scene, filepath="",
             else:
                 self.restMatrixLocal = self.restMatrix.copy()
         '''
-        def setPoseFrame(self, f):
-            # cache pose info here, frame must be set beforehand
+        def setPoseFrame(self, f, matrix=None):
+            # cache pose info here, frame must be set beforehand (unless the matrix is given)
 
-            # Didnt end up needing head or tail, if we do - here it is.
-            '''
-            self.__anim_poselist[f] = (\
-                self.__pose_bone.poseMatrix.copy(),\
-                self.__pose_bone.head.copy(),\
-                self.__pose_bone.tail.copy() )
-            '''
-
-            self.__anim_poselist[f] = self.__pose_bone.matrix.copy()
+            self.__anim_poses.set(f, self.__pose_bone.matrix if matrix is None else matrix)
 
         def getPoseBone(self):
             return self.__pose_bone
 
         # get pose from frame.
         def getPoseMatrix(self, f):  # ----------------------------------------------
-            return self.__anim_poselist[f]
-        '''
-        def getPoseHead(self, f):
-            #return self.__pose_bone.head.copy()
-            return self.__anim_poselist[f][1].copy()
-        def getPoseTail(self, f):
-            #return self.__pose_bone.tail.copy()
-            return self.__anim_poselist[f][2].copy()
-        '''
-        # end
+            return self.__anim_poses.get(f)
 
         def getAnimParRelMatrix(self, frame):
             #arm_mat = self.fbxArm.matrixWorld
@@ -317,13 +235,25 @@ def save_single(operator, scene, filepath="",
         def getAnimParRelMatrixRot(self, frame):
             return self.getAnimParRelMatrix(frame)
 
+        def getAnimParRelMatrices(self, frame_start, frame_end):
+            '''
+            (matrix, matrix_rot) for every frame in the range, the same as
+            getAnimParRelMatrix & getAnimParRelMatrixRot but reading the pose buffers once.
+            '''
+            mats = [m * mtx4_z90 for m in self.__anim_poses.get_range(frame_start, frame_end)]
+            if self.parent:
+                par_mats = self.parent.__anim_poses.get_range(frame_start, frame_end)
+                mats = [(par_m * mtx4_z90).inverted() * m for par_m, m in zip(par_mats, mats)]
+            return [(m, m) for m in mats]
+
         def flushAnimData(self):
-            self.__anim_poselist.clear()
+            self.__anim_poses.clear()
 
     class my_object_generic(object):
         __slots__ = ("fbxName",
                      "blenObject",
                      "blenData",
+                     "meshSnapshot",
                      "origData",
                      "blenTextures",
                      "blenMaterials",
@@ -333,25 +263,29 @@ def save_single(operator, scene, filepath="",
                      "fbxGroupNames",
                      "fbxParent",
                      "fbxBoneParent",
+                     "fbxBonePalette",
+                     "fbxBatch",
                      "fbxBones",
                      "fbxArm",
                      "matrixWorld",
-                     "__anim_poselist",
+                     "__anim_poses",
                      )
 
         # Other settings can be applied for each type - mesh, armature etc.
-        def __init__(self, ob, matrixWorld=None):
-            self.fbxName = sane_obname(ob)
+        def __init__(self, ob, matrixWorld=None, name=None):
+            self.fbxName = sane_obname(name or ob)
             self.blenObject = ob
             self.fbxGroupNames = []
             self.fbxParent = None  # set later on IF the parent is in the selection.
             self.fbxArm = None
+            self.fbxBonePalette = None  # set of deforming bones when split by bone palette, else all
+            self.fbxBatch = None  # the static meshes merged into this one
             if matrixWorld:
                 self.matrixWorld = global_matrix * matrixWorld
             else:
                 self.matrixWorld = global_matrix * ob.matrix_world
 
-            self.__anim_poselist = {}  # we should only access this
+            self.__anim_poses = PoseBuffer()  # we should only access this
 
         def parRelMatrix(self):
             if self.fbxParent:
@@ -361,25 +295,22 @@ def save_single(operator, scene, filepath="",
 
         def setPoseFrame(self, f, fake=False):
             if fake:
-                self.__anim_poselist[f] = self.matrixWorld * global_matrix.inverted()
+                self.__anim_poses.set(f, self.matrixWorld * global_matrix.inverted())
             else:
-                self.__anim_poselist[f] = self.blenObject.matrix_world.copy()
+                self.__anim_poses.set(f, self.blenObject.matrix_world)
 
         def getAnimParRelMatrix(self, frame):
             if self.fbxParent:
-                #return (self.__anim_poselist[frame] * self.fbxParent.__anim_poselist[frame].inverted() ) * global_matrix
-                return (global_matrix * self.fbxParent.__anim_poselist[frame]).inverted() * (global_matrix * self.__anim_poselist[frame])
+                #return (self.__anim_poses.get(frame) * self.fbxParent.__anim_poses.get(frame).inverted() ) * global_matrix
+                return (global_matrix * self.fbxParent.__anim_poses.get(frame)).inverted() * (global_matrix * self.__anim_poses.get(frame))
             else:
-                return global_matrix * self.__anim_poselist[frame]
+                return global_matrix * self.__anim_poses.get(frame)
 
-        def getAnimParRelMatrixRot(self, frame):
-            obj_type = self.blenObject.type
-            if self.fbxParent:
-                matrix_rot = ((global_matrix * self.fbxParent.__anim_poselist[frame]).inverted() * (global_matrix * self.__anim_poselist[frame])).to_3x3()
-            else:
-                matrix_rot = (global_matrix * self.__anim_poselist[frame]).to_3x3()
+        def _animMatrixRot(self, matrix):
+            matrix_rot = matrix.to_3x3()
 
             # Lamps need to be rotated
+            obj_type = self.blenObject.type
             if obj_type == 'LAMP':
                 matrix_rot = matrix_rot * mtx_x90
             elif obj_type == 'CAMERA':
@@ -388,32 +319,66 @@ def save_single(operator, scene, filepath="",
 
             return matrix_rot
 
+        def getAnimParRelMatrixRot(self, frame):
+            return self._animMatrixRot(self.getAnimParRelMatrix(frame))
+
+        def getAnimParRelMatrices(self, frame_start, frame_end):
+            '''
+            (matrix, matrix_rot) for every frame in the range, the same as
+            getAnimParRelMatrix & getAnimParRelMatrixRot but reading the pose buffers once.
+            '''
+            mats = [global_matrix * m for m in self.__anim_poses.get_range(frame_start, frame_end)]
+            if self.fbxParent:
+                par_mats = self.fbxParent.__anim_poses.get_range(frame_start, frame_end)
+                mats = [(global_matrix * par_m).inverted() * m for par_m, m in zip(par_mats, mats)]
+            return [(m, self._animMatrixRot(m)) for m in mats]
+
+        def flushAnimData(self):
+            self.__anim_poses.clear()
+
     # ----------------------------------------------
 
     print('\nFBX export starting... %r' % filepath)
     start_time = time.clock()
     try:
-        file = open(filepath, "w", encoding="utf8", newline="\n")
+        # written to a temp file and renamed when done so the content pipeline never reads a partial file.
+        if take_shard is not None:
+            # a take worker, only the text of its takes is kept
+            file = TextWriter(NullSink())
+        elif export_format == 'BINARY':
+            file = open_sink(filepath)
+        else:
+            file = TextWriter(open_sink(filepath))
     except:
         import traceback
         traceback.print_exc()
         operator.report({'ERROR'}, "Could'nt open file %r" % filepath)
         return {'CANCELLED'}
 
+    if abort_funcs is not None:
+        abort_funcs.append(file.abort)
+
     # convenience
     fw = file.write
 
+    # mesh and skin fragments from earlier exports, the text format only
+    if use_export_cache and export_format != 'BINARY':
+        export_cache = open_export_cache(filepath)
+    else:
+        export_cache = None
+
     # scene = context.scene  # now passed as an arg instead of context
     world = scene.world
 
-    # ---------------------------- Write the header first
-    fw(header_comment)
     if use_metadata:
         curtime = time.localtime()[0:6]
     else:
         curtime = (0, 0, 0, 0, 0, 0)
-    #
-    fw(
+
+    # ---------------------------- Header, written first (ASCII only)
+    def write_header():
+        fw(header_comment)
+        fw(
 '''FBXHeaderExtension:  {
 	FBXHeaderVersion: 1003
 	FBXVersion: 6100
@@ -433,8 +398,8 @@ def save_single(operator, scene, filepath="",
 	}
 }''' % (curtime))
 
-    fw('\nCreationTime: "%.4i-%.2i-%.2i %.2i:%.2i:%.2i:000"' % curtime)
-    fw('\nCreator: "Blender version %s"' % bpy.app.version_string)
+        fw('\nCreationTime: "%.4i-%.2i-%.2i %.2i:%.2i:%.2i:000"' % curtime)
+        fw('\nCreator: "Blender version %s"' % bpy.app.version_string)
 
     pose_items = []  # list of (fbxName, matrix) to write pose data for, easier to collect allong the way
 
@@ -952,15 +917,10 @@ def save_single(operator, scene, filepath="",
         fw('\n\t\tCameraOrthoZoom: 1')
         fw('\n\t}')
 
-    def write_light(my_light):
-        light = my_light.blenObject.data
-        fw('\n\tModel: "Model::%s", "Light" {' % my_light.fbxName)
-        fw('\n\t\tVersion: 232')
-
-        write_object_props(my_light.blenObject, None, my_light.parRelMatrix())
-
-        # Why are these values here twice?????? - oh well, follow the holy sdk's output
-
+    def get_light_props(light):
+        '''
+        Return (light_type, do_light, do_shadow) for a blender lamp
+        '''
         # Blender light types match FBX's, funny coincidence, we just need to
         # be sure that all unsupported types are made into a point light
         #ePOINT,
@@ -979,6 +939,18 @@ def save_single(operator, scene, filepath="",
             do_light = not (light.use_only_shadow or (not light.use_diffuse and not light.use_specular))
             do_shadow = (light.shadow_method in ('RAY_SHADOW', 'BUFFER_SHADOW'))
 
+        return light_type, do_light, do_shadow
+
+    def write_light(my_light):
+        light = my_light.blenObject.data
+        fw('\n\tModel: "Model::%s", "Light" {' % my_light.fbxName)
+        fw('\n\t\tVersion: 232')
+
+        write_object_props(my_light.blenObject, None, my_light.parRelMatrix())
+
+        # Why are these values here twice?????? - oh well, follow the holy sdk's output
+        light_type, do_light, do_shadow = get_light_props(light)
+
         # scale = abs(global_matrix.to_scale()[0])  # scale is always uniform in this case  #  UNUSED
 
         fw('\n\t\t\tProperty: "LightType", "enum", "",%i' % light_type)
@@ -1059,9 +1031,10 @@ def save_single(operator, scene, filepath="",
     else:
         world_amb = 0.0, 0.0, 0.0  # default value
 
-    def write_material(matname, mat):
-        fw('\n\tMaterial: "Material::%s", "" {' % matname)
-
+    def get_material_props(mat):
+        '''
+        Return the material values written by the FBX writers
+        '''
         # Todo, add more material Properties.
         if mat:
             mat_cold = tuple(mat.diffuse_color)
@@ -1096,42 +1069,71 @@ def save_single(operator, scene, filepath="",
             mat_shadeless = False
             mat_shader = 'Phong'
 
-        fw('\n\t\tVersion: 102')
-        fw('\n\t\tShadingModel: "%s"' % mat_shader.lower())
-        fw('\n\t\tMultiLayer: 0')
-
-        fw('\n\t\tProperties60:  {')
-        fw('\n\t\t\tProperty: "ShadingModel", "KString", "", "%s"' % mat_shader)
-        fw('\n\t\t\tProperty: "MultiLayer", "bool", "",0')
-        fw('\n\t\t\tProperty: "EmissiveColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_cold)  # emit and diffuse color are he same in blender
-        fw('\n\t\t\tProperty: "EmissiveFactor", "double", "",%.4f' % mat_emit)
-
-        fw('\n\t\t\tProperty: "AmbientColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_colamb)
-        fw('\n\t\t\tProperty: "AmbientFactor", "double", "",%.4f' % mat_amb)
-        fw('\n\t\t\tProperty: "DiffuseColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_cold)
-        fw('\n\t\t\tProperty: "DiffuseFactor", "double", "",%.4f' % mat_dif)
-        fw('\n\t\t\tProperty: "Bump", "Vector3D", "",0,0,0')
-        fw('\n\t\t\tProperty: "TransparentColor", "ColorRGB", "",1,1,1')
-        fw('\n\t\t\tProperty: "TransparencyFactor", "double", "",%.4f' % (1.0 - mat_alpha))
+        return (mat_cold, mat_cols, mat_colamb, mat_dif, mat_amb, mat_hard,
+                mat_spec, mat_alpha, mat_emit, mat_shadeless, mat_shader)
+
+    def material_text(mat):
+        '''
+        Return the text of a material after its name, as the ASCII writer writes it
+        '''
+        text = []
+        tw = text.append
+
+        (mat_cold, mat_cols, mat_colamb, mat_dif, mat_amb, mat_hard,
+         mat_spec, mat_alpha, mat_emit, mat_shadeless, mat_shader) = get_material_props(mat)
+
+        tw('\n\t\tVersion: 102')
+        tw('\n\t\tShadingModel: "%s"' % mat_shader.lower())
+        tw('\n\t\tMultiLayer: 0')
+
+        tw('\n\t\tProperties60:  {')
+        tw('\n\t\t\tProperty: "ShadingModel", "KString", "", "%s"' % mat_shader)
+        tw('\n\t\t\tProperty: "MultiLayer", "bool", "",0')
+        tw('\n\t\t\tProperty: "EmissiveColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_cold)  # emit and diffuse color are he same in blender
+        tw('\n\t\t\tProperty: "EmissiveFactor", "double", "",%.4f' % mat_emit)
+
+        tw('\n\t\t\tProperty: "AmbientColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_colamb)
+        tw('\n\t\t\tProperty: "AmbientFactor", "double", "",%.4f' % mat_amb)
+        tw('\n\t\t\tProperty: "DiffuseColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_cold)
+        tw('\n\t\t\tProperty: "DiffuseFactor", "double", "",%.4f' % mat_dif)
+        tw('\n\t\t\tProperty: "Bump", "Vector3D", "",0,0,0')
+        tw('\n\t\t\tProperty: "TransparentColor", "ColorRGB", "",1,1,1')
+        tw('\n\t\t\tProperty: "TransparencyFactor", "double", "",%.4f' % (1.0 - mat_alpha))
         if not mat_shadeless:
-            fw('\n\t\t\tProperty: "SpecularColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_cols)
-            fw('\n\t\t\tProperty: "SpecularFactor", "double", "",%.4f' % mat_spec)
-            fw('\n\t\t\tProperty: "ShininessExponent", "double", "",80.0')
-            fw('\n\t\t\tProperty: "ReflectionColor", "ColorRGB", "",0,0,0')
-            fw('\n\t\t\tProperty: "ReflectionFactor", "double", "",1')
-        fw('\n\t\t\tProperty: "Emissive", "ColorRGB", "",0,0,0')
-        fw('\n\t\t\tProperty: "Ambient", "ColorRGB", "",%.1f,%.1f,%.1f' % mat_colamb)
-        fw('\n\t\t\tProperty: "Diffuse", "ColorRGB", "",%.1f,%.1f,%.1f' % mat_cold)
+            tw('\n\t\t\tProperty: "SpecularColor", "ColorRGB", "",%.4f,%.4f,%.4f' % mat_cols)
+            tw('\n\t\t\tProperty: "SpecularFactor", "double", "",%.4f' % mat_spec)
+            tw('\n\t\t\tProperty: "ShininessExponent", "double", "",80.0')
+            tw('\n\t\t\tProperty: "ReflectionColor", "ColorRGB", "",0,0,0')
+            tw('\n\t\t\tProperty: "ReflectionFactor", "double", "",1')
+        tw('\n\t\t\tProperty: "Emissive", "ColorRGB", "",0,0,0')
+        tw('\n\t\t\tProperty: "Ambient", "ColorRGB", "",%.1f,%.1f,%.1f' % mat_colamb)
+        tw('\n\t\t\tProperty: "Diffuse", "ColorRGB", "",%.1f,%.1f,%.1f' % mat_cold)
         if not mat_shadeless:
-            fw('\n\t\t\tProperty: "Specular", "ColorRGB", "",%.1f,%.1f,%.1f' % mat_cols)
-            fw('\n\t\t\tProperty: "Shininess", "double", "",%.1f' % mat_hard)
-        fw('\n\t\t\tProperty: "Opacity", "double", "",%.1f' % mat_alpha)
+            tw('\n\t\t\tProperty: "Specular", "ColorRGB", "",%.1f,%.1f,%.1f' % mat_cols)
+            tw('\n\t\t\tProperty: "Shininess", "double", "",%.1f' % mat_hard)
+        tw('\n\t\t\tProperty: "Opacity", "double", "",%.1f' % mat_alpha)
         if not mat_shadeless:
-            fw('\n\t\t\tProperty: "Reflectivity", "double", "",0')
+            tw('\n\t\t\tProperty: "Reflectivity", "double", "",0')
 
-        fw('\n\t\t}')
+        tw('\n\t\t}')
+
+        return "".join(text)
+
+    def write_material(matname, mat):
+        fw('\n\tMaterial: "Material::%s", "" {' % matname)
+        fw(material_text(mat))
         fw('\n\t}')
 
+    def get_texture_path(tex):
+        '''
+        Return (fname_rel, fname_strip) for an Image, empty strings for None
+        '''
+        if not tex:
+            return "", ""
+        fname_rel = texture_deploy.path(tex.filepath)
+        fname_strip = bpy.path.basename(fname_rel)
+        return fname_rel, fname_strip
+
     # tex is an Image (Arystan)
     def write_video(texname, tex):
         # Same as texture really!
@@ -1144,11 +1146,7 @@ def save_single(operator, scene, filepath="",
 			Property: "LastFrame", "int", "",0
 			Property: "Width", "int", "",0
 			Property: "Height", "int", "",0''')
-        if tex:
-            fname_rel = bpy_extras.io_utils.path_reference(tex.filepath, base_src, base_dst, path_mode, "", copy_set)
-            fname_strip = bpy.path.basename(fname_rel)
-        else:
-            fname_strip = fname_rel = ""
+        fname_rel, fname_strip = get_texture_path(tex)
 
         fw('\n\t\t\tProperty: "Path", "charptr", "", "%s"' % fname_strip)
 
@@ -1203,11 +1201,7 @@ def save_single(operator, scene, filepath="",
 
         fw('\n\t\tMedia: "Video::%s"' % texname)
 
-        if tex:
-            fname_rel = bpy_extras.io_utils.path_reference(tex.filepath, base_src, base_dst, path_mode, "", copy_set)
-            fname_strip = bpy.path.basename(bpy.path.abspath(fname_rel))
-        else:
-            fname_strip = fname_rel = ""
+        fname_rel, fname_strip = get_texture_path(tex)
 
         fw('\n\t\tFileName: "%s"' % fname_strip)
         fw('\n\t\tRelativeFilename: "%s"' % fname_rel)  # need some make relative command
@@ -1233,6 +1227,62 @@ def save_single(operator, scene, filepath="",
 		Link_DeformAcuracy: 50
 	}''')
 
+    def get_cluster_weights(my_mesh, my_bone, weights):
+        '''
+        Return (vertex_indices, weights) for the vertices this bone deforms,
+        weights is the meshes VertexWeights (None for bone parents).
+        '''
+        # Support for bone parents
+        if my_mesh.fbxBoneParent:
+            if my_mesh.fbxBoneParent == my_bone:
+                tot = my_mesh.meshSnapshot.vert_count
+                return range(tot), [1.0] * tot
+            else:
+                # This bone is not a parent of this mesh object, no weights
+                return (), ()
+
+        # Normal weight painted mesh
+        vgroup_indices, vgroup_weights = weights.group(my_bone.blenName)
+
+        vertex_remap = my_mesh.meshSnapshot.vertex_remap
+        if vertex_remap is not None:
+            # -1 for vertices in other bone palette parts
+            remapped = [(vertex_remap[i], w) for i, w in zip(vgroup_indices, vgroup_weights) if vertex_remap[i] != -1]
+            vgroup_indices = [i for i, w in remapped]
+            vgroup_weights = [w for i, w in remapped]
+
+        return vgroup_indices, vgroup_weights
+
+    def get_cluster_matrix(my_mesh, my_bone):
+        if my_mesh.fbxParent:
+            # TODO FIXME, this case is broken in some cases. skinned meshes just shouldnt have parents where possible!
+            m = (my_mesh.matrixWorld.inverted() * my_bone.fbxArm.matrixWorld.copy() * my_bone.restMatrix) * mtx4_z90
+        else:
+            # Yes! this is it...  - but dosnt work when the mesh is a.
+            m = (my_mesh.matrixWorld.inverted() * my_bone.fbxArm.matrixWorld.copy() * my_bone.restMatrix) * mtx4_z90
+
+        #m = mtx4_z90 * my_bone.restMatrix
+        return m
+
+    def write_cached(cache_key, write_func, *args):
+        '''
+        Write a fragment with write_func(*args),
+        or the text cached for the same cache_key by an earlier export.
+        A cache_key of None is never cached.
+        '''
+        if export_cache is None or cache_key is None:
+            write_func(*args)
+            return
+
+        key = export_cache.key(*cache_key)
+        text = export_cache.get(key)
+        if text is None:
+            file.capture_begin()
+            write_func(*args)
+            export_cache.put(key, file.capture_end())
+        else:
+            fw(text)
+
     # in the example was 'Bip01 L Thigh_2'
     def write_sub_deformer_skin(my_mesh, my_bone, weights):
 
@@ -1243,6 +1293,13 @@ def save_single(operator, scene, filepath="",
         Its possible that there is no matching vgroup in this mesh, in that case no verts are in the subdeformer,
         a but silly but dosnt really matter
         '''
+        vgroup_indices, vgroup_weights = get_cluster_weights(my_mesh, my_bone, weights)
+        m = get_cluster_matrix(my_mesh, my_bone)
+
+        write_cached(("Cluster", my_mesh.fbxName, my_bone.fbxName, vgroup_indices, vgroup_weights, mat4x4str(m)),
+                     write_sub_deformer_cluster, my_mesh, my_bone, vgroup_indices, vgroup_weights, m)
+
+    def write_sub_deformer_cluster(my_mesh, my_bone, vgroup_indices, vgroup_weights, m):
         fw('\n\tDeformer: "SubDeformer::Cluster %s %s", "Cluster" {' % (my_mesh.fbxName, my_bone.fbxName))
 
         fw('''
@@ -1255,61 +1312,12 @@ def save_single(operator, scene, filepath="",
 		}
 		UserData: "", ""''')
 
-        # Support for bone parents
-        if my_mesh.fbxBoneParent:
-            if my_mesh.fbxBoneParent == my_bone:
-                # TODO - this is a bit lazy, we could have a simple write loop
-                # for this case because all weights are 1.0 but for now this is ok
-                # Parent Bones arent used all that much anyway.
-                vgroup_data = [(j, 1.0) for j in range(len(my_mesh.blenData.vertices))]
-            else:
-                # This bone is not a parent of this mesh object, no weights
-                vgroup_data = []
-
-        else:
-            # Normal weight painted mesh
-            if my_bone.blenName in weights[0]:
-                # Before we used normalized weight list
-                group_index = weights[0].index(my_bone.blenName)
-                vgroup_data = [(j, weight[group_index]) for j, weight in enumerate(weights[1]) if weight[group_index]]
-            else:
-                vgroup_data = []
-
         fw('\n\t\tIndexes: ')
-
-        i = -1
-        for vg in vgroup_data:
-            if i == -1:
-                fw('%i' % vg[0])
-                i = 0
-            else:
-                if i == 23:
-                    fw('\n\t\t')
-                    i = 0
-                fw(',%i' % vg[0])
-            i += 1
+        write_array(fw, vgroup_indices, '%i', 23, '\n\t\t')
 
         fw('\n\t\tWeights: ')
-        i = -1
-        for vg in vgroup_data:
-            if i == -1:
-                fw('%.8f' % vg[1])
-                i = 0
-            else:
-                if i == 38:
-                    fw('\n\t\t')
-                    i = 0
-                fw(',%.8f' % vg[1])
-            i += 1
-
-        if my_mesh.fbxParent:
-            # TODO FIXME, this case is broken in some cases. skinned meshes just shouldnt have parents where possible!
-            m = (my_mesh.matrixWorld.inverted() * my_bone.fbxArm.matrixWorld.copy() * my_bone.restMatrix) * mtx4_z90
-        else:
-            # Yes! this is it...  - but dosnt work when the mesh is a.
-            m = (my_mesh.matrixWorld.inverted() * my_bone.fbxArm.matrixWorld.copy() * my_bone.restMatrix) * mtx4_z90
+        write_array(fw, vgroup_weights, '%.8f', 38, '\n\t\t')
 
-        #m = mtx4_z90 * my_bone.restMatrix
         matstr = mat4x4str(m)
         matstr_i = mat4x4str(m.inverted())
 
@@ -1319,26 +1327,62 @@ def save_single(operator, scene, filepath="",
 
     def write_mesh(my_mesh):
 
-        me = my_mesh.blenData
-
-        # if there are non NULL materials on this mesh
-        do_materials = bool(my_mesh.blenMaterials)
-        do_textures = bool(my_mesh.blenTextures)
-        do_uvs = bool(me.uv_textures)
-
         fw('\n\tModel: "Model::%s", "Mesh" {' % my_mesh.fbxName)
         fw('\n\t\tVersion: 232')  # newline is added in write_object_props
 
-        # convert into lists once.
-        me_vertices = me.vertices[:]
-        me_edges = me.edges[:] if use_mesh_edges else ()
-        me_faces = me.faces[:]
-
         poseMatrix = write_object_props(my_mesh.blenObject, None, my_mesh.parRelMatrix())[3]
         pose_items.append((my_mesh.fbxName, poseMatrix))
 
         fw('\n\t\t}')
 
+        snapshot = my_mesh.meshSnapshot
+
+        # objects sharing a mesh repeat the text written for the first of them (FBX 6 can't share geometry)
+        remaining = mesh_instance_users.get(snapshot, 1) - 1  # objects to write after this one
+        mesh_instance_users[snapshot] = remaining
+
+        text = mesh_geometry_texts.get(snapshot)
+        if text is not None:
+            if not remaining:
+                del mesh_geometry_texts[snapshot]
+            fw(text)
+            return
+
+        cache_key = ["Geometry", mesh_smooth_type, use_mesh_edges, use_color_quantize,
+                     snapshot.co, snapshot.normal, snapshot.face_vertices_raw, snapshot.face_smooth,
+                     snapshot.face_materials, snapshot.edge_vertices, snapshot.edge_loose, snapshot.edge_sharp,
+                     [(getattr(mat, "name", None), getattr(tex, "name", None)) for mat, tex in my_mesh.blenMaterials],
+                     [getattr(mat, "name", None) for mat in my_mesh.blenMaterialList],
+                     [getattr(tex, "name", None) for tex in my_mesh.blenTextures],
+                     ]
+        for uvlayer in snapshot.uv_layers:
+            cache_key += [uvlayer.name, uvlayer.data, [getattr(image, "name", None) for image in uvlayer.images]]
+        for collayer in snapshot.color_layers:
+            cache_key += [collayer.name, collayer.data]
+
+        if remaining:
+            file.capture_begin()
+            write_cached(cache_key, write_mesh_geometry, my_mesh)
+            mesh_geometry_texts[snapshot] = file.capture_end()
+        else:
+            write_cached(cache_key, write_mesh_geometry, my_mesh)
+
+    def write_mesh_geometry(my_mesh):
+        '''
+        Everything in the mesh model after its properties.
+        '''
+        snapshot = my_mesh.meshSnapshot
+
+        # if there are non NULL materials on this mesh
+        do_materials = bool(my_mesh.blenMaterials)
+        do_textures = bool(my_mesh.blenTextures)
+        do_uvs = bool(snapshot.uv_layers)
+
+        if use_mesh_edges:
+            t_ev = snapshot.edge_vertices
+        else:
+            t_ev = ()
+
         fw('\n\t\tMultiLayer: 0'
            '\n\t\tMultiTake: 1'
            '\n\t\tShading: Y'
@@ -1347,69 +1391,24 @@ def save_single(operator, scene, filepath="",
 
         # Write the Real Mesh data here
         fw('\n\t\tVertices: ')
-        i = -1
-
-        for v in me_vertices:
-            if i == -1:
-                fw('%.6f,%.6f,%.6f' % v.co[:])
-                i = 0
-            else:
-                if i == 7:
-                    fw('\n\t\t')
-                    i = 0
-                fw(',%.6f,%.6f,%.6f' % v.co[:])
-            i += 1
+        write_array(fw, snapshot.co, '%.6f', 7, '\n\t\t', group_size=3)
 
-        fw('\n\t\tPolygonVertexIndex: ')
-        i = -1
-        for f in me_faces:
-            fi = f.vertices[:]
-
-            # last index XORd w. -1 indicates end of face
-            if i == -1:
-                if len(fi) == 3:
-                    fw('%i,%i,%i' % (fi[0], fi[1], fi[2] ^ -1))
-                else:
-                    fw('%i,%i,%i,%i' % (fi[0], fi[1], fi[2], fi[3] ^ -1))
-                i = 0
-            else:
-                if i == 13:
-                    fw('\n\t\t')
-                    i = 0
-                if len(fi) == 3:
-                    fw(',%i,%i,%i' % (fi[0], fi[1], fi[2] ^ -1))
-                else:
-                    fw(',%i,%i,%i,%i' % (fi[0], fi[1], fi[2], fi[3] ^ -1))
-            i += 1
+        # last index XORd w. -1 indicates end of face
+        t_pvi, t_pvi_sizes = snapshot.polygon_vertex_index()
 
         # write loose edges as faces.
-        for ed in me_edges:
-            if ed.is_loose:
-                ed_val = ed.vertices[:]
-                ed_val = ed_val[0], ed_val[-1] ^ -1
-
-                if i == -1:
-                    fw('%i,%i' % ed_val)
-                    i = 0
-                else:
-                    if i == 13:
-                        fw('\n\t\t')
-                        i = 0
-                    fw(',%i,%i' % ed_val)
-            i += 1
+        if use_mesh_edges:
+            for j, v1, v2 in snapshot.loose_edges():
+                t_pvi.append(v1)
+                t_pvi.append(v2 ^ -1)
+                t_pvi_sizes.append(2)
+
+        fw('\n\t\tPolygonVertexIndex: ')
+        write_array(fw, t_pvi, '%i', 13, '\n\t\t', group_sizes=t_pvi_sizes)
+        del t_pvi, t_pvi_sizes
 
         fw('\n\t\tEdges: ')
-        i = -1
-        for ed in me_edges:
-                if i == -1:
-                    fw('%i,%i' % (ed.vertices[0], ed.vertices[1]))
-                    i = 0
-                else:
-                    if i == 13:
-                        fw('\n\t\t')
-                        i = 0
-                    fw(',%i,%i' % (ed.vertices[0], ed.vertices[1]))
-                i += 1
+        write_array(fw, t_ev, '%i', 13, '\n\t\t', group_size=2)
 
         fw('\n\t\tGeometryVersion: 124')
 
@@ -1421,17 +1420,7 @@ def save_single(operator, scene, filepath="",
 			ReferenceInformationType: "Direct"
 			Normals: ''')
 
-        i = -1
-        for v in me_vertices:
-            if i == -1:
-                fw('%.15f,%.15f,%.15f' % v.normal[:])
-                i = 0
-            else:
-                if i == 2:
-                    fw('\n\t\t\t ')
-                    i = 0
-                fw(',%.15f,%.15f,%.15f' % v.normal[:])
-            i += 1
+        write_array(fw, snapshot.normal, '%.15f', 2, '\n\t\t\t ', group_size=3)
         fw('\n\t\t}')
 
         # Write Face Smoothing
@@ -1444,18 +1433,7 @@ def save_single(operator, scene, filepath="",
 			ReferenceInformationType: "Direct"
 			Smoothing: ''')
 
-            i = -1
-            for f in me_faces:
-                if i == -1:
-                    fw('%i' % f.use_smooth)
-                    i = 0
-                else:
-                    if i == 54:
-                        fw('\n\t\t\t ')
-                        i = 0
-                    fw(',%i' % f.use_smooth)
-                i += 1
-
+            write_array(fw, snapshot.face_smooth, '%i', 54, '\n\t\t\t ')
             fw('\n\t\t}')
 
         elif mesh_smooth_type == 'EDGE':
@@ -1468,18 +1446,8 @@ def save_single(operator, scene, filepath="",
 			ReferenceInformationType: "Direct"
 			Smoothing: ''')
 
-            i = -1
-            for ed in me_edges:
-                if i == -1:
-                    fw('%i' % (ed.use_edge_sharp))
-                    i = 0
-                else:
-                    if i == 54:
-                        fw('\n\t\t\t ')
-                        i = 0
-                    fw(',%i' % ed.use_edge_sharp)
-                i += 1
-
+            if use_mesh_edges:
+                write_array(fw, snapshot.edge_sharp, '%i', 54, '\n\t\t\t ')
             fw('\n\t\t}')
         elif mesh_smooth_type == 'OFF':
             pass
@@ -1488,9 +1456,8 @@ def save_single(operator, scene, filepath="",
 
         # Write VertexColor Layers
         # note, no programs seem to use this info :/
-        collayers = []
-        if len(me.vertex_colors):
-            collayers = me.vertex_colors
+        collayers = snapshot.color_layers
+        if collayers:
             for colindex, collayer in enumerate(collayers):
                 fw('\n\t\tLayerElementColor: %i {' % colindex)
                 fw('\n\t\t\tVersion: 101')
@@ -1501,47 +1468,26 @@ def save_single(operator, scene, filepath="",
 			ReferenceInformationType: "IndexToDirect"
 			Colors: ''')
 
-                i = -1
-                ii = 0  # Count how many Colors we write
+                t_col = collayer.data
+                if use_color_quantize:
+                    t_col = encode_ascii.quantize_values(t_col)
 
-                for fi, cf in enumerate(collayer.data):
-                    if len(me_faces[fi].vertices) == 4:
-                        colors = cf.color1[:], cf.color2[:], cf.color3[:], cf.color4[:]
-                    else:
-                        colors = cf.color1[:], cf.color2[:], cf.color3[:]
+                # each distinct color once, corners index them
+                t_col, t_ci = encode_ascii.dedupe_values(t_col, 3)
 
-                    for col in colors:
-                        if i == -1:
-                            fw('%.4f,%.4f,%.4f,1' % col)
-                            i = 0
-                        else:
-                            if i == 7:
-                                fw('\n\t\t\t\t')
-                                i = 0
-                            fw(',%.4f,%.4f,%.4f,1' % col)
-                        i += 1
-                        ii += 1  # One more Color
+                write_array(fw, t_col, '%.4f', 7, '\n\t\t\t\t', group_size=3, group_suffix=',1')
+                del t_col
 
                 fw('\n\t\t\tColorIndex: ')
-                i = -1
-                for j in range(ii):
-                    if i == -1:
-                        fw('%i' % j)
-                        i = 0
-                    else:
-                        if i == 55:
-                            fw('\n\t\t\t\t')
-                            i = 0
-                        fw(',%i' % j)
-                    i += 1
+                write_array(fw, t_ci, '%i', 55, '\n\t\t\t\t')
+                del t_ci
 
                 fw('\n\t\t}')
 
         # Write UV and texture layers.
-        uvlayers = []
+        uvlayers = snapshot.uv_layers
         if do_uvs:
-            uvlayers = me.uv_textures
-            for uvindex, uvlayer in enumerate(me.uv_textures):
+            for uvindex, uvlayer in enumerate(uvlayers):
                 fw('\n\t\tLayerElementUV: %i {' % uvindex)
                 fw('\n\t\t\tVersion: 101')
                 fw('\n\t\t\tName: "%s"' % uvlayer.name)
@@ -1551,35 +1497,15 @@ def save_single(operator, scene, filepath="",
 			ReferenceInformationType: "IndexToDirect"
 			UV: ''')
 
-                i = -1
-                ii = 0  # Count how many UVs we write
+                # each distinct UV once, corners index them
+                t_uv, t_uvi = encode_ascii.dedupe_values(uvlayer.data, 2)
 
-                for uf in uvlayer.data:
-                    # workaround, since uf.uv iteration is wrong atm
-                    for uv in uf.uv:
-                        if i == -1:
-                            fw('%.6f,%.6f' % uv[:])
-                            i = 0
-                        else:
-                            if i == 7:
-                                fw('\n\t\t\t ')
-                                i = 0
-                            fw(',%.6f,%.6f' % uv[:])
-                        i += 1
-                        ii += 1  # One more UV
+                write_array(fw, t_uv, '%.6f', 7, '\n\t\t\t ', group_size=2)
+                del t_uv
 
                 fw('\n\t\t\tUVIndex: ')
-                i = -1
-                for j in range(ii):
-                    if i == -1:
-                        fw('%i' % j)
-                        i = 0
-                    else:
-                        if i == 55:
-                            fw('\n\t\t\t\t')
-                            i = 0
-                        fw(',%i' % j)
-                    i += 1
+                write_array(fw, t_uvi, '%i', 55, '\n\t\t\t\t')
+                del t_uvi
 
                 fw('\n\t\t}')
 
@@ -1609,20 +1535,7 @@ def save_single(operator, scene, filepath="",
                                 texture_mapping_local[tex] = i
                                 i += 1
 
-                        i = -1
-                        for f in uvlayer.data:
-                            img_key = f.image
-
-                            if i == -1:
-                                i = 0
-                                fw('%s' % texture_mapping_local[img_key])
-                            else:
-                                if i == 55:
-                                    fw('\n			 ')
-                                    i = 0
-
-                                fw(',%s' % texture_mapping_local[img_key])
-                            i += 1
+                        write_array(fw, [texture_mapping_local[image] for image in uvlayer.images], '%s', 55, '\n\t\t\t ')
 
                 else:
                     fw('''
@@ -1661,33 +1574,27 @@ def save_single(operator, scene, filepath="",
 
                 mats = my_mesh.blenMaterialList
 
-                if me.uv_textures.active:
-                    uv_faces = me.uv_textures.active.data
+                if snapshot.face_images is not None:
+                    face_images = snapshot.face_images
                 else:
-                    uv_faces = [None] * len(me_faces)
+                    face_images = [None] * snapshot.face_count
 
-                i = -1
-                for f, uf in zip(me_faces, uv_faces):
+                t_mi = []
+                for mat_index, image in zip(encode_ascii.tolist(snapshot.face_materials), face_images):
                     try:
-                        mat = mats[f.material_index]
+                        mat = mats[mat_index]
                     except:
                         mat = None
 
                     if do_uvs:
-                        tex = uf.image  # WARNING - MULTI UV LAYER IMAGES NOT SUPPORTED :/
+                        tex = image  # WARNING - MULTI UV LAYER IMAGES NOT SUPPORTED :/
                     else:
                         tex = None
 
-                    if i == -1:
-                        i = 0
-                        fw('%s' % material_mapping_local[mat, tex])  # None for mat or tex is ok
-                    else:
-                        if i == 55:
-                            fw('\n\t\t\t\t')
-                            i = 0
+                    t_mi.append(material_mapping_local[mat, tex])  # None for mat or tex is ok
 
-                        fw(',%s' % material_mapping_local[mat, tex])
-                    i += 1
+                write_array(fw, t_mi, '%s', 55, '\n\t\t\t\t')
+                del t_mi
 
             fw('\n\t\t}')
 
@@ -1722,7 +1629,7 @@ def save_single(operator, scene, filepath="",
 				TypedIndex: 0
 			}''')
 
-        if me.vertex_colors:
+        if collayers:
             fw('''
 			LayerElement:  {
 				Type: "LayerElementColor"
@@ -1797,6 +1704,9 @@ def save_single(operator, scene, filepath="",
     # add meshes here to clear because they are not used anywhere.
     meshes_to_clear = []
 
+    # evaluated meshes shared by objects with the same mesh and modifiers, see mesh_instance_key
+    mesh_instances = {}
+
     ob_meshes = []
     ob_lights = []
     ob_cameras = []
@@ -1804,8 +1714,11 @@ def save_single(operator, scene, filepath="",
     # armatures not a part of a mesh, will be added to ob_arms
     ob_bones = []
     ob_arms = []
+    ob_arms_set = set()  # blender armature objects in ob_arms
     ob_null = []  # emptys
 
+    scene_index = SceneIndex()  # blender data to the classes above
+
     # List of types that have blender objects (not bones)
     ob_all_typegroups = [ob_meshes, ob_lights, ob_cameras, ob_arms, ob_null]
 
@@ -1856,36 +1769,46 @@ def save_single(operator, scene, filepath="",
             elif tmp_ob_type == 'ARMATURE':
                 if 'ARMATURE' in object_types:
                     # TODO - armatures dont work in dupligroups!
-                    if ob not in ob_arms:
+                    if ob not in ob_arms_set:
                         ob_arms.append(ob)
+                        ob_arms_set.add(ob)
                     # ob_arms.append(ob) # replace later. was "ob_arms.append(sane_obname(ob), ob)"
             elif tmp_ob_type == 'EMPTY':
                 if 'EMPTY' in object_types:
                     ob_null.append(my_object_generic(ob, mtx))
             elif 'MESH' in object_types:
-                origData = True
-                if tmp_ob_type != 'MESH':
-                    try:
-                        me = ob.to_mesh(scene, True, 'PREVIEW')
-                    except:
-                        me = None
+                if use_mesh_instances:
+                    instance_key = mesh_instance_key(ob, use_mesh_modifiers, 'ARMATURE' in object_types)
+                else:
+                    instance_key = None
 
-                    if me:
-                        meshes_to_clear.append(me)
-                        mats = me.materials
-                        origData = False
+                if instance_key in mesh_instances:
+                    # same mesh and modifiers as an earlier object, share its evaluated mesh
+                    me, mats, origData, snapshot = mesh_instances[instance_key]
                 else:
-                    # Mesh Type!
-                    if use_mesh_modifiers:
-                        me = ob.to_mesh(scene, True, 'PREVIEW')
-
-                        # print ob, me, me.getVertGroupNames()
-                        meshes_to_clear.append(me)
-                        origData = False
-                        mats = me.materials
+                    origData = True
+                    if tmp_ob_type != 'MESH':
+                        try:
+                            me = ob.to_mesh(scene, True, 'PREVIEW')
+                        except:
+                            me = None
+
+                        if me:
+                            meshes_to_clear.append(me)
+                            mats = me.materials
+                            origData = False
                     else:
-                        me = ob.data
-                        mats = me.materials
+                        # Mesh Type!
+                        if use_mesh_modifiers:
+                            me = ob.to_mesh(scene, True, 'PREVIEW')
+
+                            # print ob, me, me.getVertGroupNames()
+                            meshes_to_clear.append(me)
+                            origData = False
+                            mats = me.materials
+                        else:
+                            me = ob.data
+                            mats = me.materials
 
 # 						# Support object colors
 # 						tmp_colbits = ob.colbits
@@ -1897,23 +1820,33 @@ def save_single(operator, scene, filepath="",
 # 							del tmp_ob_mats
 # 						del tmp_colbits
 
-                if me:
+                    if me:
 # 					# This WILL modify meshes in blender if use_mesh_modifiers is disabled.
 # 					# so strictly this is bad. but only in rare cases would it have negative results
 # 					# say with dupliverts the objects would rotate a bit differently
 # 					if EXP_MESH_HQ_NORMALS:
 # 						BPyMesh.meshCalcNormals(me) # high quality normals nice for realtime engines.
 
+                        snapshot = MeshSnapshot(me, use_mesh_edges or mesh_smooth_type == 'EDGE')
+
+                        if use_mesh_optimize:
+                            acmr_before, acmr_after = optimize_mesh(snapshot)
+                            print('\tmesh "%s": %d triangles, ACMR %.3f -> %.3f' % (ob.name, snapshot.face_count, acmr_before, acmr_after))
+
+                        if instance_key is not None:
+                            mesh_instances[instance_key] = me, mats, origData, snapshot
+
+                if me:
                     texture_mapping_local = {}
                     material_mapping_local = {}
-                    if me.uv_textures:
-                        for uvlayer in me.uv_textures:
-                            for f, uf in zip(me.faces, uvlayer.data):
-                                tex = uf.image
+                    if snapshot.uv_layers:
+                        face_materials = encode_ascii.tolist(snapshot.face_materials)
+                        for uvlayer in snapshot.uv_layers:
+                            for mat_index, tex in zip(face_materials, uvlayer.images):
                                 textures[tex] = texture_mapping_local[tex] = None
 
                                 try:
-                                    mat = mats[f.material_index]
+                                    mat = mats[mat_index]
                                 except:
                                     mat = None
 
@@ -1936,8 +1869,9 @@ def save_single(operator, scene, filepath="",
                             armob = ob.parent
                             blenParentBoneName = ob.parent_bone
 
-                        if armob and armob not in ob_arms:
+                        if armob and armob not in ob_arms_set:
                             ob_arms.append(armob)
+                            ob_arms_set.add(armob)
 
                         # Warning for scaled, mesh objects with armatures
                         if abs(ob.scale[0] - 1.0) > 0.05 or abs(ob.scale[1] - 1.0) > 0.05 or abs(ob.scale[1] - 1.0) > 0.05:
@@ -1948,6 +1882,7 @@ def save_single(operator, scene, filepath="",
 
                     my_mesh = my_object_generic(ob, mtx)
                     my_mesh.blenData = me
+                    my_mesh.meshSnapshot = snapshot
                     my_mesh.origData = origData
                     my_mesh.blenMaterials = list(material_mapping_local.keys())
                     my_mesh.blenMaterialList = mats
@@ -2000,85 +1935,368 @@ def save_single(operator, scene, filepath="",
         # fbxName, blenderObject, my_bones, blenderActions
         #ob_arms[i] = fbxArmObName, ob, arm_my_bones, (ob.action, [])
 
+        scene_index.add_object(my_arm)
+
         for bone in my_arm.blenData.bones:
             my_bone = my_bone_class(bone, my_arm)
             my_arm.fbxBones.append(my_bone)
             ob_bones.append(my_bone)
+            scene_index.add_bone(my_bone)
 
-    # add the meshes to the bones and replace the meshes armature with own armature class
-    #for obname, ob, mtx, me, mats, arm, armname in ob_meshes:
-    for my_mesh in ob_meshes:
-        # Replace
-        # ...this could be sped up with dictionary mapping but its unlikely for
-        # it ever to be a bottleneck - (would need 100+ meshes using armatures)
-        if my_mesh.fbxArm:
-            for my_arm in ob_arms:
-                if my_arm.blenObject == my_mesh.fbxArm:
-                    my_mesh.fbxArm = my_arm
-                    break
+    del ob_arms_set
 
-        for my_bone in ob_bones:
+    def material_fingerprint(mat):
+        '''
+        Return the material values as the writer emits them, equal for materials written the same:
+        the written text for ASCII, the full precision values for binary.
+        '''
+        if export_format == 'BINARY':
+            return get_material_props(mat)
+        return material_text(mat)
 
-            # The mesh uses this bones armature!
-            if my_bone.fbxArm == my_mesh.fbxArm:
-                if my_bone.blenBone.use_deform:
-                    my_bone.blenMeshes[my_mesh.fbxName] = me
+    def merge_identical_materials():
+        '''
+        Replace materials with the same values as another by that one (the first by name),
+        in the materials dict and the meshes. Pairs with different images stay apart.
+        '''
+        blen_mats = set(mat for mat, tex in materials if mat)
 
-                # parent bone: replace bone names with our class instances
-                # my_mesh.fbxBoneParent is None or a blender bone name initialy, replacing if the names match.
-                if my_mesh.fbxBoneParent == my_bone.blenName:
-                    my_mesh.fbxBoneParent = my_bone
+        material_merged = {}  # material: the material used instead
+        fingerprints = {}  # fingerprint: first material
+        for mat in sorted(blen_mats, key=lambda m: m.name):
+            mat_first = fingerprints.setdefault(material_fingerprint(mat), mat)
+            if mat_first is not mat:
+                material_merged[mat] = mat_first
 
-    bone_deformer_count = 0  # count how many bones deform a mesh
-    my_bone_blenParent = None
-    for my_bone in ob_bones:
-        my_bone_blenParent = my_bone.blenBone.parent
-        if my_bone_blenParent:
-            for my_bone_parent in ob_bones:
-                # Note 2.45rc2 you can compare bones normally
-                if my_bone_blenParent.name == my_bone_parent.blenName and my_bone.fbxArm == my_bone_parent.fbxArm:
-                    my_bone.parent = my_bone_parent
-                    break
+        if not material_merged:
+            return
 
-        # Not used at the moment
-        # my_bone.calcRestMatrixLocal()
-        bone_deformer_count += len(my_bone.blenMeshes)
+        material_pairs = [(material_merged.get(mat, mat), tex) for mat, tex in materials]
+        materials.clear()
+        for mat_tex_pair in material_pairs:
+            materials[mat_tex_pair] = None
 
-    del my_bone_blenParent
+        for my_mesh in ob_meshes:
+            my_mesh.blenMaterialList = [material_merged.get(mat, mat) for mat in my_mesh.blenMaterialList]
 
-    # Build blenObject -> fbxObject mapping
-    # this is needed for groups as well as fbxParenting
-    bpy.data.objects.tag(False)
+            blenMaterials = []
+            for mat, tex in my_mesh.blenMaterials:
+                mat_tex_pair = material_merged.get(mat, mat), tex
+                if mat_tex_pair not in blenMaterials:
+                    blenMaterials.append(mat_tex_pair)
+            my_mesh.blenMaterials = blenMaterials
 
-    # using a list of object names for tagging (Arystan)
+        print('	materials: %d merged into identical ones' % len(material_merged))
 
-    tmp_obmapping = {}
-    for ob_generic in ob_all_typegroups:
+    def static_batch_meshes():
+        '''
+        Merge the static meshes in ob_meshes, one mesh for each (material, image) pair
+        and cell of static_batch_cell_size.
+        '''
+        # objects others are parented to stay, so their children keep their place
+        parents = set()
+        for ob_generic in ob_all_typegroups:
+            for my_ob in ob_generic:
+                parents.add(my_ob.blenObject.parent)
+
+        global_matrix_inv = global_matrix.inverted()
+
+        batches = {}  # (mat, image, cell, layer counts, group names): [(snapshot, transform), ...]
+        batch_sources = {}  # same keys: [my_mesh, ...]
+        meshes_kept = []
+        for my_mesh in ob_meshes:
+            ob = my_mesh.blenObject
+            snapshot = my_mesh.meshSnapshot
+            if (my_mesh.fbxArm or ob.parent or ob in parents or len(ob.constraints) or not snapshot.face_count or
+                    (ob.animation_data and ob.animation_data.action)):
+                meshes_kept.append(my_mesh)
+                continue
+
+            # bake the world matrix, without the axis conversion the batch model keeps
+            mtx = global_matrix_inv * my_mesh.matrixWorld
+            origin = mtx * Vector((0.0, 0.0, 0.0))
+            transform = tuple((mtx * Vector(axis) - origin)[:] for axis in ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)))
+            transform += (origin[:],)
+
+            cell = batch_cell(snapshot_center(snapshot, transform), static_batch_cell_size)
+            layout = len(snapshot.uv_layers), len(snapshot.color_layers)
+            # objects only merge with others in the same groups, the batch takes their groups
+            group_names = tuple(sorted(group.name for group in ob.users_group))
+
+            key_faces = {}
+            for f, mat_tex_pair in enumerate(face_material_keys(snapshot, my_mesh.blenMaterialList)):
+                key_faces.setdefault(mat_tex_pair, []).append(f)
+
+            for (mat, tex), faces in key_faces.items():
+                part_snapshot = snapshot if len(key_faces) == 1 else snapshot.subset(faces)
+                batch_key = mat, tex, cell, layout, group_names
+                batches.setdefault(batch_key, []).append((part_snapshot, transform))
+                batch_sources.setdefault(batch_key, []).append(my_mesh)
+
+        if not batches:
+            return
+
+        # sort the keys so we get predictable names
+        batch_keys = list(batches.keys())
+        batch_keys.sort(key=lambda k: (getattr(k[0], "name", ""), getattr(k[1], "name", ""), k[2] or (), k[3], k[4]))
+
+        meshes_batched = []
+        for batch_key in batch_keys:
+            mat, tex, cell, layout, group_names = batch_key
+            sources = batch_sources[batch_key]
+
+            snapshot = merge_snapshots(batches[batch_key])
+            snapshot.face_materials = [0] * snapshot.face_count
+
+            name = "batch_%s" % getattr(mat, "name", "none")
+            if cell is not None:
+                name += "_%d_%d_%d" % cell
+
+            # blenObject is only kept for its settings, a batch is no stand-in for the objects
+            # it merges, see the blenObject -> fbxObject mapping
+            my_batch = my_object_generic(sources[0].blenObject, Matrix(), name)
+            my_batch.blenData = sources[0].blenData
+            my_batch.origData = sources[0].origData
+            my_batch.meshSnapshot = snapshot
+            my_batch.blenMaterials = [(mat, tex)]
+            my_batch.blenMaterialList = [mat]
+            my_batch.blenTextures = [tex] if tex else []
+            my_batch.fbxBoneParent = None
+            my_batch.fbxBatch = sources
+            meshes_batched.append(my_batch)
+
+        print('	static batching: %d meshes merged into %d' %
+              (len(ob_meshes) - len(meshes_kept), len(meshes_batched)))
+
+        ob_meshes[:] = meshes_kept + meshes_batched
+
+    def mesh_parts(my_mesh, part_snapshots):
+        '''
+        Return an object for each part snapshot of my_mesh, my_mesh is the first part.
+        '''
+        my_parts = [my_mesh]
+        my_mesh.meshSnapshot = part_snapshots[0]
+        for part_snapshot in part_snapshots[1:]:
+            my_part = my_object_generic(my_mesh.blenObject)
+            my_part.matrixWorld = my_mesh.matrixWorld
+            my_part.fbxGroupNames = my_mesh.fbxGroupNames  # shared, groups are added to one of the parts
+            for attr in ("blenData", "origData", "blenMaterials", "blenMaterialList", "blenTextures",
+                         "fbxArm", "fbxBoneParent", "fbxBonePalette", "fbxBatch"):
+                setattr(my_part, attr, getattr(my_mesh, attr))
+            my_part.meshSnapshot = part_snapshot
+            my_parts.append(my_part)
+        return my_parts
+
+    def mesh_bone_palette_parts(my_mesh):
+        '''
+        Return my_mesh split into parts deformed by at most bone_palette_size bones,
+        my_mesh is the first part.
+        '''
+        my_arm = scene_index.get_object(my_mesh.fbxArm)
+        deform_bones = [my_bone for my_bone in my_arm.fbxBones if my_bone.blenBone.use_deform]
+        if len(deform_bones) <= bone_palette_size:
+            return [my_mesh]
+
+        snapshot = my_mesh.meshSnapshot
+        parts = bone_palette_parts.get(snapshot)
+        if parts is None:
+            weights = mesh_vertex_weights(my_mesh.blenObject, my_mesh.blenData)
+            bone_index = dict((my_bone.blenName, i) for i, my_bone in enumerate(deform_bones))
+            group_bones = [bone_index.get(name) for name in weights.group_names]
+
+            parts = partition_mesh(snapshot, weights, group_bones, bone_palette_size)
+            if len(parts) == 1:
+                parts = [(snapshot, parts[0][1])]
+            else:
+                parts = [(snapshot.subset(faces), bones) for faces, bones in parts]
+            bone_palette_parts[snapshot] = parts
+
+            print('\tmesh "%s": %d bones, %d parts using %s bones' %
+                  (my_mesh.blenObject.name, len(deform_bones), len(parts), ", ".join(str(len(bones)) for part, bones in parts)))
+
+        my_parts = mesh_parts(my_mesh, [part_snapshot for part_snapshot, bones in parts])
+        for my_part, (part_snapshot, bones) in zip(my_parts, parts):
+            my_part.fbxBonePalette = set(deform_bones[i] for i in bones)
+
+        return my_parts
+
+    def mesh_chunk_parts(my_mesh):
+        '''
+        Return my_mesh split into chunks of at most mesh_vertex_limit vertices,
+        my_mesh is the first chunk.
+        '''
+        snapshot = my_mesh.meshSnapshot
+        chunks = mesh_chunks.get(snapshot)
+        if chunks is None:
+            faces_chunks = chunk_mesh(snapshot, mesh_vertex_limit)
+            if len(faces_chunks) == 1:
+                chunks = [snapshot]
+            else:
+                chunks = [snapshot.subset(faces) for faces in faces_chunks]
+                print('\tmesh "%s": %d faces, split into %d chunks of at most %d vertices' %
+                      (my_mesh.blenObject.name, snapshot.face_count, len(chunks), mesh_vertex_limit))
+            mesh_chunks[snapshot] = chunks
+
+        return mesh_parts(my_mesh, chunks)
+
+    # materials differing only by name, each would be its own render state
+    if use_material_merge:
+        merge_identical_materials()
+
+    # merge meshes that never move, so the game draws each material once
+    if use_static_batch:
+        static_batch_meshes()
+
+    # split skinned meshes deformed by more bones than a draw can use (72 for XNA's SkinnedEffect)
+    if bone_palette_size:
+        bone_palette_parts = {}  # snapshot: [(part snapshot, bones), ...], for meshes shared by objects
+        ob_meshes_split = []
+        for my_mesh in ob_meshes:
+            if my_mesh.fbxArm and not my_mesh.fbxBoneParent:
+                ob_meshes_split += mesh_bone_palette_parts(my_mesh)
+            else:
+                ob_meshes_split.append(my_mesh)
+        ob_meshes[:] = ob_meshes_split
+        del ob_meshes_split
+
+    # split meshes with more vertices than 16 bit indices reach (65535 for XNA's Reach profile)
+    if mesh_vertex_limit:
+        mesh_chunks = {}  # snapshot: [chunk snapshot, ...], for meshes shared by objects
+        ob_meshes_split = []
+        for my_mesh in ob_meshes:
+            ob_meshes_split += mesh_chunk_parts(my_mesh)
+        ob_meshes[:] = ob_meshes_split
+        del ob_meshes_split
+
+    # add the meshes to the bones and replace the meshes armature with own armature class
+    #for obname, ob, mtx, me, mats, arm, armname in ob_meshes:
+    for my_mesh in ob_meshes:
+        if my_mesh.fbxArm:
+            # Replace
+            my_mesh.fbxArm = my_arm = scene_index.get_object(my_mesh.fbxArm)
+
+            # The mesh uses this armatures bones!
+            for my_bone in my_arm.fbxBones:
+                if my_bone.blenBone.use_deform and (my_mesh.fbxBonePalette is None or my_bone in my_mesh.fbxBonePalette):
+                    my_bone.blenMeshes[my_mesh.fbxName] = my_mesh
+                    scene_index.add_mesh_bone(my_mesh, my_bone)
+
+            # parent bone: replace bone names with our class instances
+            # my_mesh.fbxBoneParent is None or a blender bone name initialy, replacing if the names match.
+            if my_mesh.fbxBoneParent:
+                my_mesh.fbxBoneParent = scene_index.get_bone(my_arm.blenObject, my_mesh.fbxBoneParent, my_mesh.fbxBoneParent)
+
+    def prune_bones():
+        '''
+        Remove the bones that deform no exported mesh from ob_bones and the armatures,
+        keeping the parents of kept bones, bones meshes are parented to
+        and (with use_bone_prune_keep_animated) bones the exported actions animate.
+        '''
+        arm_keep = dict((my_arm, set()) for my_arm in ob_arms)  # my_arm: bone names kept
+        for my_mesh in ob_meshes:
+            if my_mesh.fbxArm and my_mesh.fbxBoneParent:
+                arm_keep[my_mesh.fbxArm].add(getattr(my_mesh.fbxBoneParent, "blenName", my_mesh.fbxBoneParent))
+
+        bone_pruned_count = 0
+        for my_arm in ob_arms:
+            keep = arm_keep[my_arm]
+
+            if use_anim and use_bone_prune_keep_animated:
+                if use_anim_action_all:
+                    actions = bpy.data.actions[:]
+                else:
+                    actions = [my_arm.blenAction] if my_arm.blenAction else []
+                for action in actions:
+                    keep.update(action_bone_names(action))
+
+            for my_bone in my_arm.fbxBones:
+                if my_bone.blenMeshes:
+                    keep.add(my_bone.blenName)
+
+            # the parents of kept bones, so the kept bones keep their place
+            for my_bone in my_arm.fbxBones:
+                if my_bone.blenName in keep:
+                    bone = my_bone.blenBone.parent
+                    while bone and bone.name not in keep:
+                        keep.add(bone.name)
+                        bone = bone.parent
+
+            bones_pruned = [my_bone.blenName for my_bone in my_arm.fbxBones if my_bone.blenName not in keep]
+            if bones_pruned:
+                my_arm.fbxBones = [my_bone for my_bone in my_arm.fbxBones if my_bone.blenName in keep]
+                bone_pruned_count += len(bones_pruned)
+                print('	armature "%s": pruned %d of %d bones, %s' %
+                      (my_arm.blenObject.name, len(bones_pruned), len(bones_pruned) + len(my_arm.fbxBones), ", ".join(bones_pruned)))
+
+        if bone_pruned_count:
+            ob_bones[:] = [my_bone for my_arm in ob_arms for my_bone in my_arm.fbxBones]
+
+    # bones that no mesh uses (IK targets, poles, controls)
+    if use_bone_prune:
+        prune_bones()
+
+    # how many objects use each shared snapshot, the geometry text is kept until the last is written
+    mesh_instance_users = {}
+    mesh_geometry_texts = {}
+    if mesh_instances:
+        for my_mesh in ob_meshes:
+            mesh_instance_users[my_mesh.meshSnapshot] = mesh_instance_users.get(my_mesh.meshSnapshot, 0) + 1
+        print('\t%d mesh objects share %d evaluated meshes' % (sum(mesh_instance_users.values()), len(mesh_instances)))
+
+    bone_deformer_count = 0  # count how many bones deform a mesh
+    my_bone_blenParent = None
+    for my_bone in ob_bones:
+        my_bone_blenParent = my_bone.blenBone.parent
+        if my_bone_blenParent:
+            my_bone.parent = scene_index.get_bone(my_bone.fbxArm.blenObject, my_bone_blenParent.name)
+
+        # Not used at the moment
+        # my_bone.calcRestMatrixLocal()
+        bone_deformer_count += len(my_bone.blenMeshes)
+
+    del my_bone_blenParent
+
+    # Build blenObject -> fbxObject mapping
+    # this is needed for groups as well as fbxParenting
+    bpy.data.objects.tag(False)
+
+    # using a list of object names for tagging (Arystan)
+
+    # static batches merge many objects, they have no blender object of their own
+    # and are never parents, they are in the groups all their objects are in
+    group_batches = {}  # group: [batch, ...]
+    for ob_generic in ob_all_typegroups:
         for ob_base in ob_generic:
+            if ob_generic is ob_meshes and ob_base.fbxBatch:
+                for blenGroup in ob_base.fbxBatch[0].blenObject.users_group:
+                    group_batches.setdefault(blenGroup, []).append(ob_base)
+                continue
             ob_base.blenObject.tag = True
-            tmp_obmapping[ob_base.blenObject] = ob_base
+            scene_index.add_object(ob_base)
 
     # Build Groups from objects we export
     for blenGroup in bpy.data.groups:
         fbxGroupName = None
-        for ob in blenGroup.objects:
-            if ob.tag:
-                if fbxGroupName is None:
-                    fbxGroupName = sane_groupname(blenGroup)
-                    groups.append((fbxGroupName, blenGroup))
+        my_members = [scene_index.get_object(ob) for ob in blenGroup.objects if ob.tag]
+        my_members += group_batches.get(blenGroup, [])
+        for my_ob in my_members:
+            if fbxGroupName is None:
+                fbxGroupName = sane_groupname(blenGroup)
+                groups.append((fbxGroupName, blenGroup))
 
-                tmp_obmapping[ob].fbxGroupNames.append(fbxGroupName)  # also adds to the objects fbxGroupNames
+            if fbxGroupName not in my_ob.fbxGroupNames:  # parts of a split mesh share the list
+                my_ob.fbxGroupNames.append(fbxGroupName)  # also adds to the objects fbxGroupNames
 
     groups.sort()  # not really needed
 
     # Assign parents using this mapping
     for ob_generic in ob_all_typegroups:
         for my_ob in ob_generic:
+            if ob_generic is ob_meshes and my_ob.fbxBatch:
+                continue
             parent = my_ob.blenObject.parent
             if parent and parent.tag:  # does it exist and is it in the mapping
-                my_ob.fbxParent = tmp_obmapping[parent]
-
-    del tmp_obmapping
+                my_ob.fbxParent = scene_index.get_object(parent)
     # Finished finding groups we use
     
     # == WRITE OBJECTS TO THE FILE ==
@@ -2105,6 +2323,599 @@ def save_single(operator, scene, filepath="",
         import traceback
         traceback.print_exc()
 
+    # Needed for scene footer as well as animation
+    render = scene.render
+
+    # from the FBX sdk
+    #define KTIME_ONE_SECOND        KTime (K_LONGLONG(46186158000))
+    def fbx_time(t):
+        # 0.5 + val is the same as rounding.
+        return int(0.5 + ((t / fps) * 46186158000))
+
+    fps = float(render.fps)
+    start = scene.frame_start
+    end = scene.frame_end
+    if end < start:
+        start, end = end, start
+
+    # comment the following line, otherwise we dont get the pose
+    # if start==end: use_anim = False
+
+    # animations for these object types
+    ob_anim_lists = ob_bones, ob_meshes, ob_null, ob_cameras, ob_lights, ob_arms
+
+    if use_anim_optimize:
+        ANIM_OPTIMIZE_PRECISSION_FLOAT = 0.1 ** anim_optimize_precision
+
+    # --------------- funcs for sampling animation, used by all writers
+    def anim_collect_actions():
+        '''
+        Return (take_actions, blenActionDefault),
+        None in take_actions is the default take.
+        '''
+        # default action, when no actions are avaioable
+        tmp_actions = []
+        blenActionDefault = None
+        action_lastcompat = None
+
+        # instead of tagging
+        tagged_actions = []
+
+        # get the current action first so we can use it if we only export one action (JCB)
+        for my_arm in ob_arms:
+            if not blenActionDefault:
+                blenActionDefault = my_arm.blenAction
+                if blenActionDefault:
+                    break
+
+        if use_anim_action_all:
+            tmp_actions = bpy.data.actions[:]
+        elif not use_default_take:
+            if blenActionDefault:
+                # Export the current action (JCB)
+                tmp_actions.append(blenActionDefault)
+
+        if tmp_actions:
+            # find which actions are compatible with the armatures
+            tmp_act_count = 0
+            for my_arm in ob_arms:
+
+                arm_bone_names = set([my_bone.blenName for my_bone in my_arm.fbxBones])
+
+                for action in tmp_actions:
+
+                    action_chan_names = arm_bone_names.intersection(set([g.name for g in action.groups]))
+
+                    if action_chan_names:  # at least one channel matches.
+                        my_arm.blenActionList.append(action)
+                        tagged_actions.append(action.name)
+                        tmp_act_count += 1
+
+                        # incase there are no actions applied to armatures
+                        # for example, when a user deletes the current action.
+                        action_lastcompat = action
+
+            if tmp_act_count:
+                # unlikely to ever happen but if no actions applied to armatures, just use the last compatible armature.
+                if not blenActionDefault:
+                    blenActionDefault = action_lastcompat
+
+        del action_lastcompat
+
+        if use_default_take:
+            tmp_actions.insert(0, None)  # None is the default action
+
+        # we have tagged all actious that are used be selected armatures
+        take_actions = []
+        for blenAction in tmp_actions:
+            if blenAction and blenAction.name not in tagged_actions:
+                print('\taction: "%s" has no armature using it, skipping' % blenAction.name)
+            else:
+                take_actions.append(blenAction)
+
+        return take_actions, blenActionDefault
+
+    def anim_take_name(blenAction):
+        '''
+        Return the take name for the action, names are given out in the order takes are written.
+        '''
+        if blenAction is None:
+            return "Default Take"
+
+        # use existing name
+        take_name = names.get('TAKE', blenAction.name)
+        if take_name is None:
+            take_name = sane_takename(blenAction)
+        return take_name
+
+    def anim_take_frame_range(blenAction):
+        if blenAction is None:
+            # Warning, this only accounts for tmp_actions being [None]
+            return start, end
+
+        act_start, act_end = blenAction.frame_range
+        return int(act_start), int(act_end)
+
+    def anim_take_begin(blenAction):
+        '''
+        Make the action active on its armatures, return (take_name, act_start, act_end)
+        '''
+        take_name = anim_take_name(blenAction)
+        act_start, act_end = anim_take_frame_range(blenAction)
+
+        # every take starts from the pose the export started with, so a take doesn't
+        # depend on which of the takes before it were sampled or read from the cache
+        for my_arm in ob_arms:
+            if my_arm.blenObject not in anim_take_pose_orig:
+                anim_take_pose_orig[my_arm.blenObject] = armature_pose_values(my_arm.blenObject)
+
+        if blenAction is not None:
+            print('\taction: "%s" exporting...' % blenAction.name)
+
+            # Set the action active
+            for my_arm in ob_arms:
+                if my_arm.blenObject.animation_data and blenAction in my_arm.blenActionList:
+                    my_arm.blenObject.animation_data.action = blenAction
+
+        if use_anim_channel_prune:
+            for my_arm in ob_arms:
+                anim_take_bones_skipped.update(anim_take_static_bones(my_arm))
+            if anim_take_bones_skipped:
+                print('\t\t%d of %d bones not animated, left out of the take' % (len(anim_take_bones_skipped), len(ob_bones)))
+
+        return take_name, act_start, act_end
+
+    # bones the take being written leaves in their rest pose, they get no curves (the bind pose is used)
+    anim_take_bones_skipped = set()
+
+    # armature object: pose values before the first take, restored after every take
+    anim_take_pose_orig = {}
+
+    def anim_take_static_bones(my_arm):
+        '''
+        Return the bones of my_arm that stay in their rest pose while its action plays,
+        the bones its action animates, bones posed away from rest and all their parents are kept.
+        '''
+        ob = my_arm.blenObject
+        if armature_unsupported(ob):
+            # constraints, drivers... can move any bone
+            return []
+
+        animated = set()
+        action = ob.animation_data.action if ob.animation_data else None
+        if action:
+            animated.update(action_bone_names(action))
+            animated.update(group.name for group in action.groups)
+
+        pose_bones = ob.pose.bones
+        keep = set()
+        for my_bone in my_arm.fbxBones:
+            if my_bone.blenName in animated or not pose_bone_at_rest(pose_bones[my_bone.blenName]):
+                bone = my_bone.blenBone
+                while bone and bone.name not in keep:
+                    keep.add(bone.name)
+                    bone = bone.parent
+
+        return [my_bone for my_bone in my_arm.fbxBones if my_bone.blenName not in keep]
+
+    def anim_take_sample(act_start, act_end):
+        # set pose data for all bones
+        # do this here incase the action changes
+        for ob_generic in ob_anim_lists:
+            for my_ob in ob_generic:
+                my_ob.flushAnimData()
+
+        samplers = None
+        if use_anim_fcurve_sampling:
+            samplers = anim_fcurve_samplers()
+
+        i = act_start
+        while i <= act_end:
+            if samplers is None:
+                scene.frame_set(i)
+            else:
+                for my_arm, sampler in samplers:
+                    pose_mats = sampler.evaluate(i)
+                    for my_bone in my_arm.fbxBones:
+                        if my_bone not in anim_take_bones_skipped:
+                            my_bone.setPoseFrame(i, pose_mats[my_bone.blenName])
+
+            for ob_generic in ob_anim_lists:
+                if samplers is not None and ob_generic is ob_bones:
+                    continue  # set above
+
+                for my_ob in ob_generic:
+                    #Blender.Window.RedrawAll()
+                    if my_ob in anim_take_bones_skipped:
+                        continue
+                    elif ob_generic is ob_meshes and (my_ob.fbxArm or my_ob.fbxBatch):
+                        # We cant animate armature meshes! (or batches, their transforms are in the vertices)
+                        my_ob.setPoseFrame(i, fake=True)
+                    else:
+                        my_ob.setPoseFrame(i)
+
+            i += 1
+
+    def anim_fcurve_samplers():
+        '''
+        Return [(my_arm, sampler), ...] when the only animation is the armature actions,
+        so poses can be read from the F-Curves. Otherwise None, the scene must be set every frame.
+        '''
+        reason = anim_actions_only_reason()
+        if reason:
+            print('\t\tsampling by setting the frame, %s' % reason)
+            return None
+
+        samplers = []
+        for my_arm in ob_arms:
+            anim_data = my_arm.blenObject.animation_data
+            samplers.append((my_arm, ArmatureSampler(my_arm.blenObject, anim_data.action if anim_data else None)))
+
+        print('\t\tsampling F-Curves')
+        return samplers
+
+    def anim_actions_only_reason():
+        '''
+        Return why the motion depends on more than the armature actions, or None.
+        '''
+        render = scene.render
+        if render.frame_map_old != render.frame_map_new:
+            return "time remapping"
+
+        for ob_generic in (ob_meshes, ob_null, ob_cameras, ob_lights, ob_arms):
+            for my_ob in ob_generic:
+                if not (ob_generic is ob_meshes and (my_ob.fbxArm or my_ob.fbxBatch)):
+                    reason = object_transform_unsupported(my_ob.blenObject)
+                    if reason:
+                        return reason
+
+        for my_arm in ob_arms:
+            reason = armature_unsupported(my_arm.blenObject)
+            if reason:
+                return reason
+
+        return None
+
+    def anim_take_cache_key(take_name, act_start, act_end):
+        '''
+        Return the values a take depends on (call after anim_take_begin),
+        None when it can't be cached because more than the actions animate the scene.
+        '''
+        if export_cache is None:
+            return None
+
+        reason = anim_actions_only_reason()
+        if reason:
+            print('\t\tnot cached, %s' % reason)
+            return None
+
+        key = ["Take", take_name, act_start, act_end, fps, start,
+               use_anim_optimize, anim_optimize_precision, use_anim_fcurve_sampling,
+               matrix_flat(global_matrix), matrix_flat(mtx4_z90),
+               ]
+
+        # the actions playing during this take, with the rest and pose values they start from
+        for my_arm in ob_arms:
+            ob = my_arm.blenObject
+            key += [my_arm.fbxName, matrix_flat(ob.matrix_world)]
+            action = ob.animation_data.action if ob.animation_data else None
+            key += action_key(action)
+            key += armature_pose_key(ob, action_pose_channels(action))
+
+        # everything else is static, checked above
+        for my_ob in anim_objects():
+            key.append(my_ob.fbxName)
+            if not isinstance(my_ob, my_bone_class):
+                key += [matrix_flat(my_ob.matrixWorld), matrix_flat(my_ob.blenObject.matrix_world),
+                        my_ob.fbxParent.fbxName if my_ob.fbxParent else None]
+
+        return key
+
+    def anim_take_end():
+        # end action loop. set original actions
+        # do this after every loop incase actions effect eachother.
+        for my_arm in ob_arms:
+            if my_arm.blenObject.animation_data:
+                my_arm.blenObject.animation_data.action = my_arm.blenAction
+            if my_arm.blenObject in anim_take_pose_orig:
+                armature_pose_set(my_arm.blenObject, anim_take_pose_orig[my_arm.blenObject])
+
+        anim_take_bones_skipped.clear()
+
+        if anim_optimize_report:
+            anim_optimize_print_report()
+
+    def anim_objects():
+        '''
+        Objects written with animation curves in every take, in write order
+        '''
+        for ob_generic in (ob_bones, ob_meshes, ob_null, ob_cameras, ob_lights, ob_arms):
+            for my_ob in ob_generic:
+                # do nothing for armature meshes, static batches and bones the take leaves at rest
+                if not (ob_generic is ob_meshes and (my_ob.fbxArm or my_ob.fbxBatch)) and my_ob not in anim_take_bones_skipped:
+                    yield my_ob
+
+    def anim_object_channels(my_ob, act_start, act_end):
+        '''
+        Return the translation, rotation (in degrees) and scale of the sampled frames,
+        each is a list of per axis arrays with a value for every frame.
+        '''
+        return matrices_to_trs(my_ob.getAnimParRelMatrices(act_start, act_end))
+
+    # (fbxName, channel, keys removed, key count) for the take being written
+    anim_optimize_report = []
+
+    def anim_optimize_keys(values, fbxName, channel):
+        '''
+        Remove keys that are linear with their neighbours (within ANIM_OPTIMIZE_PRECISSION_FLOAT),
+        return a list of (value, frame_offset) pairs for the keys left.
+        '''
+        kept = reduce_keys(values, ANIM_OPTIMIZE_PRECISSION_FLOAT)
+        anim_optimize_report.append((fbxName, channel, len(values) - len(kept), len(values)))
+        return [(values[j], j) for j in kept]
+
+    def anim_optimize_print_report():
+        # one line for each object
+        ob_channels = {}
+        ob_names = []
+        for fbxName, channel, removed, tot in anim_optimize_report:
+            channels = ob_channels.get(fbxName)
+            if channels is None:
+                channels = ob_channels[fbxName] = []
+                ob_names.append(fbxName)
+            channels.append("%s %i/%i" % (channel, removed, tot))
+
+        for fbxName in ob_names:
+            print('\t\tkeys removed, "%s": %s' % (fbxName, ", ".join(ob_channels[fbxName])))
+
+        anim_optimize_report[:] = []
+
+    def export_finish():
+        # Clear mesh data Only when writing with modifiers applied
+        for me in meshes_to_clear:
+            bpy.data.meshes.remove(me)
+
+        ob_arms[:] = []
+        ob_bones[:] = []
+        ob_cameras[:] = []
+        ob_lights[:] = []
+        ob_meshes[:] = []
+        ob_null[:] = []
+
+        file.close()
+
+        if export_cache is not None:
+            export_cache.report()
+
+        # wait for the images still copying.
+        texture_deploy.finish()
+
+        print('export finished in %.4f sec.' % (time.clock() - start_time))
+
+    if export_format == 'BINARY':
+        from . import export_fbx_bin
+
+        export_fbx_bin.write_binary(file, export_fbx_bin.FBXExportData(
+                scene=scene,
+                curtime=curtime,
+                fps=fps,
+                start=start,
+                end=end,
+                fbx_time=fbx_time,
+                world_amb=world_amb,
+                object_types=object_types,
+                mesh_smooth_type=mesh_smooth_type,
+                use_mesh_edges=use_mesh_edges,
+                use_color_quantize=use_color_quantize,
+                use_anim=(use_anim and bool([tmp for tmp in ob_anim_lists if tmp])),
+                use_anim_optimize=use_anim_optimize,
+                use_default_take=use_default_take,
+                ob_meshes=ob_meshes,
+                ob_bones=ob_bones,
+                ob_arms=ob_arms,
+                ob_null=ob_null,
+                ob_cameras=ob_cameras,
+                ob_lights=ob_lights,
+                materials=materials,
+                textures=textures,
+                object_tx=object_tx,
+                get_constraints=get_constraints,
+                get_light_props=get_light_props,
+                get_material_props=get_material_props,
+                get_texture_path=get_texture_path,
+                get_cluster_weights=get_cluster_weights,
+                get_cluster_matrix=get_cluster_matrix,
+                anim_collect_actions=anim_collect_actions,
+                anim_take_begin=anim_take_begin,
+                anim_take_sample=anim_take_sample,
+                anim_take_end=anim_take_end,
+                anim_objects=anim_objects,
+                anim_object_channels=anim_object_channels,
+                anim_optimize_keys=anim_optimize_keys,
+                sane_takename=sane_takename,
+                scene_index=scene_index,
+                ))
+
+        export_finish()
+        return {'FINISHED'}
+
+    use_takes = use_anim and bool([tmp for tmp in ob_anim_lists if tmp])
+
+    if use_takes:
+        take_actions, blenActionDefault = anim_collect_actions()
+
+    if use_takes and take_workers is not None:
+        # start the workers first, they write the takes while this process writes the rest
+        if len(take_actions) > 1:
+            take_jobs = []
+            for blenAction in take_actions:
+                act_start, act_end = anim_take_frame_range(blenAction)
+                take_jobs.append((getattr(blenAction, "name", None), act_end - act_start + 1))
+            take_workers.start(take_jobs)
+
+    def write_take(take_name, act_start, act_end):
+        # Use the action name as the take name and the take filename (JCB)
+        fw('\n\tTake: "%s" {' % take_name)
+        fw('\n\t\tFileName: "%s.tak"' % take_name.replace(" ", "_"))
+        fw('\n\t\tLocalTime: %i,%i' % (fbx_time(act_start - 1), fbx_time(act_end - 1)))  # ??? - not sure why this is needed
+        fw('\n\t\tReferenceTime: %i,%i' % (fbx_time(act_start - 1), fbx_time(act_end - 1)))  # ??? - not sure why this is needed
+
+        fw('''
+
+		;Models animation
+		;----------------------------------------------------''')
+
+        anim_take_sample(act_start, act_end)
+
+        #for bonename, bone, obname, me, armob in ob_bones:
+        for my_ob in anim_objects():
+
+            fw('\n\t\tModel: "Model::%s" {' % my_ob.fbxName)  # ??? - not sure why this is needed
+            fw('\n\t\t\tVersion: 1.1')
+            fw('\n\t\t\tChannel: "Transform" {')
+
+            anim_channels = anim_object_channels(my_ob, act_start, act_end)
+
+            # ----------------
+            # ----------------
+            for TX_LAYER, TX_CHAN in enumerate('TRS'):  # transform, rotate, scale
+
+                context_bone_anim_vecs = anim_channels[TX_LAYER]
+
+                fw('\n\t\t\t\tChannel: "%s" {' % TX_CHAN)  # translation
+
+                for i in range(3):
+                    context_bone_anim_values = context_bone_anim_vecs[i]
+
+                    # Loop on each axis of the bone
+                    fw('\n\t\t\t\t\tChannel: "%s" {' % ('XYZ'[i]))  # translation
+                    fw('\n\t\t\t\t\t\tDefault: %.15f' % context_bone_anim_values[0])
+                    fw('\n\t\t\t\t\t\tKeyVer: 4005')
+
+                    if not use_anim_optimize:
+                        # Just write all frames, simple but in-eficient
+                        fw('\n\t\t\t\t\t\tKeyCount: %i' % (1 + act_end - act_start))
+                        fw('\n\t\t\t\t\t\tKey: ')
+                        frame = act_start
+                        while frame <= act_end:
+                            if frame != act_start:
+                                fw(',')
+
+                            # Curve types are 'C,n' for constant, 'L' for linear
+                            # C,n is for bezier? - linear is best for now so we can do simple keyframe removal
+                            fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(frame - 1), context_bone_anim_values[frame - act_start]))
+                            frame += 1
+                    else:
+                        # remove unneeded keys, j is the frame, needed when some frames are removed.
+                        context_bone_anim_keys = anim_optimize_keys(context_bone_anim_values, my_ob.fbxName, TX_CHAN + 'XYZ'[i])
+
+                        if len(context_bone_anim_keys) == 2 and context_bone_anim_keys[0][0] == context_bone_anim_keys[1][0]:
+
+                            # This axis has no moton, its okay to skip KeyCount and Keys in this case
+                            # pass
+
+                            # better write one, otherwise we loose poses with no animation
+                            fw('\n\t\t\t\t\t\tKeyCount: 1')
+                            fw('\n\t\t\t\t\t\tKey: ')
+                            fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(start), context_bone_anim_keys[0][0]))
+                        else:
+                            # We only need to write these if there is at least one
+                            fw('\n\t\t\t\t\t\tKeyCount: %i' % len(context_bone_anim_keys))
+                            fw('\n\t\t\t\t\t\tKey: ')
+                            for val, frame in context_bone_anim_keys:
+                                if frame != context_bone_anim_keys[0][1]:  # not the first
+                                    fw(',')
+                                # frame is already one less then blenders frame
+                                fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(frame), val))
+
+                    if i == 0:
+                        fw('\n\t\t\t\t\t\tColor: 1,0,0')
+                    elif i == 1:
+                        fw('\n\t\t\t\t\t\tColor: 0,1,0')
+                    elif i == 2:
+                        fw('\n\t\t\t\t\t\tColor: 0,0,1')
+
+                    fw('\n\t\t\t\t\t}')
+                fw('\n\t\t\t\t\tLayerType: %i' % (TX_LAYER + 1))
+                fw('\n\t\t\t\t}')
+
+            # ---------------
+
+            fw('\n\t\t\t}')
+            fw('\n\t\t}')
+
+        # end the take
+        fw('\n\t}')
+
+    def write_takes():
+        if use_takes:
+
+            frame_orig = scene.frame_current
+
+            take_fragments = {}
+            if take_workers is not None:
+                take_fragments = take_workers.collect()
+
+            if take_shard is not None and [getattr(blenAction, "name", None) for blenAction in take_actions] != take_shard.action_names:
+                operator.report({'ERROR'}, "Takes differ from the exporting process, none written")
+                take_shard.indices.clear()
+
+            fw('''
+;Takes and animation section
+;----------------------------------------------------
+
+Takes:  {''')
+
+            if blenActionDefault and not use_default_take:
+                fw('\n\tCurrent: "%s"' % sane_takename(blenActionDefault))
+            else:
+                fw('\n\tCurrent: "Default Take"')
+
+            for i, blenAction in enumerate(take_actions):
+                if take_shard is not None and i not in take_shard.indices:
+                    # written by another worker, keep the take names in step
+                    anim_take_name(blenAction)
+                    continue
+
+                if i in take_fragments:
+                    anim_take_name(blenAction)
+                    fw(take_fragments[i])
+                    continue
+
+                if take_shard is not None:
+                    file.capture_begin()
+
+                take_name, act_start, act_end = anim_take_begin(blenAction)
+
+                write_cached(anim_take_cache_key(take_name, act_start, act_end),
+                             write_take, take_name, act_start, act_end)
+
+                anim_take_end()
+
+                if take_shard is not None:
+                    take_shard.fragments[i] = file.capture_end()
+
+            fw('\n}')
+
+            scene.frame_set(frame_orig)
+
+        else:
+            # no animation
+            fw('\n;Takes and animation section')
+            fw('\n;----------------------------------------------------')
+            fw('\n')
+            fw('\nTakes:  {')
+            fw('\n\tCurrent: ""')
+            fw('\n}')
+
+    if take_shard is not None:
+        # a take worker keeps only the text of its takes, the objects would be written for nothing
+        write_takes()
+        export_finish()
+        return {'FINISHED'}
+
+    write_header()
+
     fw('''
 
 ; Object definitions
@@ -2255,12 +3066,11 @@ Objects:  {''')
             if my_mesh.fbxBoneParent:
                 weights = None
             else:
-                weights = meshNormalizedWeights(my_mesh.blenObject, my_mesh.blenData)
+                weights = mesh_vertex_weights(my_mesh.blenObject, my_mesh.blenData)
 
             #for bonename, bone, obname, bone_mesh, armob in ob_bones:
-            for my_bone in ob_bones:
-                if me in iter(my_bone.blenMeshes.values()):
-                    write_sub_deformer_skin(my_mesh, my_bone, weights)
+            for my_bone in scene_index.get_mesh_bones(my_mesh):
+                write_sub_deformer_skin(my_mesh, my_bone, weights)
 
     # Write pose is really weird, only needed when an armature and mesh are used together
     # each by themselves do not need pose data. For now only pose meshes and bones
@@ -2403,7 +3213,7 @@ Connections:  {''')
                 mat_name = mat.name if mat else None
                 tex_name = tex.name if tex else None
 
-                fw('\n\tConnect: "OO", "Material::%s", "Model::%s"' % (sane_name_mapping_mat[mat_name, tex_name], my_mesh.fbxName))
+                fw('\n\tConnect: "OO", "Material::%s", "Model::%s"' % (names.get('MATERIAL', (mat_name, tex_name)), my_mesh.fbxName))
 
     if textures:
         for my_mesh in ob_meshes:
@@ -2411,7 +3221,7 @@ Connections:  {''')
                 # fw('\n\tConnect: "OO", "Texture::_empty_", "Model::%s"' % my_mesh.fbxName)
                 for tex in my_mesh.blenTextures:
                     if tex:
-                        fw('\n\tConnect: "OO", "Texture::%s", "Model::%s"' % (sane_name_mapping_tex[tex.name], my_mesh.fbxName))
+                        fw('\n\tConnect: "OO", "Texture::%s", "Model::%s"' % (names.get('TEXTURE', tex.name), my_mesh.fbxName))
 
         for texname, tex in textures:
             fw('\n\tConnect: "OO", "Video::%s", "Texture::%s"' % (texname, texname))
@@ -2453,312 +3263,7 @@ Connections:  {''')
 
     fw('\n}')
 
-    # Needed for scene footer as well as animation
-    render = scene.render
-
-    # from the FBX sdk
-    #define KTIME_ONE_SECOND        KTime (K_LONGLONG(46186158000))
-    def fbx_time(t):
-        # 0.5 + val is the same as rounding.
-        return int(0.5 + ((t / fps) * 46186158000))
-
-    fps = float(render.fps)
-    start = scene.frame_start
-    end = scene.frame_end
-    if end < start:
-        start, end = end, start
-
-    # comment the following line, otherwise we dont get the pose
-    # if start==end: use_anim = False
-
-    # animations for these object types
-    ob_anim_lists = ob_bones, ob_meshes, ob_null, ob_cameras, ob_lights, ob_arms
-
-    if use_anim and [tmp for tmp in ob_anim_lists if tmp]:
-
-        frame_orig = scene.frame_current
-
-        if use_anim_optimize:
-            ANIM_OPTIMIZE_PRECISSION_FLOAT = 0.1 ** anim_optimize_precision
-
-        # default action, when no actions are avaioable
-        tmp_actions = []
-        blenActionDefault = None
-        action_lastcompat = None
-
-        # instead of tagging
-        tagged_actions = []
-
-        # get the current action first so we can use it if we only export one action (JCB)
-        for my_arm in ob_arms:
-            if not blenActionDefault:
-                blenActionDefault = my_arm.blenAction
-                if blenActionDefault:
-                    break
-
-        if use_anim_action_all:
-            tmp_actions = bpy.data.actions[:]
-        elif not use_default_take:
-            if blenActionDefault:
-                # Export the current action (JCB)
-                tmp_actions.append(blenActionDefault)
-
-        if tmp_actions:
-            # find which actions are compatible with the armatures
-            tmp_act_count = 0
-            for my_arm in ob_arms:
-
-                arm_bone_names = set([my_bone.blenName for my_bone in my_arm.fbxBones])
-
-                for action in tmp_actions:
-
-                    action_chan_names = arm_bone_names.intersection(set([g.name for g in action.groups]))
-
-                    if action_chan_names:  # at least one channel matches.
-                        my_arm.blenActionList.append(action)
-                        tagged_actions.append(action.name)
-                        tmp_act_count += 1
-
-                        # incase there are no actions applied to armatures
-                        # for example, when a user deletes the current action.
-                        action_lastcompat = action
-
-            if tmp_act_count:
-                # unlikely to ever happen but if no actions applied to armatures, just use the last compatible armature.
-                if not blenActionDefault:
-                    blenActionDefault = action_lastcompat
-
-        del action_lastcompat
-
-        if use_default_take:
-            tmp_actions.insert(0, None)  # None is the default action
-
-        fw('''
-;Takes and animation section
-;----------------------------------------------------
-
-Takes:  {''')
-
-        if blenActionDefault and not use_default_take:
-            fw('\n\tCurrent: "%s"' % sane_takename(blenActionDefault))
-        else:
-            fw('\n\tCurrent: "Default Take"')
-
-        for blenAction in tmp_actions:
-            # we have tagged all actious that are used be selected armatures
-            if blenAction:
-                if blenAction.name in tagged_actions:
-                    print('\taction: "%s" exporting...' % blenAction.name)
-                else:
-                    print('\taction: "%s" has no armature using it, skipping' % blenAction.name)
-                    continue
-
-            if blenAction is None:
-                # Warning, this only accounts for tmp_actions being [None]
-                take_name = "Default Take"
-                act_start = start
-                act_end = end
-            else:
-                # use existing name
-                take_name = sane_name_mapping_take.get(blenAction.name)
-                if take_name is None:
-                    take_name = sane_takename(blenAction)
-
-                act_start, act_end = blenAction.frame_range
-                act_start = int(act_start)
-                act_end = int(act_end)
-
-                # Set the action active
-                for my_arm in ob_arms:
-                    if my_arm.blenObject.animation_data and blenAction in my_arm.blenActionList:
-                        my_arm.blenObject.animation_data.action = blenAction
-
-            # Use the action name as the take name and the take filename (JCB)
-            fw('\n\tTake: "%s" {' % take_name)
-            fw('\n\t\tFileName: "%s.tak"' % take_name.replace(" ", "_"))
-            fw('\n\t\tLocalTime: %i,%i' % (fbx_time(act_start - 1), fbx_time(act_end - 1)))  # ??? - not sure why this is needed
-            fw('\n\t\tReferenceTime: %i,%i' % (fbx_time(act_start - 1), fbx_time(act_end - 1)))  # ??? - not sure why this is needed
-
-            fw('''
-
-		;Models animation
-		;----------------------------------------------------''')
-
-            # set pose data for all bones
-            # do this here incase the action changes
-            '''
-            for my_bone in ob_bones:
-                my_bone.flushAnimData()
-            '''
-            i = act_start
-            while i <= act_end:
-                scene.frame_set(i)
-                for ob_generic in ob_anim_lists:
-                    for my_ob in ob_generic:
-                        #Blender.Window.RedrawAll()
-                        if ob_generic == ob_meshes and my_ob.fbxArm:
-                            # We cant animate armature meshes!
-                            my_ob.setPoseFrame(i, fake=True)
-                        else:
-                            my_ob.setPoseFrame(i)
-
-                i += 1
-
-            #for bonename, bone, obname, me, armob in ob_bones:
-            for ob_generic in (ob_bones, ob_meshes, ob_null, ob_cameras, ob_lights, ob_arms):
-
-                for my_ob in ob_generic:
-
-                    if ob_generic == ob_meshes and my_ob.fbxArm:
-                        # do nothing,
-                        pass
-                    else:
-
-                        fw('\n\t\tModel: "Model::%s" {' % my_ob.fbxName)  # ??? - not sure why this is needed
-                        fw('\n\t\t\tVersion: 1.1')
-                        fw('\n\t\t\tChannel: "Transform" {')
-
-                        context_bone_anim_mats = [(my_ob.getAnimParRelMatrix(frame), my_ob.getAnimParRelMatrixRot(frame)) for frame in range(act_start, act_end + 1)]
-
-                        # ----------------
-                        # ----------------
-                        for TX_LAYER, TX_CHAN in enumerate('TRS'):  # transform, rotate, scale
-
-                            if TX_CHAN == 'T':
-                                context_bone_anim_vecs = [mtx[0].to_translation() for mtx in context_bone_anim_mats]
-                            elif	TX_CHAN == 'S':
-                                context_bone_anim_vecs = [mtx[0].to_scale() for mtx in context_bone_anim_mats]
-                            elif	TX_CHAN == 'R':
-                                # Was....
-                                # elif 	TX_CHAN=='R':	context_bone_anim_vecs = [mtx[1].to_euler()			for mtx in context_bone_anim_mats]
-                                #
-                                # ...but we need to use the previous euler for compatible conversion.
-                                context_bone_anim_vecs = []
-                                prev_eul = None
-                                for mtx in context_bone_anim_mats:
-                                    if prev_eul:
-                                        prev_eul = mtx[1].to_euler('XYZ', prev_eul)
-                                    else:
-                                        prev_eul = mtx[1].to_euler()
-                                    context_bone_anim_vecs.append(tuple_rad_to_deg(prev_eul))
-
-                            fw('\n\t\t\t\tChannel: "%s" {' % TX_CHAN)  # translation
-
-                            for i in range(3):
-                                # Loop on each axis of the bone
-                                fw('\n\t\t\t\t\tChannel: "%s" {' % ('XYZ'[i]))  # translation
-                                fw('\n\t\t\t\t\t\tDefault: %.15f' % context_bone_anim_vecs[0][i])
-                                fw('\n\t\t\t\t\t\tKeyVer: 4005')
-
-                                if not use_anim_optimize:
-                                    # Just write all frames, simple but in-eficient
-                                    fw('\n\t\t\t\t\t\tKeyCount: %i' % (1 + act_end - act_start))
-                                    fw('\n\t\t\t\t\t\tKey: ')
-                                    frame = act_start
-                                    while frame <= act_end:
-                                        if frame != act_start:
-                                            fw(',')
-
-                                        # Curve types are 'C,n' for constant, 'L' for linear
-                                        # C,n is for bezier? - linear is best for now so we can do simple keyframe removal
-                                        fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(frame - 1), context_bone_anim_vecs[frame - act_start][i]))
-                                        frame += 1
-                                else:
-                                    # remove unneeded keys, j is the frame, needed when some frames are removed.
-                                    context_bone_anim_keys = [(vec[i], j) for j, vec in enumerate(context_bone_anim_vecs)]
-
-                                    # last frame to fisrt frame, missing 1 frame on either side.
-                                    # removeing in a backwards loop is faster
-                                    #for j in xrange( (act_end-act_start)-1, 0, -1 ):
-                                    # j = (act_end-act_start)-1
-                                    j = len(context_bone_anim_keys) - 2
-                                    while j > 0 and len(context_bone_anim_keys) > 2:
-                                        # print j, len(context_bone_anim_keys)
-                                        # Is this key the same as the ones next to it?
-
-                                        # co-linear horizontal...
-                                        if		abs(context_bone_anim_keys[j][0] - context_bone_anim_keys[j - 1][0]) < ANIM_OPTIMIZE_PRECISSION_FLOAT and \
-                                                abs(context_bone_anim_keys[j][0] - context_bone_anim_keys[j + 1][0]) < ANIM_OPTIMIZE_PRECISSION_FLOAT:
-
-                                            del context_bone_anim_keys[j]
-
-                                        else:
-                                            frame_range = float(context_bone_anim_keys[j + 1][1] - context_bone_anim_keys[j - 1][1])
-                                            frame_range_fac1 = (context_bone_anim_keys[j + 1][1] - context_bone_anim_keys[j][1]) / frame_range
-                                            frame_range_fac2 = 1.0 - frame_range_fac1
-
-                                            if abs(((context_bone_anim_keys[j - 1][0] * frame_range_fac1 + context_bone_anim_keys[j + 1][0] * frame_range_fac2)) - context_bone_anim_keys[j][0]) < ANIM_OPTIMIZE_PRECISSION_FLOAT:
-                                                del context_bone_anim_keys[j]
-                                            else:
-                                                j -= 1
-
-                                        # keep the index below the list length
-                                        if j > len(context_bone_anim_keys) - 2:
-                                            j = len(context_bone_anim_keys) - 2
-
-                                    if len(context_bone_anim_keys) == 2 and context_bone_anim_keys[0][0] == context_bone_anim_keys[1][0]:
-
-                                        # This axis has no moton, its okay to skip KeyCount and Keys in this case
-                                        # pass
-
-                                        # better write one, otherwise we loose poses with no animation
-                                        fw('\n\t\t\t\t\t\tKeyCount: 1')
-                                        fw('\n\t\t\t\t\t\tKey: ')
-                                        fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(start), context_bone_anim_keys[0][0]))
-                                    else:
-                                        # We only need to write these if there is at least one
-                                        fw('\n\t\t\t\t\t\tKeyCount: %i' % len(context_bone_anim_keys))
-                                        fw('\n\t\t\t\t\t\tKey: ')
-                                        for val, frame in context_bone_anim_keys:
-                                            if frame != context_bone_anim_keys[0][1]:  # not the first
-                                                fw(',')
-                                            # frame is already one less then blenders frame
-                                            fw('\n\t\t\t\t\t\t\t%i,%.15f,L' % (fbx_time(frame), val))
-
-                                if i == 0:
-                                    fw('\n\t\t\t\t\t\tColor: 1,0,0')
-                                elif i == 1:
-                                    fw('\n\t\t\t\t\t\tColor: 0,1,0')
-                                elif i == 2:
-                                    fw('\n\t\t\t\t\t\tColor: 0,0,1')
-
-                                fw('\n\t\t\t\t\t}')
-                            fw('\n\t\t\t\t\tLayerType: %i' % (TX_LAYER + 1))
-                            fw('\n\t\t\t\t}')
-
-                        # ---------------
-
-                        fw('\n\t\t\t}')
-                        fw('\n\t\t}')
-
-            # end the take
-            fw('\n\t}')
-
-            # end action loop. set original actions
-            # do this after every loop incase actions effect eachother.
-            for my_arm in ob_arms:
-                if my_arm.blenObject.animation_data:
-                    my_arm.blenObject.animation_data.action = my_arm.blenAction
-
-        fw('\n}')
-
-        scene.frame_set(frame_orig)
-
-    else:
-        # no animation
-        fw('\n;Takes and animation section')
-        fw('\n;----------------------------------------------------')
-        fw('\n')
-        fw('\nTakes:  {')
-        fw('\n\tCurrent: ""')
-        fw('\n}')
-
-    # write meshes animation
-    #for obname, ob, mtx, me, mats, arm, armname in ob_meshes:
-
-    # Clear mesh data Only when writing with modifiers applied
-    for me in meshes_to_clear:
-        bpy.data.meshes.remove(me)
+    write_takes()
 
     # --------------------------- Footer
     if world:
@@ -2804,30 +3309,7 @@ Takes:  {''')
     fw('\n}')
     fw('\n')
 
-    # XXX, shouldnt be global!
-    for mapping in (sane_name_mapping_ob,
-                    sane_name_mapping_ob_unique,
-                    sane_name_mapping_mat,
-                    sane_name_mapping_tex,
-                    sane_name_mapping_take,
-                    sane_name_mapping_group,
-                    ):
-        mapping.clear()
-    del mapping
-
-    ob_arms[:] = []
-    ob_bones[:] = []
-    ob_cameras[:] = []
-    ob_lights[:] = []
-    ob_meshes[:] = []
-    ob_null[:] = []
-
-    file.close()
-
-    # copy all collected files.
-    bpy_extras.io_utils.path_reference_copy(copy_set)
-
-    print('export finished in %.4f sec.' % (time.clock() - start_time))
+    export_finish()
     return {'FINISHED'}
 
 
@@ -2845,11 +3327,83 @@ def defaults_unity3d():
                 )
 
 
+def batch_filepaths(data_seq, filepath, use_batch_own_dir):
+    '''
+    Return [(data, filepath), ...], the file to write each scene or group to,
+    making the directories for them.
+    '''
+    fbxpath = filepath
+
+    prefix = os.path.basename(fbxpath)
+    if prefix:
+        fbxpath = os.path.dirname(fbxpath)
+
+    if not fbxpath.endswith(os.sep):
+        fbxpath += os.sep
+
+    jobs = []
+    new_fbxpath = fbxpath  # own dir option modifies, we need to keep an original
+    for data in data_seq:  # scene or group
+        newname = prefix + bpy.path.clean_name(data.name)
+
+        if use_batch_own_dir:
+            new_fbxpath = fbxpath + newname + os.sep
+            # path may already exist
+            # TODO - might exist but be a file. unlikely but should probably account for it.
+
+            if not os.path.exists(new_fbxpath):
+                os.makedirs(new_fbxpath)
+
+        jobs.append((data, new_fbxpath + newname + '.fbx'))
+
+    return jobs
+
+
+def save_batch_data(operator, batch_mode, data, filepath, **kwargs):
+    '''
+    Export one scene or group (data) of a batch.
+    '''
+    print('\nBatch exporting %s as...\n\t%r' % (data, filepath))
+
+    # XXX don't know what to do with this, probably do the same? (Arystan)
+    if batch_mode == 'GROUP':  # group
+        # group, so objects update properly, add a dummy scene.
+        scene = bpy.data.scenes.new(name="FBX_Temp")
+        scene.layers = [True] * 20
+        # bpy.data.scenes.active = scene # XXX, cant switch
+        for ob_base in data.objects:
+            scene.objects.link(ob_base)
+
+        scene.update()
+    else:
+        scene = data
+
+        # TODO - BUMMER! Armatures not in the group wont animate the mesh
+
+    # else:  # scene
+    #     data_seq.active = data
+
+    # Call self with modified args
+    # Dont pass batch options since we already usedt them
+    kwargs_batch = kwargs.copy()
+
+    kwargs_batch["context_objects"] = data.objects
+
+    try:
+        return save_single(operator, scene, filepath, **kwargs_batch)
+    finally:
+        if batch_mode == 'GROUP':
+            # remove temp group scene
+            bpy.data.scenes.remove(scene)
+
+
 def save(operator, context,
          filepath="",
          use_selection=False,
          batch_mode='OFF',
          use_batch_own_dir=False,
+         batch_processes=1,
+         take_processes=1,
          **kwargs
          ):
 
@@ -2863,71 +3417,30 @@ def save(operator, context,
         else:
             kwargs_mod["context_objects"] = context.scene.objects
 
+        if take_processes > 1 and kwargs.get("export_format", 'ASCII') != 'BINARY':
+            from . import batch_export
+            kwargs_mod["take_workers"] = batch_export.TakeWorkers(take_processes, context.scene,
+                                                                  kwargs_mod["context_objects"], filepath, kwargs)
+
         return save_single(operator, context.scene, filepath, **kwargs_mod)
     else:
-        fbxpath = filepath
-
-        prefix = os.path.basename(fbxpath)
-        if prefix:
-            fbxpath = os.path.dirname(fbxpath)
-
-        if not fbxpath.endswith(os.sep):
-            fbxpath += os.sep
-
         if batch_mode == 'GROUP':
             data_seq = bpy.data.groups
         else:
             data_seq = bpy.data.scenes
 
+        jobs = batch_filepaths(data_seq, filepath, use_batch_own_dir)
+
+        if batch_processes > 1 and len(jobs) > 1:
+            from . import batch_export
+            return batch_export.save_parallel(operator, batch_mode, jobs, batch_processes, kwargs)
+
         # call this function within a loop with BATCH_ENABLE == False
         # no scene switching done at the moment.
         # orig_sce = context.scene
 
-        new_fbxpath = fbxpath  # own dir option modifies, we need to keep an original
-        for data in data_seq:  # scene or group
-            newname = prefix + bpy.path.clean_name(data.name)
-
-            if use_batch_own_dir:
-                new_fbxpath = fbxpath + newname + os.sep
-                # path may already exist
-                # TODO - might exist but be a file. unlikely but should probably account for it.
-
-                if not os.path.exists(new_fbxpath):
-                    os.makedirs(new_fbxpath)
-
-            filepath = new_fbxpath + newname + '.fbx'
-
-            print('\nBatch exporting %s as...\n\t%r' % (data, filepath))
-
-            # XXX don't know what to do with this, probably do the same? (Arystan)
-            if batch_mode == 'GROUP':  # group
-                # group, so objects update properly, add a dummy scene.
-                scene = bpy.data.scenes.new(name="FBX_Temp")
-                scene.layers = [True] * 20
-                # bpy.data.scenes.active = scene # XXX, cant switch
-                for ob_base in data.objects:
-                    scene.objects.link(ob_base)
-
-                scene.update()
-            else:
-                scene = data
-
-                # TODO - BUMMER! Armatures not in the group wont animate the mesh
-
-            # else:  # scene
-            #     data_seq.active = data
-
-            # Call self with modified args
-            # Dont pass batch options since we already usedt them
-            kwargs_batch = kwargs.copy()
-
-            kwargs_batch["context_objects"] = data.objects
-
-            save_single(operator, scene, filepath, **kwargs_batch)
-
-            if batch_mode == 'GROUP':
-                # remove temp group scene
-                bpy.data.scenes.remove(scene)
+        for data, filepath in jobs:
+            save_batch_data(operator, batch_mode, data, filepath, **kwargs)
 
         # no active scene changing!
         # bpy.data.scenes.active = orig_sce
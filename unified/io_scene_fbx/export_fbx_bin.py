@@ -0,0 +1,972 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Binary FBX 7.4 writer.
+
+This writes the same object graph as the ASCII writer in export_fbx.py
+(Models, Geometry, Deformers, Pose and Takes) from the objects collected by
+export_fbx.save_single, only the encoding of the file differs.
+"""
+
+import math
+from collections import namedtuple
+
+import bpy
+from mathutils import Vector
+
+from . import encode_bin
+from .encode_bin import FBXElem
+from .encode_ascii import tolist, dedupe_values, quantize_values
+from .export_fbx import tuple_rad_to_deg
+from .vertex_weights import mesh_vertex_weights
+
+FBX_VERSION = 7400
+FBX_HEADER_VERSION = 1003
+FBX_TEMPLATES_VERSION = 100
+FBX_MODELS_VERSION = 232
+FBX_GEOMETRY_VERSION = 124
+FBX_GEOMETRY_NORMAL_VERSION = 101
+FBX_GEOMETRY_SMOOTHING_VERSION = 102
+FBX_GEOMETRY_VCOLOR_VERSION = 101
+FBX_GEOMETRY_UV_VERSION = 101
+FBX_GEOMETRY_MATERIAL_VERSION = 101
+FBX_GEOMETRY_LAYER_VERSION = 100
+FBX_POSE_BIND_VERSION = 100
+FBX_DEFORMER_SKIN_VERSION = 101
+FBX_DEFORMER_CLUSTER_VERSION = 100
+FBX_MATERIAL_VERSION = 102
+FBX_TEXTURE_VERSION = 202
+FBX_ANIM_KEY_VERSION = 4008
+
+# Keys are always linear, see the ASCII writer.
+FBX_ANIM_KEY_FLAG_LINEAR = 1 << 2
+# default tangent weights (0.333), never used with linear keys but expected by importers.
+FBX_ANIM_KEY_ATTR_DATA = (0.0, 0.0, 9.419963346924634e-30, 0.0)
+
+# Order the object types are listed in the Definitions section.
+FBX_DEFINITIONS_ORDER = (b"NodeAttribute",
+                         b"Geometry",
+                         b"Model",
+                         b"Pose",
+                         b"Deformer",
+                         b"Material",
+                         b"Texture",
+                         b"Video",
+                         b"AnimationStack",
+                         b"AnimationLayer",
+                         b"AnimationCurveNode",
+                         b"AnimationCurve",
+                         )
+
+# Everything the binary writer needs from save_single,
+# the functions are closures sharing its settings and collected objects.
+FBXExportData = namedtuple("FBXExportData", (
+    "scene",
+    "curtime",
+    "fps",
+    "start",
+    "end",
+    "fbx_time",
+    "world_amb",
+    "object_types",
+    "mesh_smooth_type",
+    "use_mesh_edges",
+    "use_color_quantize",
+    "use_anim",
+    "use_anim_optimize",
+    "use_default_take",
+    "ob_meshes",
+    "ob_bones",
+    "ob_arms",
+    "ob_null",
+    "ob_cameras",
+    "ob_lights",
+    "materials",
+    "textures",
+    "object_tx",
+    "get_constraints",
+    "get_light_props",
+    "get_material_props",
+    "get_texture_path",
+    "get_cluster_weights",
+    "get_cluster_matrix",
+    "anim_collect_actions",
+    "anim_take_begin",
+    "anim_take_sample",
+    "anim_take_end",
+    "anim_objects",
+    "anim_object_channels",
+    "anim_optimize_keys",
+    "sane_takename",
+    "scene_index",
+    ))
+
+
+# ----------------------------------------------------------------------------
+# Element helpers
+
+def elem_empty(elem, name):
+    sub_elem = FBXElem(name)
+    if elem is not None:
+        elem.elems.append(sub_elem)
+    return sub_elem
+
+
+def _elem_data_single(elem, name, value, func_name):
+    sub_elem = elem_empty(elem, name)
+    getattr(sub_elem, func_name)(value)
+    return sub_elem
+
+
+def _elem_data_vec(elem, name, value, func_name):
+    sub_elem = elem_empty(elem, name)
+    func = getattr(sub_elem, func_name)
+    for v in value:
+        func(v)
+    return sub_elem
+
+
+def elem_data_single_bool(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_bool")
+
+
+def elem_data_single_int32(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_int32")
+
+
+def elem_data_single_int64(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_int64")
+
+
+def elem_data_single_float64(elem, name, value):
+    return _elem_data_single(elem, name, float(value), "add_float64")
+
+
+def elem_data_single_bytes(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_bytes")
+
+
+def elem_data_single_string(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_string")
+
+
+def elem_data_single_string_unicode(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_string_unicode")
+
+
+def elem_data_single_int32_array(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_int32_array")
+
+
+def elem_data_single_int64_array(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_int64_array")
+
+
+def elem_data_single_float32_array(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_float32_array")
+
+
+def elem_data_single_float64_array(elem, name, value):
+    return _elem_data_single(elem, name, value, "add_float64_array")
+
+
+def elem_data_vec_int32(elem, name, value):
+    return _elem_data_vec(elem, name, value, "add_int32")
+
+
+def elem_data_vec_float64(elem, name, value):
+    return _elem_data_vec(elem, name, [float(v) for v in value], "add_float64")
+
+
+def elem_properties(elem):
+    return elem_empty(elem, b"Properties70")
+
+
+# ptype: (fbx type, fbx sub-type, number of values, add function)
+FBX_PROPERTIES_DEFINITIONS = {
+    "p_bool": (b"bool", b"", 1, "add_int32"),
+    "p_integer": (b"int", b"Integer", 1, "add_int32"),
+    "p_enum": (b"enum", b"", 1, "add_int32"),
+    "p_double": (b"double", b"Number", 1, "add_float64"),
+    "p_number": (b"Number", b"", 1, "add_float64"),
+    "p_visibility": (b"Visibility", b"", 1, "add_float64"),
+    "p_fov": (b"FieldOfView", b"", 1, "add_float64"),
+    "p_vector": (b"Vector3D", b"Vector", 3, "add_float64"),
+    "p_lcl_translation": (b"Lcl Translation", b"", 3, "add_float64"),
+    "p_lcl_rotation": (b"Lcl Rotation", b"", 3, "add_float64"),
+    "p_lcl_scaling": (b"Lcl Scaling", b"", 3, "add_float64"),
+    "p_color": (b"Color", b"", 3, "add_float64"),
+    "p_color_rgb": (b"ColorRGB", b"Color", 3, "add_float64"),
+    "p_string": (b"KString", b"", 1, "add_string_unicode"),
+    "p_string_url": (b"KString", b"Url", 1, "add_string_unicode"),
+    "p_timestamp": (b"KTime", b"Time", 1, "add_int64"),
+    "p_object": (b"object", b"", 0, None),
+    }
+
+
+def elem_props_set(elem, ptype, name, value=None, animatable=False):
+    fbx_type, fbx_sub_type, value_count, func_name = FBX_PROPERTIES_DEFINITIONS[ptype]
+
+    p = elem_data_single_string(elem, b"P", name)
+    p.add_string(fbx_type)
+    p.add_string(fbx_sub_type)
+    p.add_string(b"A" if animatable else b"")
+
+    if value_count:
+        if value_count == 1:
+            value = (value,)
+        assert(len(value) == value_count)
+
+        func = getattr(p, func_name)
+        for v in value:
+            if func_name == "add_float64":
+                v = float(v)
+            elif func_name in {"add_int32", "add_int64"}:
+                v = int(v)
+            func(v)
+
+
+def fbx_name_class(name, cls):
+    return name.encode('utf8') + b"\x00\x01" + cls
+
+
+def matrix_to_array(mat):
+    # same layout as mat4x4str in the ASCII writer
+    return [f for v in mat for f in v]
+
+
+# ----------------------------------------------------------------------------
+# Writer
+
+def write_binary(file, data):
+    '''
+    Write the collected scene in data (an FBXExportData) to a file opened in binary mode.
+    '''
+    scene = data.scene
+    fbx_time = data.fbx_time
+
+    root = elem_empty(None, b"")
+
+    # ids only need to be unique in this file, keep them predictable
+    object_ids = {}
+
+    def get_id(key):
+        uid = object_ids.get(key)
+        if uid is None:
+            uid = object_ids[key] = 1000000 + len(object_ids)
+        return uid
+
+    definitions = {}  # element name: count
+    connections = []  # (type, child_id, parent_id, property)
+    shared_geom_ids = {}  # mesh snapshot: geometry id, for unskinned meshes
+
+    def connect_oo(child_id, parent_id):
+        connections.append((b"OO", child_id, parent_id, None))
+
+    def connect_op(child_id, parent_id, prop):
+        connections.append((b"OP", child_id, parent_id, prop))
+
+    # ---------------------------- Header
+    header_ext = elem_empty(root, b"FBXHeaderExtension")
+    elem_data_single_int32(header_ext, b"FBXHeaderVersion", FBX_HEADER_VERSION)
+    elem_data_single_int32(header_ext, b"FBXVersion", FBX_VERSION)
+    elem_data_single_int32(header_ext, b"EncryptionType", 0)
+
+    elem = elem_empty(header_ext, b"CreationTimeStamp")
+    elem_data_single_int32(elem, b"Version", 1000)
+    for name, value in zip((b"Year", b"Month", b"Day", b"Hour", b"Minute", b"Second"), data.curtime):
+        elem_data_single_int32(elem, name, value)
+    elem_data_single_int32(elem, b"Millisecond", 0)
+
+    creator = "Blender version %s" % bpy.app.version_string
+    elem_data_single_string_unicode(header_ext, b"Creator", creator)
+
+    elem_data_single_bytes(root, b"FileId", encode_bin.FILE_ID)
+    elem_data_single_string(root, b"CreationTime", encode_bin.TIME_ID)
+    elem_data_single_string_unicode(root, b"Creator", creator)
+
+    # ---------------------------- Global settings
+    global_settings = elem_empty(root, b"GlobalSettings")
+    elem_data_single_int32(global_settings, b"Version", 1000)
+    props = elem_properties(global_settings)
+    elem_props_set(props, "p_integer", b"UpAxis", 1)
+    elem_props_set(props, "p_integer", b"UpAxisSign", 1)
+    elem_props_set(props, "p_integer", b"FrontAxis", 2)
+    elem_props_set(props, "p_integer", b"FrontAxisSign", 1)
+    elem_props_set(props, "p_integer", b"CoordAxis", 0)
+    elem_props_set(props, "p_integer", b"CoordAxisSign", 1)
+    elem_props_set(props, "p_double", b"UnitScaleFactor", 1.0)
+    elem_props_set(props, "p_color_rgb", b"AmbientColor", data.world_amb)
+    elem_props_set(props, "p_string", b"DefaultCamera", "Producer Perspective")
+    elem_props_set(props, "p_enum", b"TimeMode", 14)  # eCustom
+    elem_props_set(props, "p_timestamp", b"TimeSpanStart", fbx_time(data.start - 1))
+    elem_props_set(props, "p_timestamp", b"TimeSpanStop", fbx_time(data.end - 1))
+    elem_props_set(props, "p_double", b"CustomFrameRate", data.fps)
+
+    # ---------------------------- Documents, the active take is set once it is known
+    documents = elem_empty(root, b"Documents")
+    elem_data_single_int32(documents, b"Count", 1)
+    document = elem_data_single_int64(documents, b"Document", get_id(("Document",)))
+    document.add_string_unicode(scene.name)
+    document.add_string(b"Scene")
+    document_props = elem_properties(document)
+    elem_props_set(document_props, "p_object", b"SourceObject")
+    elem_data_single_int64(document, b"RootNode", 0)
+
+    elem_empty(root, b"References")
+
+    # filled in once all objects are written
+    definitions_elem = elem_empty(root, b"Definitions")
+
+    objects = elem_empty(root, b"Objects")
+
+    def add_object(elem_name, key, name, cls, sub_type):
+        elem = elem_data_single_int64(objects, elem_name, get_id(key))
+        elem.add_string(fbx_name_class(name, cls))
+        elem.add_string(sub_type)
+        definitions[elem_name] = definitions.get(elem_name, 0) + 1
+        return elem
+
+    pose_items = []  # list of (model_id, matrix), as with the ASCII writer
+
+    # --------------- funcs for exporting
+    def write_model(fbxName, fbx_sub_type, ob, matrix, pose_bone=None, is_bone=False):
+        '''
+        Write the Model and return the values of object_tx()
+        '''
+        model_id = get_id(("Model", fbxName))
+
+        if is_bone:
+            loc, rot, scale, matrix, matrix_rot = data.object_tx(ob, None, None)
+            constraints = data.get_constraints(pose_bone)
+        else:
+            loc, rot, scale, matrix, matrix_rot = data.object_tx(ob, None, matrix)
+            constraints = data.get_constraints(ob)
+
+        model = add_object(b"Model", ("Model", fbxName), fbxName, b"Model", fbx_sub_type)
+        elem_data_single_int32(model, b"Version", FBX_MODELS_VERSION)
+
+        props = elem_properties(model)
+        elem_props_set(props, "p_bool", b"QuaternionInterpolate", 0)
+        elem_props_set(props, "p_lcl_translation", b"Lcl Translation", loc, True)
+        elem_props_set(props, "p_lcl_rotation", b"Lcl Rotation", tuple_rad_to_deg(rot), True)
+        elem_props_set(props, "p_lcl_scaling", b"Lcl Scaling", scale, True)
+        elem_props_set(props, "p_visibility", b"Visibility", 1.0, True)
+        elem_props_set(props, "p_enum", b"RotationOrder", 0)
+        elem_props_set(props, "p_enum", b"InheritType", 0)
+
+        elem_props_set(props, "p_vector", b"TranslationMin", constraints["loc_min"])
+        elem_props_set(props, "p_vector", b"TranslationMax", constraints["loc_max"])
+        for i, axis in enumerate((b"TranslationMinX", b"TranslationMinY", b"TranslationMinZ",
+                                  b"TranslationMaxX", b"TranslationMaxY", b"TranslationMaxZ")):
+            elem_props_set(props, "p_bool", axis, constraints["loc_limit"][i])
+
+        elem_props_set(props, "p_vector", b"RotationMin", constraints["rot_min"])
+        elem_props_set(props, "p_vector", b"RotationMax", constraints["rot_max"])
+        for i, axis in enumerate((b"RotationMinX", b"RotationMinY", b"RotationMinZ",
+                                  b"RotationMaxX", b"RotationMaxY", b"RotationMaxZ")):
+            elem_props_set(props, "p_bool", axis, constraints["rot_limit"][i % 3])
+
+        elem_props_set(props, "p_vector", b"ScalingMin", constraints["sca_min"])
+        elem_props_set(props, "p_vector", b"ScalingMax", constraints["sca_max"])
+        for i, axis in enumerate((b"ScalingMinX", b"ScalingMinY", b"ScalingMinZ",
+                                  b"ScalingMaxX", b"ScalingMaxY", b"ScalingMaxZ")):
+            elem_props_set(props, "p_bool", axis, constraints["sca_limit"][i])
+
+        elem_props_set(props, "p_integer", b"DefaultAttributeIndex", 0)
+
+        elem_data_single_int32(model, b"MultiLayer", 0)
+        elem_data_single_int32(model, b"MultiTake", 1)
+        elem_data_single_bool(model, b"Shading", True)
+        elem_data_single_string(model, b"Culling", b"CullingOff")
+
+        return model_id, (loc, rot, scale, matrix, matrix_rot)
+
+    def write_node_attribute(fbxName, fbx_sub_type, fbx_type_flags, model_id):
+        attr = add_object(b"NodeAttribute", ("NodeAttribute", fbxName), fbxName, b"NodeAttribute", fbx_sub_type)
+        connect_oo(get_id(("NodeAttribute", fbxName)), model_id)
+        props = elem_properties(attr)
+        elem_data_single_string(attr, b"TypeFlags", fbx_type_flags)
+        return attr, props
+
+    def write_null(my_null, fbx_sub_type=b"Null", fbx_type_flags=b"Null"):
+        model_id, tx = write_model(my_null.fbxName, fbx_sub_type, my_null.blenObject, my_null.parRelMatrix())
+        pose_items.append((model_id, tx[3]))
+        write_node_attribute(my_null.fbxName, fbx_sub_type, fbx_type_flags, model_id)
+
+    def write_bone(my_bone):
+        model_id, tx = write_model(my_bone.fbxName, b"LimbNode", my_bone.blenBone, None,
+                                   pose_bone=my_bone.getPoseBone(), is_bone=True)
+        pose_items.append((model_id, tx[3]))
+
+        attr, props = write_node_attribute(my_bone.fbxName, b"LimbNode", b"Skeleton", model_id)
+        elem_props_set(props, "p_double", b"Size", 1.0)
+        elem_props_set(props, "p_double", b"LimbLength",
+                       (my_bone.blenBone.head_local - my_bone.blenBone.tail_local).length)
+
+    def write_camera(my_cam):
+        render = scene.render
+        width = render.resolution_x
+        height = render.resolution_y
+        aspect = width / height
+
+        cam = my_cam.blenObject.data
+
+        model_id, tx = write_model(my_cam.fbxName, b"Camera", my_cam.blenObject, my_cam.parRelMatrix())
+        loc, rot, scale, matrix, matrix_rot = tx
+
+        up = matrix_rot * Vector((0.0, 1.0, 0.0))
+        look_at = matrix_rot * Vector((0.0, 0.0, -1.0))
+
+        attr, props = write_node_attribute(my_cam.fbxName, b"Camera", b"Camera", model_id)
+        elem_props_set(props, "p_vector", b"Position", loc)
+        elem_props_set(props, "p_vector", b"UpVector", up)
+        elem_props_set(props, "p_vector", b"InterestPosition", Vector(loc) + look_at)
+        elem_props_set(props, "p_fov", b"FieldOfView", math.degrees(cam.angle), True)
+        elem_props_set(props, "p_number", b"OpticalCenterX", cam.shift_x, True)
+        elem_props_set(props, "p_number", b"OpticalCenterY", cam.shift_y, True)
+        elem_props_set(props, "p_double", b"AspectWidth", width)
+        elem_props_set(props, "p_double", b"AspectHeight", height)
+        elem_props_set(props, "p_double", b"FilmAspectRatio", aspect)
+        elem_props_set(props, "p_double", b"NearPlane", cam.clip_start)
+        elem_props_set(props, "p_double", b"FarPlane", cam.clip_end)
+        elem_props_set(props, "p_enum", b"CameraProjectionType", 0)
+
+        elem_data_single_int32(attr, b"GeometryVersion", FBX_GEOMETRY_VERSION)
+        elem_data_vec_float64(attr, b"Position", loc)
+        elem_data_vec_float64(attr, b"Up", up)
+        elem_data_vec_float64(attr, b"LookAt", look_at)
+        elem_data_single_int32(attr, b"ShowInfoOnMoving", 1)
+        elem_data_single_int32(attr, b"ShowAudio", 0)
+        elem_data_vec_float64(attr, b"AudioColor", (0.0, 1.0, 0.0))
+        elem_data_single_float64(attr, b"CameraOrthoZoom", 1.0)
+
+    def write_light(my_light):
+        light = my_light.blenObject.data
+        light_type, do_light, do_shadow = data.get_light_props(light)
+
+        model_id, tx = write_model(my_light.fbxName, b"Light", my_light.blenObject, my_light.parRelMatrix())
+
+        attr, props = write_node_attribute(my_light.fbxName, b"Light", b"Light", model_id)
+        elem_props_set(props, "p_enum", b"LightType", light_type)
+        elem_props_set(props, "p_bool", b"CastLight", do_light)
+        elem_props_set(props, "p_color", b"Color", light.color, True)
+        elem_props_set(props, "p_number", b"Intensity", min(light.energy * 100.0, 200.0), True)  # clamp below 200
+        if light.type == 'SPOT':
+            elem_props_set(props, "p_number", b"OuterAngle", math.degrees(light.spot_size), True)
+        elem_props_set(props, "p_enum", b"DecayType", 0)
+        elem_props_set(props, "p_double", b"DecayStart", light.distance)
+        elem_props_set(props, "p_bool", b"CastShadows", do_shadow)
+        elem_props_set(props, "p_color", b"ShadowColor", (0.0, 0.0, 0.0), True)
+
+        elem_data_single_int32(attr, b"GeometryVersion", FBX_GEOMETRY_VERSION)
+
+    def write_layer_element(geom, name, index, version, layer_name, mapping, reference):
+        lay = elem_data_single_int32(geom, name, index)
+        elem_data_single_int32(lay, b"Version", version)
+        elem_data_single_string_unicode(lay, b"Name", layer_name)
+        elem_data_single_string(lay, b"MappingInformationType", mapping)
+        elem_data_single_string(lay, b"ReferenceInformationType", reference)
+        return lay
+
+    def write_mesh(my_mesh):
+        snapshot = my_mesh.meshSnapshot
+
+        model_id, tx = write_model(my_mesh.fbxName, b"Mesh", my_mesh.blenObject, my_mesh.parRelMatrix())
+        pose_items.append((model_id, tx[3]))
+
+        # objects sharing a mesh share its geometry, unless skinned (the skin deformer belongs to the geometry)
+        if not my_mesh.fbxArm:
+            geom_id = shared_geom_ids.get(snapshot)
+            if geom_id is not None:
+                connect_oo(geom_id, model_id)
+                return model_id, geom_id
+
+        geom_id = get_id(("Geometry", my_mesh.fbxName))
+        connect_oo(geom_id, model_id)
+        if not my_mesh.fbxArm:
+            shared_geom_ids[snapshot] = geom_id
+
+        geom = add_object(b"Geometry", ("Geometry", my_mesh.fbxName), my_mesh.fbxName, b"Geometry", b"Mesh")
+        elem_properties(geom)
+        elem_data_single_int32(geom, b"GeometryVersion", FBX_GEOMETRY_VERSION)
+
+        elem_data_single_float64_array(geom, b"Vertices", tolist(snapshot.co))
+
+        # last index XORd w. -1 indicates end of face
+        t_pvi = snapshot.polygon_vertex_index()[0]
+
+        # write loose edges as faces.
+        loose_count = 0
+        if data.use_mesh_edges:
+            for j, v1, v2 in snapshot.loose_edges():
+                t_pvi.append(v1)
+                t_pvi.append(v2 ^ -1)
+                loose_count += 1
+
+        elem_data_single_int32_array(geom, b"PolygonVertexIndex", t_pvi)
+
+        # Edges reference the first polygon-vertex using them (FBX 7 differs from 6.1 here).
+        t_eli = []
+        if snapshot.edge_count:
+            edges_pvi = {}
+            pvi_ofs = 0
+            for i, v in enumerate(t_pvi):
+                if v < 0:
+                    v ^= -1
+                    # next index wraps around to the start of this polygon
+                    v_next = t_pvi[pvi_ofs]
+                    pvi_ofs = i + 1
+                else:
+                    v_next = t_pvi[i + 1]
+                    if v_next < 0:
+                        v_next ^= -1
+                edges_pvi.setdefault((min(v, v_next), max(v, v_next)), i)
+
+            edge_vertices = tolist(snapshot.edge_vertices)
+            for j in range(snapshot.edge_count):
+                v1 = edge_vertices[j * 2]
+                v2 = edge_vertices[j * 2 + 1]
+                i = edges_pvi.get((min(v1, v2), max(v1, v2)))
+                if i is not None:
+                    t_eli.append((i, j))
+
+            elem_data_single_int32_array(geom, b"Edges", [i for i, j in t_eli])
+        del t_pvi
+
+        # Normals
+        lay = write_layer_element(geom, b"LayerElementNormal", 0, FBX_GEOMETRY_NORMAL_VERSION, "",
+                                  b"ByVertice", b"Direct")
+        elem_data_single_float64_array(lay, b"Normals", tolist(snapshot.normal))
+
+        # Smoothing
+        if data.mesh_smooth_type == 'FACE':
+            lay = write_layer_element(geom, b"LayerElementSmoothing", 0, FBX_GEOMETRY_SMOOTHING_VERSION, "",
+                                      b"ByPolygon", b"Direct")
+            t_ps = tolist(snapshot.face_smooth) + [0] * loose_count
+            elem_data_single_int32_array(lay, b"Smoothing", t_ps)
+        elif data.mesh_smooth_type == 'EDGE':
+            lay = write_layer_element(geom, b"LayerElementSmoothing", 0, FBX_GEOMETRY_SMOOTHING_VERSION, "",
+                                      b"ByEdge", b"Direct")
+            edge_sharp = tolist(snapshot.edge_sharp)
+            t_ps = [edge_sharp[j] for i, j in t_eli]
+            elem_data_single_int32_array(lay, b"Smoothing", t_ps)
+        elif data.mesh_smooth_type != 'OFF':
+            raise Exception("invalid mesh_smooth_type: %r" % data.mesh_smooth_type)
+
+        # loose edges are 2 sided polygons, pad the per polygon-vertex layers.
+        loose_pv_count = loose_count * 2
+
+        # Vertex colors
+        collayers = snapshot.color_layers
+        for colindex, collayer in enumerate(collayers):
+            lay = write_layer_element(geom, b"LayerElementColor", colindex, FBX_GEOMETRY_VCOLOR_VERSION,
+                                      collayer.name, b"ByPolygonVertex", b"IndexToDirect")
+            t_col = collayer.data
+            if data.use_color_quantize:
+                t_col = quantize_values(t_col)
+
+            # each distinct color once, corners index them
+            t_col, t_ci = dedupe_values(t_col, 3)
+            if loose_pv_count:
+                t_ci.extend([len(t_col) // 3] * loose_pv_count)
+                t_col.extend([0.0, 0.0, 0.0])
+
+            t_lc = []
+            for i in range(0, len(t_col), 3):
+                t_lc.extend(t_col[i:i + 3])
+                t_lc.append(1.0)
+            del t_col
+            elem_data_single_float64_array(lay, b"Colors", t_lc)
+            elem_data_single_int32_array(lay, b"ColorIndex", t_ci)
+            del t_lc, t_ci
+
+        # UVs
+        uvlayers = snapshot.uv_layers
+        for uvindex, uvlayer in enumerate(uvlayers):
+            lay = write_layer_element(geom, b"LayerElementUV", uvindex, FBX_GEOMETRY_UV_VERSION,
+                                      uvlayer.name, b"ByPolygonVertex", b"IndexToDirect")
+            # each distinct UV once, corners index them
+            t_uv, t_uvi = dedupe_values(uvlayer.data, 2)
+            if loose_pv_count:
+                t_uvi.extend([len(t_uv) // 2] * loose_pv_count)
+                t_uv.extend([0.0, 0.0])
+
+            elem_data_single_float64_array(lay, b"UV", t_uv)
+            elem_data_single_int32_array(lay, b"UVIndex", t_uvi)
+            del t_uv, t_uvi
+
+        # Materials, indices are in the order the materials are connected to the model.
+        do_materials = bool(my_mesh.blenMaterials)
+        if do_materials:
+            if len(my_mesh.blenMaterials) == 1:
+                lay = write_layer_element(geom, b"LayerElementMaterial", 0, FBX_GEOMETRY_MATERIAL_VERSION, "",
+                                          b"AllSame", b"IndexToDirect")
+                elem_data_single_int32_array(lay, b"Materials", (0,))
+            else:
+                lay = write_layer_element(geom, b"LayerElementMaterial", 0, FBX_GEOMETRY_MATERIAL_VERSION, "",
+                                          b"ByPolygon", b"IndexToDirect")
+
+                material_mapping_local = {}  # local-mat & tex : global index.
+                for j, mat_tex_pair in enumerate(my_mesh.blenMaterials):
+                    material_mapping_local[mat_tex_pair] = j
+
+                mats = my_mesh.blenMaterialList
+
+                if snapshot.face_images is not None:
+                    face_images = snapshot.face_images
+                else:
+                    face_images = [None] * snapshot.face_count
+
+                t_mi = []
+                for mat_index, tex in zip(tolist(snapshot.face_materials), face_images):
+                    try:
+                        mat = mats[mat_index]
+                    except:
+                        mat = None
+
+                    # WARNING - MULTI UV LAYER IMAGES NOT SUPPORTED :/
+                    t_mi.append(material_mapping_local[mat, tex])
+                t_mi.extend([0] * loose_count)
+                elem_data_single_int32_array(lay, b"Materials", t_mi)
+
+        # Layers
+        layer = elem_data_single_int32(geom, b"Layer", 0)
+        elem_data_single_int32(layer, b"Version", FBX_GEOMETRY_LAYER_VERSION)
+        layer_types = [b"LayerElementNormal"]
+        if do_materials:
+            layer_types.append(b"LayerElementMaterial")
+        if data.mesh_smooth_type != 'OFF':
+            layer_types.append(b"LayerElementSmoothing")
+        if collayers:
+            layer_types.append(b"LayerElementColor")
+        if uvlayers:
+            layer_types.append(b"LayerElementUV")
+        for layer_type in layer_types:
+            lay = elem_empty(layer, b"LayerElement")
+            elem_data_single_string(lay, b"Type", layer_type)
+            elem_data_single_int32(lay, b"TypedIndex", 0)
+
+        for i in range(1, max(len(uvlayers), len(collayers))):
+            layer = elem_data_single_int32(geom, b"Layer", i)
+            elem_data_single_int32(layer, b"Version", FBX_GEOMETRY_LAYER_VERSION)
+            if i < len(uvlayers):
+                lay = elem_empty(layer, b"LayerElement")
+                elem_data_single_string(lay, b"Type", b"LayerElementUV")
+                elem_data_single_int32(lay, b"TypedIndex", i)
+            if i < len(collayers):
+                lay = elem_empty(layer, b"LayerElement")
+                elem_data_single_string(lay, b"Type", b"LayerElementColor")
+                elem_data_single_int32(lay, b"TypedIndex", i)
+
+        return model_id, geom_id
+
+    def write_material(matname, mat):
+        (mat_cold, mat_cols, mat_colamb, mat_dif, mat_amb, mat_hard,
+         mat_spec, mat_alpha, mat_emit, mat_shadeless, mat_shader) = data.get_material_props(mat)
+
+        material = add_object(b"Material", ("Material", matname), matname, b"Material", b"")
+        elem_data_single_int32(material, b"Version", FBX_MATERIAL_VERSION)
+        elem_data_single_string_unicode(material, b"ShadingModel", mat_shader.lower())
+        elem_data_single_int32(material, b"MultiLayer", 0)
+
+        props = elem_properties(material)
+        elem_props_set(props, "p_string", b"ShadingModel", mat_shader)
+        elem_props_set(props, "p_bool", b"MultiLayer", 0)
+        elem_props_set(props, "p_color", b"EmissiveColor", mat_cold, True)  # emit and diffuse color are he same in blender
+        elem_props_set(props, "p_number", b"EmissiveFactor", mat_emit, True)
+        elem_props_set(props, "p_color", b"AmbientColor", mat_colamb, True)
+        elem_props_set(props, "p_number", b"AmbientFactor", mat_amb, True)
+        elem_props_set(props, "p_color", b"DiffuseColor", mat_cold, True)
+        elem_props_set(props, "p_number", b"DiffuseFactor", mat_dif, True)
+        elem_props_set(props, "p_color", b"TransparentColor", (1.0, 1.0, 1.0), True)
+        elem_props_set(props, "p_number", b"TransparencyFactor", 1.0 - mat_alpha, True)
+        if not mat_shadeless:
+            elem_props_set(props, "p_color", b"SpecularColor", mat_cols, True)
+            elem_props_set(props, "p_number", b"SpecularFactor", mat_spec, True)
+            elem_props_set(props, "p_number", b"ShininessExponent", 80.0, True)
+            elem_props_set(props, "p_color", b"ReflectionColor", (0.0, 0.0, 0.0), True)
+            elem_props_set(props, "p_number", b"ReflectionFactor", 1.0, True)
+        elem_props_set(props, "p_vector", b"Emissive", (0.0, 0.0, 0.0))
+        elem_props_set(props, "p_vector", b"Ambient", mat_colamb)
+        elem_props_set(props, "p_vector", b"Diffuse", mat_cold)
+        if not mat_shadeless:
+            elem_props_set(props, "p_vector", b"Specular", mat_cols)
+            elem_props_set(props, "p_double", b"Shininess", mat_hard)
+        elem_props_set(props, "p_double", b"Opacity", mat_alpha)
+        if not mat_shadeless:
+            elem_props_set(props, "p_double", b"Reflectivity", 0.0)
+
+    def write_texture(texname, tex):
+        fname_rel, fname_strip = data.get_texture_path(tex)
+
+        video = add_object(b"Video", ("Video", texname), texname, b"Video", b"Clip")
+        elem_data_single_string(video, b"Type", b"Clip")
+        props = elem_properties(video)
+        elem_props_set(props, "p_string_url", b"Path", fname_rel)
+        elem_data_single_int32(video, b"UseMipMap", 0)
+        elem_data_single_string_unicode(video, b"Filename", fname_strip)
+        elem_data_single_string_unicode(video, b"RelativeFilename", fname_rel)
+
+        texture = add_object(b"Texture", ("Texture", texname), texname, b"Texture", b"")
+        elem_data_single_string(texture, b"Type", b"TextureVideoClip")
+        elem_data_single_int32(texture, b"Version", FBX_TEXTURE_VERSION)
+        elem_data_single_string(texture, b"TextureName", fbx_name_class(texname, b"Texture"))
+        props = elem_properties(texture)
+        elem_props_set(props, "p_enum", b"CurrentTextureBlendMode", 1)
+        elem_props_set(props, "p_bool", b"UseMaterial", 0)
+        elem_props_set(props, "p_bool", b"UseMipMap", 0)
+        elem_props_set(props, "p_enum", b"CurrentMappingType", 0)
+        # WrapModeU/V 0==rep, 1==clamp
+        elem_props_set(props, "p_enum", b"WrapModeU", tex.use_clamp_x)
+        elem_props_set(props, "p_enum", b"WrapModeV", tex.use_clamp_y)
+        elem_data_single_string(texture, b"Media", fbx_name_class(texname, b"Video"))
+        elem_data_single_string_unicode(texture, b"FileName", fname_strip)
+        elem_data_single_string_unicode(texture, b"RelativeFilename", fname_rel)
+        elem_data_vec_float64(texture, b"ModelUVTranslation", (0.0, 0.0))
+        elem_data_vec_float64(texture, b"ModelUVScaling", (1.0, 1.0))
+        elem_data_single_string(texture, b"Texture_Alpha_Source", b"None")
+        elem_data_vec_int32(texture, b"Cropping", (0, 0, 0, 0))
+
+        connect_oo(get_id(("Video", texname)), get_id(("Texture", texname)))
+
+    def write_deformer_skin(my_mesh, geom_id):
+        '''
+        Each mesh has its own deformer
+        '''
+        skin = add_object(b"Deformer", ("Skin", my_mesh.fbxName), my_mesh.fbxName, b"Deformer", b"Skin")
+        elem_data_single_int32(skin, b"Version", FBX_DEFORMER_SKIN_VERSION)
+        elem_data_single_float64(skin, b"Link_DeformAcuracy", 50.0)
+        skin_id = get_id(("Skin", my_mesh.fbxName))
+        connect_oo(skin_id, geom_id)
+
+        # Get normalized weights for temorary use
+        if my_mesh.fbxBoneParent:
+            weights = None
+        else:
+            weights = mesh_vertex_weights(my_mesh.blenObject, my_mesh.blenData)
+
+        for my_bone in data.scene_index.get_mesh_bones(my_mesh):
+            vgroup_indices, vgroup_weights = data.get_cluster_weights(my_mesh, my_bone, weights)
+            m = data.get_cluster_matrix(my_mesh, my_bone)
+
+            key = ("Cluster", my_mesh.fbxName, my_bone.fbxName)
+            cluster = add_object(b"Deformer", key, "Cluster %s %s" % (my_mesh.fbxName, my_bone.fbxName),
+                                 b"SubDeformer", b"Cluster")
+            elem_data_single_int32(cluster, b"Version", FBX_DEFORMER_CLUSTER_VERSION)
+            elem = elem_data_single_string(cluster, b"UserData", b"")
+            elem.add_string(b"")
+            elem_data_single_int32_array(cluster, b"Indexes", vgroup_indices)
+            elem_data_single_float64_array(cluster, b"Weights", vgroup_weights)
+            # THIS IS __NOT__ THE GLOBAL MATRIX AS DOCUMENTED :/
+            elem_data_single_float64_array(cluster, b"Transform", matrix_to_array(m.inverted()))
+            elem_data_single_float64_array(cluster, b"TransformLink", matrix_to_array(m))
+
+            connect_oo(get_id(key), skin_id)
+            connect_oo(get_id(("Model", my_bone.fbxName)), get_id(key))
+
+    def write_take(take_name, act_start, act_end):
+        '''
+        One AnimationStack per take with a single layer,
+        each animated model gets a T/R/S curve node with one curve per axis.
+        '''
+        stack_key = ("AnimationStack", take_name)
+        layer_key = ("AnimationLayer", take_name)
+
+        stack = add_object(b"AnimationStack", stack_key, take_name, b"AnimStack", b"")
+        props = elem_properties(stack)
+        elem_props_set(props, "p_timestamp", b"LocalStart", fbx_time(act_start - 1))
+        elem_props_set(props, "p_timestamp", b"LocalStop", fbx_time(act_end - 1))
+        elem_props_set(props, "p_timestamp", b"ReferenceStart", fbx_time(act_start - 1))
+        elem_props_set(props, "p_timestamp", b"ReferenceStop", fbx_time(act_end - 1))
+
+        add_object(b"AnimationLayer", layer_key, take_name, b"AnimLayer", b"")
+        connect_oo(get_id(layer_key), get_id(stack_key))
+
+        for my_ob in data.anim_objects():
+            model_id = get_id(("Model", my_ob.fbxName))
+            anim_loc, anim_rot, anim_scale = data.anim_object_channels(my_ob, act_start, act_end)
+
+            for prop_name, node_name, channels in ((b"Lcl Translation", "T", anim_loc),
+                                                   (b"Lcl Rotation", "R", anim_rot),
+                                                   (b"Lcl Scaling", "S", anim_scale),
+                                                   ):
+                node_key = ("AnimationCurveNode", take_name, my_ob.fbxName, node_name)
+                node_id = get_id(node_key)
+                curve_node = add_object(b"AnimationCurveNode", node_key, node_name, b"AnimCurveNode", b"")
+                node_props = elem_properties(curve_node)
+                connect_oo(node_id, get_id(layer_key))
+                connect_op(node_id, model_id, prop_name)
+
+                for i, axis in enumerate("XYZ"):
+                    values = channels[i]
+                    elem_props_set(node_props, "p_number", ("d|%s" % axis).encode('ascii'), values[0], True)
+
+                    if data.use_anim_optimize:
+                        keys = data.anim_optimize_keys(values, my_ob.fbxName, node_name + axis)
+                    else:
+                        keys = [(val, j) for j, val in enumerate(values)]
+
+                    curve_key = node_key + (axis,)
+                    curve = add_object(b"AnimationCurve", curve_key, "", b"AnimCurve", b"")
+                    elem_data_single_float64(curve, b"Default", values[0])
+                    elem_data_single_int32(curve, b"KeyVer", FBX_ANIM_KEY_VERSION)
+                    elem_data_single_int64_array(curve, b"KeyTime", [fbx_time(act_start + j - 1) for val, j in keys])
+                    elem_data_single_float32_array(curve, b"KeyValueFloat", [val for val, j in keys])
+                    elem_data_single_int32_array(curve, b"KeyAttrFlags", (FBX_ANIM_KEY_FLAG_LINEAR,))
+                    elem_data_single_float32_array(curve, b"KeyAttrDataFloat", FBX_ANIM_KEY_ATTR_DATA)
+                    elem_data_single_int32_array(curve, b"KeyAttrRefCount", (len(keys),))
+
+                    connect_op(get_id(curve_key), node_id, ("d|%s" % axis).encode('ascii'))
+
+    # ---------------------------- Objects, same order as the ASCII writer
+    for my_null in data.ob_null:
+        write_null(my_null)
+
+    # XNA requires the armature to be a Limb (JCB)
+    for my_arm in data.ob_arms:
+        write_null(my_arm, fbx_sub_type=b"LimbNode", fbx_type_flags=b"Skeleton")
+
+    for my_cam in data.ob_cameras:
+        write_camera(my_cam)
+
+    for my_light in data.ob_lights:
+        write_light(my_light)
+
+    mesh_geom_ids = []
+    for my_mesh in data.ob_meshes:
+        mesh_geom_ids.append(write_mesh(my_mesh))
+
+    for my_bone in data.ob_bones:
+        write_bone(my_bone)
+
+    material_names = {}
+    for matname, (mat, tex) in data.materials:
+        write_material(matname, mat)
+        material_names[mat, tex] = matname
+
+    texture_names = {}
+    for texname, tex in data.textures:
+        write_texture(texname, tex)
+        texture_names[tex] = texname
+
+    for my_mesh, (model_id, geom_id) in zip(data.ob_meshes, mesh_geom_ids):
+        if my_mesh.fbxArm:
+            write_deformer_skin(my_mesh, geom_id)
+
+    # Bind pose is essential for XNA if the 'MESH' is included (JCB)
+    pose = add_object(b"Pose", ("Pose",), "BIND_POSES", b"Pose", b"BindPose")
+    elem_data_single_string(pose, b"Type", b"BindPose")
+    elem_data_single_int32(pose, b"Version", FBX_POSE_BIND_VERSION)
+    elem_data_single_int32(pose, b"NbPoseNodes", len(pose_items))
+    for model_id, matrix in pose_items:
+        pose_node = elem_empty(pose, b"PoseNode")
+        elem_data_single_int64(pose_node, b"Node", model_id)
+        elem_data_single_float64_array(pose_node, b"Matrix", matrix_to_array(matrix) if matrix else
+                                       (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+
+    # ---------------------------- Connections between objects
+    # NOTE - The FBX SDK does not care about the order but some importers DO!
+    for ob_generic in (data.ob_meshes, data.ob_lights, data.ob_cameras, data.ob_arms, data.ob_null):
+        for my_ob in ob_generic:
+            # for deformed meshes, don't have any parents or they can get twice transformed.
+            if my_ob.fbxParent and (not my_ob.fbxArm):
+                connect_oo(get_id(("Model", my_ob.fbxName)), get_id(("Model", my_ob.fbxParent.fbxName)))
+            else:
+                connect_oo(get_id(("Model", my_ob.fbxName)), 0)
+
+    for my_mesh in data.ob_meshes:
+        # indices of LayerElementMaterial follow this order.
+        for mat_tex_pair in my_mesh.blenMaterials:
+            connect_oo(get_id(("Material", material_names[mat_tex_pair])), get_id(("Model", my_mesh.fbxName)))
+
+    # textures are linked to the material they are paired with
+    for matname, (mat, tex) in data.materials:
+        if tex:
+            connect_op(get_id(("Texture", texture_names[tex])), get_id(("Material", matname)), b"DiffuseColor")
+
+    for my_bone in data.ob_bones:
+        # Always parent to armature now
+        if my_bone.parent:
+            connect_oo(get_id(("Model", my_bone.fbxName)), get_id(("Model", my_bone.parent.fbxName)))
+        else:
+            # the armature object is written as an empty and all root level bones connect to it
+            connect_oo(get_id(("Model", my_bone.fbxName)), get_id(("Model", my_bone.fbxArm.fbxName)))
+
+    # ---------------------------- Animation
+    takes = []  # (take_name, start_time, end_time)
+    take_current = ""
+
+    if data.use_anim:
+        frame_orig = scene.frame_current
+
+        take_actions, blenActionDefault = data.anim_collect_actions()
+
+        if blenActionDefault and not data.use_default_take:
+            take_current = data.sane_takename(blenActionDefault)
+        else:
+            take_current = "Default Take"
+
+        for blenAction in take_actions:
+            take_name, act_start, act_end = data.anim_take_begin(blenAction)
+            data.anim_take_sample(act_start, act_end)
+
+            write_take(take_name, act_start, act_end)
+            takes.append((take_name, fbx_time(act_start - 1), fbx_time(act_end - 1)))
+
+            data.anim_take_end()
+
+        scene.frame_set(frame_orig)
+
+    elem_props_set(document_props, "p_string", b"ActiveAnimStackName", take_current)
+
+    # ---------------------------- Definitions
+    elem_data_single_int32(definitions_elem, b"Version", FBX_TEMPLATES_VERSION)
+    elem_data_single_int32(definitions_elem, b"Count", 1 + sum(definitions.values()))  # add 1 for global settings
+    elem = elem_data_single_string(definitions_elem, b"ObjectType", b"GlobalSettings")
+    elem_data_single_int32(elem, b"Count", 1)
+    for elem_name in FBX_DEFINITIONS_ORDER:
+        count = definitions.get(elem_name)
+        if count:
+            elem = elem_data_single_string(definitions_elem, b"ObjectType", elem_name)
+            elem_data_single_int32(elem, b"Count", count)
+
+    connections_elem = elem_empty(root, b"Connections")
+    for c_type, child_id, parent_id, prop in connections:
+        elem = elem_data_single_string(connections_elem, b"C", c_type)
+        elem.add_int64(child_id)
+        elem.add_int64(parent_id)
+        if prop is not None:
+            elem.add_string(prop)
+
+    takes_elem = elem_empty(root, b"Takes")
+    elem_data_single_string_unicode(takes_elem, b"Current", take_current)
+    for take_name, start_time, end_time in takes:
+        take = elem_data_single_string_unicode(takes_elem, b"Take", take_name)
+        elem_data_single_string_unicode(take, b"FileName", "%s.tak" % take_name.replace(" ", "_"))
+        elem = elem_data_single_int64(take, b"LocalTime", start_time)
+        elem.add_int64(end_time)
+        elem = elem_data_single_int64(take, b"ReferenceTime", start_time)
+        elem.add_int64(end_time)
+
+    encode_bin.write(file, root, FBX_VERSION)
+
+    return
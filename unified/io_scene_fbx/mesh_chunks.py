@@ -0,0 +1,97 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Splitting meshes to fit 16 bit index buffers.
+
+The content pipeline makes a vertex for every distinct combination of
+position, UVs and colors used by a face corner, so a mesh may need more
+vertices than it has in blender. Meshes needing more than the limit
+(65535 for XNA's Reach profile) are cut in half along the longest axis
+of their face centers until every chunk fits, which keeps the chunks
+spatially coherent for culling.
+"""
+
+from .encode_ascii import tolist
+
+
+def face_corner_keys(snapshot, face_vertices):
+    '''
+    Return for each face the keys of its corners, equal for corners that become the same vertex.
+    '''
+    uv_data = [tolist(uvlayer.data) for uvlayer in snapshot.uv_layers]
+    col_data = [tolist(collayer.data) for collayer in snapshot.color_layers]
+
+    keys = []
+    corner = 0
+    for verts in face_vertices:
+        face_keys = []
+        for v in verts:
+            key = [v]
+            for data in uv_data:
+                key += data[corner * 2:corner * 2 + 2]
+            for data in col_data:
+                key += data[corner * 3:corner * 3 + 3]
+            face_keys.append(tuple(key))
+            corner += 1
+        keys.append(face_keys)
+    return keys
+
+
+def expanded_vertex_count(faces, corner_keys):
+    '''
+    Return the number of distinct corners of faces.
+    '''
+    return len(set(key for f in faces for key in corner_keys[f]))
+
+
+def chunk_mesh(snapshot, vertex_limit):
+    '''
+    Return the faces of each chunk (in increasing order) with at most vertex_limit
+    expanded vertices, one chunk when the mesh fits.
+    '''
+    face_vertices = snapshot.face_vertices()
+    corner_keys = face_corner_keys(snapshot, face_vertices)
+
+    co = tolist(snapshot.co)
+    centers = [tuple(sum(co[v * 3 + axis] for v in verts) / len(verts) for axis in range(3))
+               for verts in face_vertices]
+
+    chunks = []
+    stack = [list(range(snapshot.face_count))]
+    while stack:
+        faces = stack.pop()
+        if len(faces) < 2 or expanded_vertex_count(faces, corner_keys) <= vertex_limit:
+            chunks.append(faces)
+            continue
+
+        extents = []
+        for axis in range(3):
+            values = [centers[f][axis] for f in faces]
+            extents.append(max(values) - min(values))
+        axis = extents.index(max(extents))
+
+        # split at the median, the face index keeps the order stable for faces at the same place
+        faces.sort(key=lambda f: (centers[f][axis], f))
+        mid = len(faces) // 2
+        stack.append(sorted(faces[mid:]))
+        stack.append(sorted(faces[:mid]))
+
+    return chunks
@@ -0,0 +1,92 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Keys for sharing evaluated meshes between objects.
+
+Objects with the same mesh, material slots, vertex groups and modifier
+settings (linked duplicates, dupli-verts, dupli-faces and dupli-groups)
+evaluate to the same geometry, so the exporter evaluates and snapshots it
+once. Modifiers that read other objects (except armatures when they are in
+rest pose while meshes are collected) can give each object different
+geometry and are never shared.
+"""
+
+# RNA properties that don't change the evaluated mesh
+_MODIFIER_IGNORE = {"rna_type", "name", "show_expanded", "show_in_editmode", "show_on_cage"}
+
+
+def _modifier_key(mod, armature_rest):
+    '''
+    Return the settings of a modifier as a tuple, None when it depends on other objects.
+    '''
+    key = [mod.type]
+    for prop in mod.bl_rna.properties:
+        attr = prop.identifier
+        if attr in _MODIFIER_IGNORE:
+            continue
+
+        value = getattr(mod, attr)
+        if prop.type == 'POINTER':
+            if value is None:
+                pass
+            elif armature_rest and mod.type == 'ARMATURE' and attr == "object":
+                # doesn't deform in rest pose
+                value = value.name
+            else:
+                return None
+        elif prop.type == 'COLLECTION':
+            if len(value):
+                return None
+            value = ()
+        elif isinstance(value, (set, frozenset)):
+            value = tuple(sorted(value))
+        elif hasattr(value, "__len__") and not isinstance(value, str):
+            value = tuple(value)
+
+        key.append((attr, value))
+
+    return tuple(key)
+
+
+def mesh_instance_key(ob, use_mesh_modifiers, armature_rest):
+    '''
+    Return a key equal for objects evaluating to the same mesh, None when ob can't share its mesh.
+    armature_rest is True when armatures are in rest pose (so don't deform).
+    '''
+    if ob.type != 'MESH':
+        return None
+
+    # vertex group names are per object, the mesh weights index them
+    key = [ob.data,
+           tuple((slot.link, slot.material) for slot in ob.material_slots),
+           tuple(vgroup.name for vgroup in ob.vertex_groups),
+           ]
+
+    if use_mesh_modifiers:
+        for mod in ob.modifiers:
+            if not mod.show_viewport:
+                continue
+            mod_key = _modifier_key(mod, armature_rest)
+            if mod_key is None:
+                return None
+            key.append(mod_key)
+
+    return tuple(key)
@@ -0,0 +1,264 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Vertex cache optimization of mesh snapshots.
+
+The XNA content pipeline keeps the triangle order of the file, so meshes
+are triangulated and reordered here: triangles with Tom Forsyth's linear
+speed vertex cache optimization, then vertices in the order the triangles
+first use them. The snapshot is changed in place and keeps the map from
+old to new vertex indices for the skin clusters.
+
+ACMR (average cache miss ratio) is the vertices transformed per triangle
+with a FIFO cache, from 0.5 for an ideal grid to 3.0 with no reuse.
+"""
+
+from .encode_ascii import tolist
+
+# LRU cache modeled while ordering, larger than the hardware cache on purpose
+# so the order works for any cache up to this size.
+FORSYTH_CACHE_SIZE = 32
+FORSYTH_CACHE_DECAY_POWER = 1.5
+FORSYTH_LAST_TRI_SCORE = 0.75
+FORSYTH_VALENCE_BOOST_SCALE = 2.0
+FORSYTH_VALENCE_BOOST_POWER = 0.5
+
+# post transform cache for the ACMR report (Xbox 360 sized)
+ACMR_CACHE_SIZE = 16
+
+
+def acmr(tris, cache_size=ACMR_CACHE_SIZE):
+    '''
+    Return the average cache miss ratio of a flat triangle vertex list with a FIFO cache.
+    '''
+    tri_count = len(tris) // 3
+    if not tri_count:
+        return 0.0
+
+    cache = [-1] * cache_size
+    cached = set()
+    head = 0
+    misses = 0
+    for v in tris:
+        if v not in cached:
+            misses += 1
+            cached.discard(cache[head])
+            cache[head] = v
+            cached.add(v)
+            head = (head + 1) % cache_size
+    return misses / tri_count
+
+
+def _score_tables(max_valence, cache_size):
+    cache_scores = []
+    for pos in range(cache_size):
+        if pos < 3:
+            # the last triangle's vertices, used again now gives a strip-like order
+            cache_scores.append(FORSYTH_LAST_TRI_SCORE)
+        else:
+            scaler = 1.0 / (cache_size - 3)
+            cache_scores.append((1.0 - (pos - 3) * scaler) ** FORSYTH_CACHE_DECAY_POWER)
+
+    # vertices with few triangles left are finished first, so they leave the cache
+    valence_scores = [0.0] + [FORSYTH_VALENCE_BOOST_SCALE * (valence ** -FORSYTH_VALENCE_BOOST_POWER)
+                              for valence in range(1, max_valence + 1)]
+    return cache_scores, valence_scores
+
+
+def forsyth_order(tris, vert_count, cache_size=FORSYTH_CACHE_SIZE):
+    '''
+    Return the triangles of a flat triangle vertex list in vertex cache friendly order, as indices.
+    '''
+    tri_count = len(tris) // 3
+    if not tri_count:
+        return []
+
+    vert_tris = [[] for i in range(vert_count)]
+    for t in range(tri_count):
+        for v in tris[t * 3:t * 3 + 3]:
+            vert_tris[v].append(t)
+
+    cache_scores, valence_scores = _score_tables(max(len(t_list) for t_list in vert_tris), cache_size)
+
+    cache_pos = [-1] * vert_count
+    vert_score = [valence_scores[len(t_list)] for t_list in vert_tris]
+    tri_score = [vert_score[tris[t * 3]] + vert_score[tris[t * 3 + 1]] + vert_score[tris[t * 3 + 2]]
+                 for t in range(tri_count)]
+    tri_added = [False] * tri_count
+
+    order = []
+    cache = []
+    best_tri = max(range(tri_count), key=tri_score.__getitem__)
+    next_tri = 0  # for starting again when the cache has no triangles left
+
+    while best_tri != -1:
+        order.append(best_tri)
+        tri_added[best_tri] = True
+
+        tri_verts = tris[best_tri * 3:best_tri * 3 + 3]
+        for v in tri_verts:
+            vert_tris[v].remove(best_tri)
+
+        cache[:] = tri_verts + [v for v in cache if v not in tri_verts]
+        evicted = cache[cache_size:]
+        del cache[cache_size:]
+
+        for v in evicted:
+            cache_pos[v] = -1
+            vert_score[v] = valence_scores[len(vert_tris[v])]
+
+        for pos, v in enumerate(cache):
+            cache_pos[v] = pos
+            if vert_tris[v]:
+                vert_score[v] = cache_scores[pos] + valence_scores[len(vert_tris[v])]
+            else:
+                vert_score[v] = -1.0
+
+        for v in evicted:
+            for t in vert_tris[v]:
+                tri_score[t] = vert_score[tris[t * 3]] + vert_score[tris[t * 3 + 1]] + vert_score[tris[t * 3 + 2]]
+
+        best_tri = -1
+        best_score = -1.0
+        for v in cache:
+            for t in vert_tris[v]:
+                score = tri_score[t] = vert_score[tris[t * 3]] + vert_score[tris[t * 3 + 1]] + vert_score[tris[t * 3 + 2]]
+                if score > best_score:
+                    best_score = score
+                    best_tri = t
+
+        if best_tri == -1:
+            while next_tri < tri_count and tri_added[next_tri]:
+                next_tri += 1
+            if next_tri < tri_count:
+                best_tri = next_tri
+
+    return order
+
+
+def _diagonal_02_shorter(co, v0, v1, v2, v3):
+    d02 = sum((co[v0 * 3 + i] - co[v2 * 3 + i]) ** 2 for i in range(3))
+    d13 = sum((co[v1 * 3 + i] - co[v3 * 3 + i]) ** 2 for i in range(3))
+    return d02 <= d13
+
+
+def triangulate(snapshot):
+    '''
+    Return (tris, tri_faces, tri_corners), flat triangle vertex indices,
+    the face of each triangle and the corners (into the corner layers) of each triangle vertex.
+    Quads are split along their shorter diagonal.
+    '''
+    co = tolist(snapshot.co)
+    face_vertices_raw = tolist(snapshot.face_vertices_raw)
+
+    tris = []
+    tri_faces = []
+    tri_corners = []
+    corner = 0
+    for f, quad in enumerate(tolist(snapshot.face_is_quad)):
+        v0, v1, v2, v3 = face_vertices_raw[f * 4:f * 4 + 4]
+        if not quad:
+            tris += [v0, v1, v2]
+            tri_corners += [corner, corner + 1, corner + 2]
+            tri_faces.append(f)
+            corner += 3
+        else:
+            if _diagonal_02_shorter(co, v0, v1, v2, v3):
+                split = (0, 1, 2, 0, 2, 3)
+            else:
+                split = (0, 1, 3, 1, 2, 3)
+            face_verts = (v0, v1, v2, v3)
+            tris += [face_verts[i] for i in split]
+            tri_corners += [corner + i for i in split]
+            tri_faces += [f, f]
+            corner += 4
+
+    return tris, tri_faces, tri_corners
+
+
+def _reorder(values, order, size):
+    result = []
+    for i in order:
+        result += values[i * size:i * size + size]
+    return result
+
+
+def optimize_mesh(snapshot, cache_size=FORSYTH_CACHE_SIZE):
+    '''
+    Triangulate the snapshot and reorder its triangles and vertices for the vertex cache,
+    return (acmr_before, acmr_after).
+    '''
+    tris, tri_faces, tri_corners = triangulate(snapshot)
+    acmr_before = acmr(tris)
+
+    tri_order = forsyth_order(tris, snapshot.vert_count, cache_size)
+    tris = _reorder(tris, tri_order, 3)
+    tri_faces = [tri_faces[t] for t in tri_order]
+    tri_corners = _reorder(tri_corners, tri_order, 3)
+
+    # vertices in the order they are first used, then the ones no triangle uses (loose edges)
+    vertex_remap = [-1] * snapshot.vert_count
+    vert_order = []
+    for v in tris:
+        if vertex_remap[v] == -1:
+            vertex_remap[v] = len(vert_order)
+            vert_order.append(v)
+    for v in range(snapshot.vert_count):
+        if vertex_remap[v] == -1:
+            vertex_remap[v] = len(vert_order)
+            vert_order.append(v)
+
+    tris = [vertex_remap[v] for v in tris]
+    acmr_after = acmr(tris)
+
+    snapshot.co = _reorder(tolist(snapshot.co), vert_order, 3)
+    snapshot.normal = _reorder(tolist(snapshot.normal), vert_order, 3)
+
+    face_vertices_raw = []
+    for t in range(len(tris) // 3):
+        face_vertices_raw += tris[t * 3:t * 3 + 3]
+        face_vertices_raw.append(0)
+
+    snapshot.face_count = len(tri_faces)
+    snapshot.face_vertices_raw = face_vertices_raw
+    snapshot.face_is_quad = [False] * snapshot.face_count
+    snapshot.face_sizes = [3] * snapshot.face_count
+
+    face_smooth = tolist(snapshot.face_smooth)
+    face_materials = tolist(snapshot.face_materials)
+    snapshot.face_smooth = [face_smooth[f] for f in tri_faces]
+    snapshot.face_materials = [face_materials[f] for f in tri_faces]
+
+    for uvlayer in snapshot.uv_layers:
+        uvlayer.data = _reorder(tolist(uvlayer.data), tri_corners, 2)
+        face_images = uvlayer.images
+        uvlayer.images = [face_images[f] for f in tri_faces]
+        if snapshot.face_images is face_images:
+            snapshot.face_images = uvlayer.images
+
+    for collayer in snapshot.color_layers:
+        collayer.data = _reorder(tolist(collayer.data), tri_corners, 3)
+
+    snapshot.edge_vertices = [vertex_remap[v] for v in tolist(snapshot.edge_vertices)]
+
+    snapshot.vertex_remap = vertex_remap
+
+    return acmr_before, acmr_after
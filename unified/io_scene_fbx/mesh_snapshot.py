@@ -0,0 +1,235 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Mesh data read once with foreach_get into flat arrays.
+
+The mesh, material and skin writers (ASCII and binary) all read from the
+snapshot instead of going through the RNA attributes of every vertex,
+face and edge. Face images can't be read with foreach_get, they are
+the only per face lists made in python.
+"""
+
+from .encode_ascii import foreach_get, faces_is_quad, faces_corners, faces_vertex_index, interleave, tolist
+
+MESH_COLOR_ATTRS = ("color1", "color2", "color3", "color4")
+
+
+class MeshLayer(object):
+    '''
+    A UV or vertex color layer, values for each face corner (triangles have 3 corners).
+    '''
+    __slots__ = ("name",
+                 "data",  # flat, 2 values for each UV and 3 for each color
+                 "images",  # UV layers only, the image of each face or None
+                 )
+
+    def __init__(self, name, data, images=None):
+        self.name = name
+        self.data = data
+        self.images = images
+
+
+class MeshSnapshot(object):
+    '''
+    Flat arrays of everything the writers need from a mesh.
+    '''
+    __slots__ = ("vert_count",
+                 "face_count",
+                 "edge_count",
+                 "co",  # 3 values per vertex
+                 "normal",  # 3 values per vertex
+                 "face_vertices_raw",  # 4 per face, the 4th is zero for triangles
+                 "face_is_quad",
+                 "face_sizes",
+                 "face_smooth",
+                 "face_materials",
+                 "face_images",  # images of the active UV layer, None when there are no UVs
+                 "edge_vertices",  # 2 per edge, empty unless use_edges
+                 "edge_loose",
+                 "edge_sharp",
+                 "uv_layers",
+                 "color_layers",
+                 "vertex_remap",  # new index of each mesh vertex when reordered, else None
+                 )
+
+    def __init__(self, me, use_edges=True):
+        self.vert_count = len(me.vertices)
+        self.face_count = len(me.faces)
+
+        self.co = foreach_get(me.vertices, "co", 3)
+        self.normal = foreach_get(me.vertices, "normal", 3)
+
+        self.face_vertices_raw = foreach_get(me.faces, "vertices_raw", 4, is_int=True)
+        self.face_is_quad = faces_is_quad(self.face_vertices_raw)
+        self.face_sizes = [4 if quad else 3 for quad in tolist(self.face_is_quad)]
+        self.face_smooth = foreach_get(me.faces, "use_smooth", 1, is_int=True)
+        self.face_materials = foreach_get(me.faces, "material_index", 1, is_int=True)
+
+        if use_edges:
+            self.edge_count = len(me.edges)
+            self.edge_vertices = foreach_get(me.edges, "vertices", 2, is_int=True)
+            self.edge_loose = foreach_get(me.edges, "is_loose", 1, is_int=True)
+            self.edge_sharp = foreach_get(me.edges, "use_edge_sharp", 1, is_int=True)
+        else:
+            self.edge_count = 0
+            self.edge_vertices = self.edge_loose = self.edge_sharp = ()
+
+        uv_active = me.uv_textures.active
+        self.face_images = None
+        self.uv_layers = []
+        for uvlayer in me.uv_textures:
+            images = [uf.image for uf in uvlayer.data]
+            data = faces_corners(foreach_get(uvlayer.data, "uv_raw", 8), self.face_is_quad, 2)
+            self.uv_layers.append(MeshLayer(uvlayer.name, data, images))
+            if uvlayer == uv_active:
+                self.face_images = images
+
+        self.color_layers = []
+        for collayer in me.vertex_colors:
+            data = interleave([foreach_get(collayer.data, attr, 3) for attr in MESH_COLOR_ATTRS], 3)
+            data = faces_corners(data, self.face_is_quad, 3)
+            self.color_layers.append(MeshLayer(collayer.name, data))
+
+        self.vertex_remap = None
+
+    def polygon_vertex_index(self):
+        '''
+        Return (indices, sizes) as lists, the last index of each face XORd w. -1.
+        '''
+        indices, sizes = faces_vertex_index(self.face_vertices_raw, self.face_is_quad)
+        return tolist(indices), tolist(sizes)
+
+    def face_vertices(self):
+        '''
+        Return the vertex indices of each face as tuples.
+        '''
+        face_vertices_raw = tolist(self.face_vertices_raw)
+        return [tuple(face_vertices_raw[f * 4:f * 4 + (4 if quad else 3)])
+                for f, quad in enumerate(tolist(self.face_is_quad))]
+
+    def subset(self, faces):
+        '''
+        Return a new snapshot of the faces (indices in increasing order) and the vertices they use,
+        vertex_remap maps the mesh vertices to it (-1 for vertices left out).
+        Edges are kept when the faces use them, or when they are loose and both their
+        vertices are kept. Other loose vertices are left out.
+        '''
+        face_vertices_raw = tolist(self.face_vertices_raw)
+        face_is_quad = tolist(self.face_is_quad)
+
+        # vertices keep their order, so a vertex cache optimized order stays optimized
+        used = [False] * self.vert_count
+        face_edges = set()  # (v1, v2) with v1 < v2
+        for f in faces:
+            verts = face_vertices_raw[f * 4:f * 4 + (4 if face_is_quad[f] else 3)]
+            for i, v in enumerate(verts):
+                used[v] = True
+                v_next = verts[i - 1]
+                face_edges.add((v, v_next) if v < v_next else (v_next, v))
+
+        sub_remap = [-1] * self.vert_count
+        verts = []
+        for v, is_used in enumerate(used):
+            if is_used:
+                sub_remap[v] = len(verts)
+                verts.append(v)
+
+        # corner offset of each face, for the corner layers
+        face_corners = []
+        corner = 0
+        for quad in face_is_quad:
+            face_corners.append(corner)
+            corner += 4 if quad else 3
+
+        sub = MeshSnapshot.__new__(MeshSnapshot)
+        sub.vert_count = len(verts)
+        sub.face_count = len(faces)
+
+        co = tolist(self.co)
+        normal = tolist(self.normal)
+        sub.co = [value for v in verts for value in co[v * 3:v * 3 + 3]]
+        sub.normal = [value for v in verts for value in normal[v * 3:v * 3 + 3]]
+
+        # the 4th index of a quad may become zero, face_is_quad is kept so it's still a quad
+        sub.face_vertices_raw = []
+        for f in faces:
+            sub.face_vertices_raw += [sub_remap[v] for v in face_vertices_raw[f * 4:f * 4 + 4]]
+            if not face_is_quad[f]:
+                sub.face_vertices_raw[-1] = 0
+        sub.face_is_quad = [face_is_quad[f] for f in faces]
+        sub.face_sizes = [4 if quad else 3 for quad in sub.face_is_quad]
+
+        face_smooth = tolist(self.face_smooth)
+        face_materials = tolist(self.face_materials)
+        sub.face_smooth = [face_smooth[f] for f in faces]
+        sub.face_materials = [face_materials[f] for f in faces]
+
+        def corners_subset(data, size):
+            data = tolist(data)
+            values = []
+            for f in faces:
+                ofs = face_corners[f] * size
+                values += data[ofs:ofs + (4 if face_is_quad[f] else 3) * size]
+            return values
+
+        sub.face_images = None
+        sub.uv_layers = []
+        for uvlayer in self.uv_layers:
+            images = [uvlayer.images[f] for f in faces]
+            sub.uv_layers.append(MeshLayer(uvlayer.name, corners_subset(uvlayer.data, 2), images))
+            if uvlayer.images is self.face_images:
+                sub.face_images = images
+
+        sub.color_layers = [MeshLayer(collayer.name, corners_subset(collayer.data, 3))
+                            for collayer in self.color_layers]
+
+        edge_vertices = tolist(self.edge_vertices)
+        edge_loose = tolist(self.edge_loose)
+        edge_sharp = tolist(self.edge_sharp)
+        sub.edge_vertices = []
+        sub.edge_loose = []
+        sub.edge_sharp = []
+        for j in range(self.edge_count):
+            v1, v2 = edge_vertices[j * 2:j * 2 + 2]
+            if edge_loose[j]:
+                if not (used[v1] and used[v2]):
+                    continue
+            elif ((v1, v2) if v1 < v2 else (v2, v1)) not in face_edges:
+                continue  # only used by faces of other parts
+            sub.edge_vertices += [sub_remap[v1], sub_remap[v2]]
+            sub.edge_loose.append(edge_loose[j])
+            sub.edge_sharp.append(edge_sharp[j])
+        sub.edge_count = len(sub.edge_loose)
+
+        if self.vertex_remap is not None:
+            sub.vertex_remap = [(sub_remap[v] if v != -1 else -1) for v in self.vertex_remap]
+        else:
+            sub.vertex_remap = sub_remap
+
+        return sub
+
+    def loose_edges(self):
+        '''
+        Return a list of (edge_index, v1, v2) for edges not used by any face.
+        '''
+        edge_vertices = tolist(self.edge_vertices)
+        return [(j, edge_vertices[j * 2], edge_vertices[j * 2 + 1])
+                for j, is_loose in enumerate(tolist(self.edge_loose)) if is_loose]
@@ -0,0 +1,136 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Unique FBX names for the blender data written by one export.
+
+Each namespace keeps the names it handed out in a set, and for every
+name asked for, the last name it settled on, so a following clash
+carries on incrementing from there instead of starting over.
+"""
+
+import bpy
+
+NAMESPACES = ('OBJECT',  # objects and bones share the model namespace
+              'MATERIAL',
+              'TEXTURE',
+              'TAKE',
+              'GROUP',
+              )
+
+# Make sure reserved names are not used
+RESERVED_NAMES = {'OBJECT': {'Scene': 'Scene_'}}
+
+
+def increment_string(t):
+    name = t
+    num = ''
+    while name and name[-1].isdigit():
+        num = name[-1] + num
+        name = name[:-1]
+    if num:
+        return '%s%d' % (name, int(num) + 1)
+    else:
+        return name + '_0'
+
+
+class _Namespace(object):
+    __slots__ = ("mapping",  # original name (or name pair): fbx name
+                 "used",  # fbx names handed out
+                 "last",  # clean name: last fbx name made from it
+                 )
+
+    def __init__(self):
+        self.mapping = {}
+        self.used = set()
+        self.last = {}
+
+
+class NameRegistry(object):
+    '''
+    Hands out FBX names for blender data, unique within each namespace.
+    '''
+    __slots__ = ("namespaces",
+                 )
+
+    def __init__(self):
+        self.namespaces = dict((ns, _Namespace()) for ns in NAMESPACES)
+
+        for ns, reserved in RESERVED_NAMES.items():
+            namespace = self.namespaces[ns]
+            namespace.mapping.update(reserved)
+            namespace.used.update(reserved.values())
+
+    def name(self, ns, data):
+        '''
+        Return a new unique name for data in namespace ns,
+        data may be a (data, other) pair, materials are paired up with images,
+        or a name for things made by the exporter.
+        '''
+        if type(data) == tuple:
+            data, other = data
+            use_other = True
+        else:
+            other = None
+            use_other = False
+
+        if isinstance(data, str):
+            name = data
+        else:
+            name = data.name if data else None
+        orig_name = name
+
+        if other:
+            orig_name_other = other.name
+            name = '%s #%s' % (name, orig_name_other)
+        else:
+            orig_name_other = None
+
+        # dont cache, only ever call once for each data type now,
+        # so as to avoid namespace collision between types - like with objects <-> bones
+        if not name:
+            name = 'unnamed'  # blank string, ASKING FOR TROUBLE!
+        else:
+            name = bpy.path.clean_name(name)  # use our own
+
+        namespace = self.namespaces[ns]
+        used = namespace.used
+
+        # names already taken stay taken, carry on from the last one made from this name
+        name_clean = name
+        name = namespace.last.get(name_clean, name)
+        while name in used:
+            name = increment_string(name)
+
+        namespace.last[name_clean] = name
+        used.add(name)
+
+        if use_other:  # even if other is None - orig_name_other will be a string or None
+            namespace.mapping[orig_name, orig_name_other] = name
+        else:
+            namespace.mapping[orig_name] = name
+
+        return name
+
+    def get(self, ns, key, default=None):
+        '''
+        Return the name given to key (the original name or name pair) in namespace ns.
+        '''
+        return self.namespaces[ns].mapping.get(key, default)
@@ -0,0 +1,142 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Compact storage of sampled animation matrices.
+
+Each object keeps one flat float buffer of 16 values per frame
+instead of a Matrix for every frame, matrices_to_trs turns a range of
+these into the per axis channels written to the Takes.
+"""
+
+from array import array
+
+from mathutils import Matrix
+
+# single precision, the same as mathutils stores them.
+POSE_TYPECODE = 'f'
+
+
+def matrix_flat(mat):
+    return [f for v in mat for f in v]
+
+
+class PoseBuffer(object):
+    '''
+    4x4 matrices for a continuous range of frames, starting at frame_start.
+    '''
+    __slots__ = ("frame_start",
+                 "data",
+                 )
+
+    def __init__(self):
+        self.frame_start = 0
+        self.data = array(POSE_TYPECODE)
+
+    def __len__(self):
+        return len(self.data) // 16
+
+    def clear(self, frame_start=0):
+        self.frame_start = frame_start
+        del self.data[:]
+
+    def set(self, frame, mat):
+        if not self.data:
+            self.frame_start = frame
+
+        i = (frame - self.frame_start) * 16
+        tot = len(self.data)
+        if i == tot:
+            # frames are sampled in order, this is the common case
+            self.data.extend(matrix_flat(mat))
+        elif 0 <= i < tot:
+            self.data[i:i + 16] = array(POSE_TYPECODE, matrix_flat(mat))
+        elif i > tot:
+            # gap in the frames, should not happen but keep the layout valid
+            self.data.extend([0.0] * (i - tot))
+            self.data.extend(matrix_flat(mat))
+        else:
+            # frame before the start, shift the buffer
+            data = array(POSE_TYPECODE, matrix_flat(mat))
+            data.extend([0.0] * (-i - 16))
+            data.extend(self.data)
+            self.data = data
+            self.frame_start = frame
+
+    def get(self, frame):
+        i = (frame - self.frame_start) * 16
+        if i < 0 or i >= len(self.data):
+            raise KeyError(frame)
+        d = self.data
+        return Matrix((d[i:i + 4], d[i + 4:i + 8], d[i + 8:i + 12], d[i + 12:i + 16]))
+
+    def get_range(self, frame_start, frame_end):
+        '''
+        Return the matrices from frame_start to frame_end (inclusive).
+        '''
+        i = (frame_start - self.frame_start) * 16
+        j = (frame_end + 1 - self.frame_start) * 16
+        if i < 0 or j > len(self.data):
+            raise KeyError((frame_start, frame_end))
+        d = self.data
+        return [Matrix((d[k:k + 4], d[k + 4:k + 8], d[k + 8:k + 12], d[k + 12:k + 16])) for k in range(i, j, 16)]
+
+
+# same factor as tuple_rad_to_deg() in export_fbx.py
+RAD_TO_DEG = 57.295779513
+
+
+def matrices_to_trs(mats):
+    '''
+    Decompose a frame range of (matrix, matrix_rot) pairs in one pass.
+
+    Returns (loc, rot, scale), each a list of 3 arrays (X, Y, Z) with one value per frame,
+    rotation is in degrees and every euler is kept compatible with the previous frame
+    so the curves don't flip between equivalent rotations.
+    '''
+    loc = array('d'), array('d'), array('d')
+    rot = array('d'), array('d'), array('d')
+    scale = array('d'), array('d'), array('d')
+
+    loc_x, loc_y, loc_z = [a.append for a in loc]
+    rot_x, rot_y, rot_z = [a.append for a in rot]
+    scale_x, scale_y, scale_z = [a.append for a in scale]
+
+    eul = None
+    for mat, mat_rot in mats:
+        v = mat.to_translation()
+        loc_x(v[0])
+        loc_y(v[1])
+        loc_z(v[2])
+
+        v = mat.to_scale()
+        scale_x(v[0])
+        scale_y(v[1])
+        scale_z(v[2])
+
+        if eul is None:
+            eul = mat_rot.to_euler()
+        else:
+            eul = mat_rot.to_euler('XYZ', eul)
+        rot_x(eul[0] * RAD_TO_DEG)
+        rot_y(eul[1] * RAD_TO_DEG)
+        rot_z(eul[2] * RAD_TO_DEG)
+
+    return list(loc), list(rot), list(scale)
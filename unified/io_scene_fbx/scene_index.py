@@ -0,0 +1,56 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+
+class SceneIndex(object):
+    '''
+    Lookups between blender data and the exporters own object and bone classes,
+    filled in once while collecting the objects to export.
+    '''
+    __slots__ = ("objects",
+                 "bones",
+                 "mesh_bones",
+                 )
+
+    def __init__(self):
+        self.objects = {}  # blender object: my_object_generic
+        self.bones = {}  # (armature object, bone name): my_bone_class
+        self.mesh_bones = {}  # mesh fbxName: [my_bone_class, ...], bones deforming the mesh
+
+    def add_object(self, my_ob):
+        self.objects[my_ob.blenObject] = my_ob
+
+    def get_object(self, ob, default=None):
+        return self.objects.get(ob, default)
+
+    def add_bone(self, my_bone):
+        self.bones[my_bone.fbxArm.blenObject, my_bone.blenName] = my_bone
+
+    def get_bone(self, arm_ob, bone_name, default=None):
+        return self.bones.get((arm_ob, bone_name), default)
+
+    def add_mesh_bone(self, my_mesh, my_bone):
+        self.mesh_bones.setdefault(my_mesh.fbxName, []).append(my_bone)
+
+    def get_mesh_bones(self, my_mesh):
+        '''
+        Bones deforming my_mesh, in the order they were added.
+        '''
+        return self.mesh_bones.get(my_mesh.fbxName, ())
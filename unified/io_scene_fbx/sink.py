@@ -0,0 +1,242 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Output sinks for the exporters.
+
+Writers pass many small fragments, a sink collects them and hands them
+to the file in large blocks:
+
+- FileSink, buffered writing to a file.
+- AtomicFileSink, writes to a temporary file next to the target and renames it
+  over the target on close, so other tools never see a half written file.
+- MemorySink, keeps the data in memory (checking output without touching disk).
+- NullSink, discards the data.
+
+Sinks take bytes, text writers use TextWriter which encodes in blocks too.
+"""
+
+import os
+
+# flush to the file once this many bytes are collected.
+BUFFER_SIZE = 1 << 20
+
+
+class Sink(object):
+    '''
+    Base class, collects written fragments and passes them on in blocks.
+    '''
+    __slots__ = ("_parts",
+                 "_size",
+                 "buffer_size",
+                 "closed",
+                 )
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self._parts = []
+        self._size = 0
+        self.buffer_size = buffer_size
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._write_block(b"".join(self._parts))
+            self._parts[:] = []
+            self._size = 0
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+
+    def abort(self):
+        '''
+        Discard the output (on error), does nothing for sinks that can't undo writing.
+        '''
+        self._parts[:] = []
+        self._size = 0
+        self.closed = True
+
+    def _write_block(self, data):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class MemorySink(Sink):
+    __slots__ = ("_data",
+                 )
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        Sink.__init__(self, buffer_size)
+        self._data = bytearray()
+
+    def _write_block(self, data):
+        self._data += data
+
+    def getvalue(self):
+        self.flush()
+        return bytes(self._data)
+
+
+class NullSink(Sink):
+    '''
+    Discards everything, for writers only run for part of their output.
+    '''
+    __slots__ = ()
+
+    def _write_block(self, data):
+        pass
+
+
+class FileSink(Sink):
+    __slots__ = ("filepath",
+                 "_file",
+                 )
+
+    def __init__(self, filepath, buffer_size=BUFFER_SIZE):
+        Sink.__init__(self, buffer_size)
+        self.filepath = filepath
+        self._file = self._open()
+
+    def _open(self):
+        # we do our own buffering
+        return open(self.filepath, "wb", buffering=0)
+
+    def _write_block(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if not self.closed:
+            Sink.close(self)
+            self._file.close()
+
+    def abort(self):
+        if not self.closed:
+            Sink.abort(self)
+            self._file.close()
+
+
+class AtomicFileSink(FileSink):
+    __slots__ = ("filepath_tmp",
+                 )
+
+    def _open(self):
+        # same directory so the rename never crosses file systems.
+        dirname, basename = os.path.split(self.filepath)
+        self.filepath_tmp = os.path.join(dirname, ".%s.%d.tmp" % (basename, os.getpid()))
+        return open(self.filepath_tmp, "wb", buffering=0)
+
+    def close(self):
+        if not self.closed:
+            FileSink.close(self)
+            _replace(self.filepath_tmp, self.filepath)
+
+    def abort(self):
+        if not self.closed:
+            FileSink.abort(self)
+            try:
+                os.remove(self.filepath_tmp)
+            except OSError:
+                pass
+
+
+def _replace(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        # python 3.2, os.rename fails on windows when dst exists.
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class TextWriter(object):
+    '''
+    Text front end for a sink, strings are joined and encoded a block at a time.
+    '''
+    __slots__ = ("sink",
+                 "encoding",
+                 "_parts",
+                 "_size",
+                 "_captures",
+                 )
+
+    def __init__(self, sink, encoding="utf8"):
+        self.sink = sink
+        self.encoding = encoding
+        self._parts = []
+        self._size = 0
+        self._captures = []
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._captures:
+            for capture in self._captures:
+                capture.append(data)
+        if self._size >= self.sink.buffer_size:
+            self.flush()
+
+    def capture_begin(self):
+        '''
+        Keep a copy of everything written until capture_end, captures can be nested.
+        '''
+        self._captures.append([])
+
+    def capture_end(self):
+        '''
+        Return the text written since the matching capture_begin.
+        '''
+        return "".join(self._captures.pop())
+
+    def flush(self):
+        if self._parts:
+            self.sink.write("".join(self._parts).encode(self.encoding))
+            self._parts[:] = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+    def abort(self):
+        self._parts[:] = []
+        self.sink.abort()
+
+
+def open_sink(filepath, use_atomic=True, buffer_size=BUFFER_SIZE):
+    if use_atomic:
+        return AtomicFileSink(filepath, buffer_size)
+    else:
+        return FileSink(filepath, buffer_size)
@@ -0,0 +1,189 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Static batching of mesh snapshots.
+
+Each Model costs the game a draw call per material, so static meshes
+(no parent, animation, constraints or armature) can be merged into one
+mesh per (material, image) pair, optionally one per cell of a grid so
+the batches can still be culled. Object transforms are baked into the
+vertices; the merged meshes sit at the origin.
+
+Transforms are given as (x_axis, y_axis, z_axis, origin) tuples, where a
+point moves to x * x_axis + y * y_axis + z * z_axis + origin.
+"""
+
+import math
+
+from .encode_ascii import tolist
+from .mesh_snapshot import MeshSnapshot, MeshLayer
+
+
+def face_material_keys(snapshot, mats):
+    '''
+    Return the (material, image) key of each face, the keys the mesh writer uses.
+    '''
+    if snapshot.uv_layers and snapshot.face_images is not None:
+        face_images = snapshot.face_images
+    else:
+        face_images = [None] * snapshot.face_count
+
+    keys = []
+    for mat_index, image in zip(tolist(snapshot.face_materials), face_images):
+        mat = mats[mat_index] if mat_index < len(mats) else None
+        keys.append((mat, image))
+    return keys
+
+
+def transform_point(transform, x, y, z):
+    x_axis, y_axis, z_axis, origin = transform
+    return tuple(x * x_axis[i] + y * y_axis[i] + z * z_axis[i] + origin[i] for i in range(3))
+
+
+def _cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1],
+            a[2] * b[0] - a[0] * b[2],
+            a[0] * b[1] - a[1] * b[0])
+
+
+def _normal_transform(transform):
+    '''
+    Return (axes, det), axes transform normals (the inverse transpose, times det).
+    '''
+    x_axis, y_axis, z_axis = transform[:3]
+    axes = (_cross(y_axis, z_axis), _cross(z_axis, x_axis), _cross(x_axis, y_axis))
+    det = sum(x_axis[i] * axes[0][i] for i in range(3))
+    return axes, det
+
+
+def snapshot_center(snapshot, transform):
+    '''
+    Return the center of the bounds of the transformed snapshot vertices.
+    '''
+    co = tolist(snapshot.co)
+    points = [transform_point(transform, *co[v * 3:v * 3 + 3]) for v in range(snapshot.vert_count)]
+    if not points:
+        return (0.0, 0.0, 0.0)
+    return tuple((min(p[i] for p in points) + max(p[i] for p in points)) / 2.0 for i in range(3))
+
+
+def batch_cell(center, cell_size):
+    '''
+    Return the grid cell of a point, None when cell_size is 0 (no cells).
+    '''
+    if not cell_size:
+        return None
+    return tuple(int(math.floor(value / cell_size)) for value in center)
+
+
+def merge_snapshots(parts):
+    '''
+    Return one snapshot with the faces of all parts, [(snapshot, transform), ...].
+    The parts need the same number of UV and color layers, the layer names are taken
+    from the first part. Faces of mirrored parts are flipped so they keep facing out.
+    '''
+    first = parts[0][0]
+
+    merged = MeshSnapshot.__new__(MeshSnapshot)
+    merged.vert_count = 0
+    merged.face_count = 0
+    merged.edge_count = 0
+    merged.co = []
+    merged.normal = []
+    merged.face_vertices_raw = []
+    merged.face_is_quad = []
+    merged.face_sizes = []
+    merged.face_smooth = []
+    merged.face_materials = []
+    merged.edge_vertices = []
+    merged.edge_loose = []
+    merged.edge_sharp = []
+    merged.uv_layers = [MeshLayer(uvlayer.name, [], []) for uvlayer in first.uv_layers]
+    merged.color_layers = [MeshLayer(collayer.name, []) for collayer in first.color_layers]
+    merged.vertex_remap = None
+
+    merged.face_images = None
+    for uvlayer, merged_layer in zip(first.uv_layers, merged.uv_layers):
+        if uvlayer.images is first.face_images:
+            merged.face_images = merged_layer.images
+
+    for snapshot, transform in parts:
+        offset = merged.vert_count
+        normal_axes, det = _normal_transform(transform)
+        flip = det < 0.0
+
+        co = tolist(snapshot.co)
+        normal = tolist(snapshot.normal)
+        for v in range(snapshot.vert_count):
+            merged.co += transform_point(transform, *co[v * 3:v * 3 + 3])
+
+            nx, ny, nz = normal[v * 3:v * 3 + 3]
+            n = [nx * normal_axes[0][i] + ny * normal_axes[1][i] + nz * normal_axes[2][i] for i in range(3)]
+            length = math.sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2])
+            if length:
+                if flip:
+                    length = -length
+                n = [value / length for value in n]
+            merged.normal += n
+
+        face_vertices_raw = tolist(snapshot.face_vertices_raw)
+        face_is_quad = tolist(snapshot.face_is_quad)
+        for f, quad in enumerate(face_is_quad):
+            size = 4 if quad else 3
+            verts = [v + offset for v in face_vertices_raw[f * 4:f * 4 + size]]
+            if flip:
+                verts.reverse()
+            if not quad:
+                verts.append(0)
+            merged.face_vertices_raw += verts
+        merged.face_is_quad += face_is_quad
+        merged.face_sizes += [4 if quad else 3 for quad in face_is_quad]
+        merged.face_smooth += tolist(snapshot.face_smooth)
+        merged.face_materials += tolist(snapshot.face_materials)
+
+        def corners(data, size):
+            data = tolist(data)
+            if not flip:
+                return data
+            values = []
+            ofs = 0
+            for quad in face_is_quad:
+                corner_count = 4 if quad else 3
+                for corner in range(corner_count - 1, -1, -1):
+                    values += data[ofs + corner * size:ofs + corner * size + size]
+                ofs += corner_count * size
+            return values
+
+        for uvlayer, merged_layer in zip(snapshot.uv_layers, merged.uv_layers):
+            merged_layer.data += corners(uvlayer.data, 2)
+            merged_layer.images += uvlayer.images
+        for collayer, merged_layer in zip(snapshot.color_layers, merged.color_layers):
+            merged_layer.data += corners(collayer.data, 3)
+
+        merged.edge_vertices += [v + offset for v in tolist(snapshot.edge_vertices)]
+        merged.edge_loose += tolist(snapshot.edge_loose)
+        merged.edge_sharp += tolist(snapshot.edge_sharp)
+
+        merged.vert_count += snapshot.vert_count
+        merged.face_count += snapshot.face_count
+        merged.edge_count += snapshot.edge_count
+
+    return merged
@@ -0,0 +1,222 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Texture paths and copies for the exported file.
+
+Each image path is resolved once, and with path_mode 'COPY' the file is
+handed to a thread pool as soon as it is resolved, so textures copy while
+the rest of the FBX is written. Files already at the destination are left
+alone when their size and modification time match, or failing that when
+their content hashes match.
+"""
+
+import os
+import shutil
+import hashlib
+
+# copying is mostly waiting on the disk, a few threads are enough.
+COPY_THREADS = 4
+
+# Linux ioctl cloning a whole file (copy on write), see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+def _file_hash(filepath):
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        while True:
+            data = f.read(_HASH_BLOCK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.digest()
+
+
+def file_unchanged(file_src, file_dst):
+    '''
+    Return True when file_dst already has the content of file_src.
+    '''
+    try:
+        st_src = os.stat(file_src)
+        st_dst = os.stat(file_dst)
+    except OSError:
+        return False
+
+    if st_src.st_size != st_dst.st_size:
+        return False
+    if int(st_src.st_mtime) == int(st_dst.st_mtime):
+        return True
+
+    # touched but maybe not changed, eg. re-saved from an image editor
+    return _file_hash(file_src) == _file_hash(file_dst)
+
+
+def _reflink(file_src, file_dst):
+    import fcntl
+
+    with open(file_src, "rb") as f_src:
+        with open(file_dst, "wb") as f_dst:
+            fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+    shutil.copystat(file_src, file_dst)
+
+
+def _remove(filepath):
+    if os.path.lexists(filepath):
+        os.remove(filepath)
+
+
+def deploy_file(file_src, file_dst, copy_method='COPY'):
+    '''
+    Put file_src at file_dst, return 'MISSING', 'UNCHANGED', 'LINKED' or 'COPIED'.
+    Links fall back to copying when the file system can't make them.
+    '''
+    if not os.path.exists(file_src):
+        return 'MISSING'
+
+    if os.path.exists(file_dst) and file_unchanged(file_src, file_dst):
+        return 'UNCHANGED'
+
+    dir_to_make = os.path.dirname(file_dst)
+    if not os.path.isdir(dir_to_make):
+        try:
+            os.makedirs(dir_to_make)
+        except OSError:
+            # made by another thread in the mean time
+            if not os.path.isdir(dir_to_make):
+                raise
+
+    if copy_method == 'HARDLINK':
+        _remove(file_dst)
+        try:
+            os.link(file_src, file_dst)
+            return 'LINKED'
+        except (AttributeError, OSError):
+            pass
+    elif copy_method == 'REFLINK':
+        _remove(file_dst)
+        try:
+            _reflink(file_src, file_dst)
+            return 'LINKED'
+        except (ImportError, IOError, OSError):
+            _remove(file_dst)
+
+    # copy2 keeps the modification time, so the next export sees the file unchanged.
+    shutil.copy2(file_src, file_dst)
+    return 'COPIED'
+
+
+class TextureDeploy(object):
+    '''
+    Resolves image paths for the exported file and copies the images alongside it.
+    '''
+    __slots__ = ("base_src",
+                 "base_dst",
+                 "path_mode",
+                 "copy_method",
+                 "use_copy",
+                 "_paths",
+                 "_pending",
+                 "_executor",
+                 )
+
+    def __init__(self, base_src, base_dst, path_mode, copy_method='COPY', use_copy=True):
+        self.base_src = base_src
+        self.base_dst = base_dst
+        self.path_mode = path_mode
+        self.copy_method = copy_method
+        self.use_copy = use_copy
+        self._paths = {}
+        self._pending = {}  # file_dst: (file_src, future)
+        self._executor = None
+
+    def path(self, filepath):
+        '''
+        Return the path to write for an image filepath, starting its copy when path_mode is 'COPY'.
+        '''
+        try:
+            return self._paths[filepath]
+        except KeyError:
+            pass
+
+        import bpy_extras.io_utils
+
+        copy_set = set()
+        fname_rel = bpy_extras.io_utils.path_reference(filepath, self.base_src, self.base_dst, self.path_mode, "", copy_set)
+        self._paths[filepath] = fname_rel
+
+        if self.use_copy:
+            for file_src, file_dst in copy_set:
+                self._copy(file_src, file_dst)
+
+        return fname_rel
+
+    def _copy(self, file_src, file_dst):
+        if file_dst in self._pending:
+            return
+
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(COPY_THREADS)
+
+        future = self._executor.submit(deploy_file, file_src, file_dst, self.copy_method)
+        self._pending[file_dst] = (file_src, future)
+
+    def finish(self):
+        '''
+        Wait for the copies and print what was done.
+        '''
+        if self._executor is None:
+            return
+
+        counts = {}
+        for file_dst, (file_src, future) in sorted(self._pending.items()):
+            try:
+                status = future.result()
+            except EnvironmentError as e:
+                print("\ttextures: can't copy %r to %r, %s" % (file_src, file_dst, e))
+                status = 'FAILED'
+            else:
+                if status == 'MISSING':
+                    print("\ttextures: missing %r, not copying" % file_src)
+            counts[status] = counts.get(status, 0) + 1
+
+        self._executor.shutdown()
+        self._executor = None
+        self._pending.clear()
+
+        print("\ttextures: %s" % ", ".join("%d %s" % (count, status.lower()) for status, count in sorted(counts.items())))
+
+    def abort(self):
+        '''
+        Cancel the copies not started yet and wait for the running ones, when the export fails.
+        '''
+        if self._executor is None:
+            return
+
+        for file_src, future in self._pending.values():
+            future.cancel()
+
+        # a copy can't be stopped half way, let it finish rather than leave a partial image
+        self._executor.shutdown()
+        self._executor = None
+        self._pending.clear()
@@ -0,0 +1,113 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+"""
+Sparse vertex group weights.
+
+Only the weights a vertex actually has are stored, in compressed rows
+(vertex i uses vert_groups/vert_weights[vert_offsets[i]:vert_offsets[i + 1]]),
+along with the same weights listed by group for writing the skin clusters.
+"""
+
+from array import array
+
+_EMPTY_INDICES = array('i')
+_EMPTY_WEIGHTS = array('d')
+
+
+class VertexWeights(object):
+    '''
+    Normalized weights of a mesh, each vertex weights add up to 1.0.
+    '''
+    __slots__ = ("group_names",
+                 "group_index",  # {group_name: group index}
+                 "vert_offsets",
+                 "vert_groups",
+                 "vert_weights",
+                 "group_verts",  # per group, vertex indices in order
+                 "group_weights",  # per group, weights matching group_verts
+                 )
+
+    def __init__(self, group_names):
+        self.group_names = group_names
+        self.group_index = dict((name, i) for i, name in enumerate(group_names))
+        self.vert_offsets = array('i', (0,))
+        self.vert_groups = array('i')
+        self.vert_weights = array('d')
+        self.group_verts = [array('i') for i in range(len(group_names))]
+        self.group_weights = [array('d') for i in range(len(group_names))]
+
+    def __len__(self):
+        return len(self.vert_offsets) - 1
+
+    def add_vertex(self, groups):
+        '''
+        Add the next vertex from its (group_index, weight) pairs,
+        the weights are normalized and zero weights are left out.
+        '''
+        vert_index = len(self.vert_offsets) - 1
+
+        tot = 0.0
+        for group, w in groups:
+            tot += w
+
+        for group, w in groups:
+            if not w:
+                continue
+            if tot:
+                w /= tot
+            self.vert_groups.append(group)
+            self.vert_weights.append(w)
+            self.group_verts[group].append(vert_index)
+            self.group_weights[group].append(w)
+
+        self.vert_offsets.append(len(self.vert_groups))
+
+    def vertex(self, vert_index):
+        '''
+        Return (group_indices, weights) of a vertex.
+        '''
+        i = self.vert_offsets[vert_index]
+        j = self.vert_offsets[vert_index + 1]
+        return self.vert_groups[i:j], self.vert_weights[i:j]
+
+    def group(self, name):
+        '''
+        Return (vertex_indices, weights) for the vertices in group name.
+        '''
+        group = self.group_index.get(name)
+        if group is None:
+            return _EMPTY_INDICES, _EMPTY_WEIGHTS
+        return self.group_verts[group], self.group_weights[group]
+
+
+# ob must be OB_MESH
+def mesh_vertex_weights(ob, me):
+    '''
+    Return the VertexWeights of a mesh, reading each vertex groups once.
+    '''
+    weights = VertexWeights([g.name for g in ob.vertex_groups])
+    len_groupNames = len(weights.group_names)
+
+    for v in me.vertices:
+        # possible weights are out of range
+        weights.add_vertex([(g.group, g.weight) for g in v.groups if g.group < len_groupNames])
+
+    return weights